@@ -0,0 +1,138 @@
+"""
+benchmark_patch_order.py: compare patch traversal orders
+
+For each order (row, morton, hilbert) the patches of a slide are
+visited and
+    1. an LRU cache of native slide tiles is simulated to give the
+       tile cache hit rate
+    2. the first n patches are read with OpenSlide (fresh handle per
+       run) to give read throughput. Every run starts with the slide
+       evicted from the OS page cache, the orders run in a shuffled
+       sequence each round and the median and spread over rounds
+       are reported
+"""
+
+import os
+import time
+import random
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from openslide import OpenSlide
+
+from pyslide.slide import Slide
+from pyslide.patching import Patch
+
+
+def cache_hit_rate(patches,size,downsample,tile_size,capacity):
+    """
+    simulate an LRU cache of native tiles
+    :param patches: list of patch dicts
+    :param size: patch (w,h) at level
+    :param downsample: level downsample
+    :param tile_size: native tile edge at level
+    :param capacity: number of cached tiles
+    :return hit rate
+    """
+    cache=OrderedDict()
+    hits=total=0
+    for p in patches:
+        x0,y0=p['x']//downsample,p['y']//downsample
+        for i in range(x0//tile_size,(x0+size[0]-1)//tile_size+1):
+            for j in range(y0//tile_size,(y0+size[1]-1)//tile_size+1):
+                total+=1
+                if (i,j) in cache:
+                    hits+=1
+                    cache.move_to_end((i,j))
+                else:
+                    cache[(i,j)]=True
+                    if len(cache)>capacity:
+                        cache.popitem(last=False)
+    return hits/max(total,1)
+
+
+def drop_cache(path):
+    """
+    evict a file from the OS page cache (advisory, linux) so a
+    timed run does not reuse pages read by the previous one
+    """
+    fd=os.open(path,os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd,0,0,os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def read_throughput(slide_path,patches,size,mag_level,num):
+    """
+    time OpenSlide reads of the first num patches from a cold file
+    :return patches per second
+    """
+    drop_cache(slide_path)
+    slide=OpenSlide(slide_path)
+    start=time.perf_counter()
+    for p in patches[:num]:
+        slide.read_region((p['x'],p['y']),mag_level,size)
+    elapsed=time.perf_counter()-start
+    slide.close()
+    return min(num,len(patches))/elapsed
+
+
+def benchmark(slide_path,size,step,mag_level,tile_size,capacity,num,repeats=3,seed=0):
+    """
+    :param repeats: timed rounds, each running every order once in
+        a shuffled sequence
+    :return dataframe with median and spread of patches/s per order
+    """
+    slide=Slide(slide_path)
+    w,h=slide.dims
+    patch=Patch(slide,size,mag_level=mag_level,border=[[0,w],[0,h]])
+    orders={}
+    hit_rates={}
+    for order in ['row','morton','hilbert']:
+        patch.generate_patches(step,order=order)
+        orders[order]=list(patch.patches)
+        hit_rates[order]=cache_hit_rate(orders[order],size,patch._downsample,tile_size,capacity)
+
+    timings={order:[] for order in orders}
+    rng=random.Random(seed)
+    for r in range(repeats):
+        sequence=list(orders)
+        rng.shuffle(sequence)
+        for order in sequence:
+            timings[order].append(read_throughput(slide_path,orders[order],size,mag_level,num))
+            print(f'round {r} {order}: {timings[order][-1]:.1f} patches/s')
+
+    results=[]
+    for order, t in timings.items():
+        results.append({'order':order,
+                        'patches':len(orders[order]),
+                        'hit_rate':hit_rates[order],
+                        'patches_per_s':float(np.median(t)),
+                        'patches_per_s_min':min(t),
+                        'patches_per_s_max':max(t),
+                        'patches_per_s_std':float(np.std(t))})
+    return pd.DataFrame(results)
+
+
+if __name__=='__main__':
+    ap=argparse.ArgumentParser(description='benchmark patch traversal order')
+    ap.add_argument('-wp','--wsi_path',required=True,help='path to slide')
+    ap.add_argument('-s','--size',default=512,help='patch size')
+    ap.add_argument('-st','--step',default=512,help='patch step')
+    ap.add_argument('-ml','--mag_level',default=0,help='magnification level')
+    ap.add_argument('-ts','--tile_size',default=256,help='native tile size for cache simulation')
+    ap.add_argument('-c','--capacity',default=256,help='cached tiles in simulation')
+    ap.add_argument('-n','--num',default=2000,help='patches to read for throughput')
+    ap.add_argument('-r','--repeats',default=3,help='timed rounds per order')
+    ap.add_argument('-sp','--save_path',default=None,help='optional csv of results')
+    args=ap.parse_args()
+
+    size=(int(args.size),int(args.size))
+    df=benchmark(args.wsi_path,size,int(args.step),int(args.mag_level),
+                 int(args.tile_size),int(args.capacity),int(args.num),int(args.repeats))
+    print(df)
+    if args.save_path is not None:
+        df.to_csv(args.save_path,index=False)
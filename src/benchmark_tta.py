@@ -0,0 +1,67 @@
+"""
+benchmark_tta.py: throughput cost of test time augmentation views
+
+Times the compiled Predict forward pass on random tiles for an
+increasing number of TTA views (all views of a batch run in one model
+call) and reports tiles/s, views/s and the time per view relative to
+no augmentation.
+"""
+
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+from tensorflow.keras.models import load_model
+
+from predict import Predict, TTA_TRANSFORMS
+
+
+def benchmark(model,tile_dim,batch_size,views,num,warmup=2):
+    """
+    :param model: keras model
+    :param tile_dim: tile dims
+    :param batch_size: tiles per batch (model sees batch_size*views)
+    :param views: list of view lists to time, None for no tta
+    :param num: timed batches per setting
+    :return dataframe
+    """
+    tiles=np.random.randint(0,256,(batch_size,tile_dim,tile_dim,3),dtype=np.uint8)
+    results=[]
+    for tta in views:
+        predict=Predict(model,0.5,tile_dim,tile_dim,batch_size=batch_size,tta=tta)
+        for _ in range(warmup):
+            np.asarray(predict._infer(tiles))
+        start=time.perf_counter()
+        for _ in range(num):
+            np.asarray(predict._infer(tiles))
+        elapsed=time.perf_counter()-start
+        n_views=1 if tta is None else len(tta)
+        results.append({'views':n_views,
+                        'transforms':'none' if tta is None else ','.join(tta),
+                        'tiles_per_s':num*batch_size/elapsed,
+                        'views_per_s':num*batch_size*n_views/elapsed})
+        print(results[-1])
+    df=pd.DataFrame(results)
+    base=df['tiles_per_s'].iloc[0]
+    df['cost']=base/df['tiles_per_s']
+    df['cost_per_view']=df['cost']/df['views']
+    return df
+
+
+if __name__=='__main__':
+    ap=argparse.ArgumentParser(description='benchmark test time augmentation')
+    ap.add_argument('-mp','--model_path',required=True,help='path to trained model')
+    ap.add_argument('-td','--tile_dim',default=1024,help='tile dims')
+    ap.add_argument('-bs','--batch_size',default=2,help='tiles per batch')
+    ap.add_argument('-n','--num',default=10,help='timed batches per setting')
+    ap.add_argument('-sp','--save_path',default=None,help='optional csv of results')
+    args=ap.parse_args()
+
+    model=load_model(args.model_path, compile=False)
+    names=list(TTA_TRANSFORMS)
+    views=[None]+[names[:k] for k in (1,2,4,8)]
+    df=benchmark(model,int(args.tile_dim),int(args.batch_size),views,int(args.num))
+    print(df)
+    if args.save_path is not None:
+        df.to_csv(args.save_path,index=False)
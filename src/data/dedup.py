@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+'''
+dedup.py: find near duplicate patches before tfrecord conversion.
+
+Each image and mask gets a 64 bit difference hash (dHash) of a small
+grayscale thumbnail. dHash only compares neighbouring intensities so it
+is unchanged by the colour variants written by stain_augmentation.py
+and close for heavily overlapping grid patches. Hashes are split into
+maxDistance+1 bands, so any two hashes within maxDistance bits share at
+least one band exactly. Only patches sharing a band bucket are
+compared. Two patches are duplicates if both the image and the mask
+hashes are within maxDistance.
+'''
+
+import os
+import argparse
+
+import cv2
+import pandas as pd
+
+DEBUG=True
+
+
+def dHash(image, hashSize=8):
+    '''
+    difference hash of an image
+    Args:
+        image: ndarray (HxW or HxWxC)
+        hashSize: hash is hashSize*hashSize bits
+    Returns:
+        int hash
+    '''
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (hashSize+1, hashSize), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(''.join('1' if b else '0' for b in bits), 2)
+
+
+def hammingDistance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def hashFiles(imagePaths, maskPaths):
+    '''
+    hash images and their masks (matched on file name)
+    Args:
+        imagePaths: image paths
+        maskPaths: mask paths
+    Returns:
+        dataframe of path, maskPath, imageHash, maskHash, bytes
+    '''
+    masks = {os.path.basename(m): m for m in maskPaths}
+    rows = []
+    for i, path in enumerate(imagePaths):
+        maskPath = masks.get(os.path.basename(path))
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        mask = cv2.imread(maskPath, cv2.IMREAD_GRAYSCALE) if maskPath else None
+        size = os.path.getsize(path) + (os.path.getsize(maskPath) if maskPath else 0)
+        rows.append({'path': path,
+                     'maskPath': maskPath,
+                     'imageHash': dHash(image),
+                     'maskHash': dHash(mask) if mask is not None else 0,
+                     'bytes': size})
+        if DEBUG and i % 10000 == 0: print('hashed {}'.format(i))
+    return pd.DataFrame(rows)
+
+
+def findDuplicates(hashes, maxDistance=4, hashBits=64):
+    '''
+    cluster near duplicates with banded buckets and union find
+    Args:
+        hashes: dataframe from hashFiles
+        maxDistance: max differing bits for a duplicate
+        hashBits: bits per hash
+    Returns:
+        cluster id for each row (the index of its first member)
+    '''
+    parent = list(range(len(hashes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    #identical hashes (e.g. blank background) are joined first so
+    #buckets hold distinct hashes only
+    first = {}
+    for i, key in enumerate(zip(hashes['imageHash'], hashes['maskHash'])):
+        parent[i] = first.setdefault(key, i)
+    unique = sorted(set(first.values()))
+    imageHashes = {i: hashes['imageHash'].iat[i] for i in unique}
+    maskHashes = {i: hashes['maskHash'].iat[i] for i in unique}
+    numBands = maxDistance+1
+    width = -(-hashBits//numBands)
+    for band in range(numBands):
+        buckets = {}
+        for i in unique:
+            key = (int(imageHashes[i]) >> (band*width)) & ((1 << width)-1)
+            buckets.setdefault(key, []).append(i)
+        for members in buckets.values():
+            for a, i in enumerate(members):
+                for j in members[a+1:]:
+                    if find(i) == find(j):
+                        continue
+                    if hammingDistance(int(imageHashes[i]), int(imageHashes[j])) > maxDistance:
+                        continue
+                    if hammingDistance(int(maskHashes[i]), int(maskHashes[j])) > maxDistance:
+                        continue
+                    ri, rj = find(i), find(j)
+                    parent[max(ri, rj)] = min(ri, rj)
+    return [find(i) for i in range(len(hashes))]
+
+
+def dedupFiles(imagePaths, maskPaths, maxDistance=4, epochSeconds=None):
+    '''
+    keep one patch per cluster of near duplicates and report
+    the saving
+    Args:
+        imagePaths: image paths
+        maskPaths: mask paths
+        maxDistance: max differing hash bits for a duplicate
+        epochSeconds: optional current epoch time to estimate saving
+    Returns:
+        imagePaths: kept image paths
+        maskPaths: kept mask paths
+        report: dataframe per patch with cluster and cluster size
+    '''
+    hashes = hashFiles(imagePaths, maskPaths)
+    if len(hashes) == 0:
+        return imagePaths, maskPaths, hashes
+    hashes['cluster'] = findDuplicates(hashes, maxDistance)
+    hashes['clusterSize'] = hashes.groupby('cluster')['path'].transform('count')
+    hashes['keep'] = hashes['cluster'] == hashes.index
+
+    duplicates = int((~hashes['keep']).sum())
+    savedBytes = int(hashes.loc[~hashes['keep'], 'bytes'].sum())
+    fraction = duplicates/len(hashes)
+    print('Near duplicates: {} of {} ({:.1%})'.format(duplicates, len(hashes), fraction))
+    print('Storage saved: {:.1f} MB of {:.1f} MB'.format(savedBytes/10**6, hashes['bytes'].sum()/10**6))
+    if epochSeconds is not None:
+        print('Epoch time saved: {:.0f}s of {:.0f}s'.format(fraction*epochSeconds, epochSeconds))
+    else:
+        print('Epoch time saved: {:.1%} of steps'.format(fraction))
+
+    kept = hashes[hashes['keep']]
+    #images without a matching mask have no maskPath
+    return list(kept['path']), list(kept['maskPath'].dropna()), hashes
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-fp', '--filepath', required=True, help='path to images')
+    ap.add_argument('-mp', '--maskpath', required=True, help='path to masks')
+    ap.add_argument('-d', '--distance', default=4, help='max differing hash bits')
+    ap.add_argument('-es', '--epochseconds', default=None, help='current epoch time in seconds')
+    ap.add_argument('-op', '--outpath', default=None, help='csv of clusters')
+    args = vars(ap.parse_args())
+
+    imagePaths = sorted(os.path.join(args['filepath'], f) for f in os.listdir(args['filepath']))
+    maskPaths = sorted(os.path.join(args['maskpath'], f) for f in os.listdir(args['maskpath']))
+    epochSeconds = float(args['epochseconds']) if args['epochseconds'] else None
+    _, _, report = dedupFiles(imagePaths, maskPaths, int(args['distance']), epochSeconds)
+    if args['outpath']:
+        report.to_csv(args['outpath'], index=False)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+'''
+lmdb_read.py: tf.data input pipeline reading patches written by
+pyslide Patch.to_lmdb. Records are read by random access so the whole
+dataset is shuffled every epoch without a shuffle buffer.
+'''
+
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from data.tfrecord_read import TFRecordLoader
+from pyslide.io.lmdb_io import LMDBRead
+
+DEBUG=True
+
+
+class LMDBLoader(TFRecordLoader):
+    '''
+    drop-in replacement for TFRecordLoader. Keys are split into
+    num_shards interleaved from_generator datasets which read in
+    parallel; augment and normalize are inherited
+    '''
+    def __init__(self,db_path,name,tile_dims,task_type,batch_size,num_shards=8):
+        super().__init__(db_path,name,tile_dims,task_type,batch_size)
+        self.db_path=db_path
+        self.num_shards=num_shards
+        self.reader=LMDBRead(db_path)
+        self.keys=self.reader.get_keys()
+        #to_lmdb writes no masks by default
+        if self.reader.num_masks<len(self.keys):
+            raise ValueError(f'{db_path} has {self.reader.num_masks} masks for '
+                             f'{len(self.keys)} images, write it with to_lmdb(mask_flag=True)')
+
+
+    def record_size(self):
+        '''
+        total number of patches in the database
+        '''
+        self.tile_nums=len(self.keys)
+
+
+    def _generator(self,shard,shuffle):
+        '''
+        yield image/mask pairs for one index shard
+        :param shard: shard index
+        :param shuffle: shuffle keys each epoch
+        :yield image: ndarray (HxWxC)
+        :yield mask: ndarray (HxWx1)
+        '''
+        idx=np.arange(shard,len(self.keys),self.num_shards)
+        if shuffle:
+            idx=np.random.permutation(idx)
+        for i in idx:
+            key=self.keys[i]
+            image=self.reader.read_image(key)
+            mask=self.reader.read_mask(key)
+            yield image, mask.reshape(mask.shape[:2]+(-1,))[:,:,0:1]
+
+
+    def load(self,batch_size):
+        '''
+        generate tf.data.dataset containing image+mask tensors
+        :param batch_size: batch size
+        '''
+        self.batch_size=batch_size
+        AUTO = tf.data.experimental.AUTOTUNE
+        shuffle=self.name!='test'
+        signature=(tf.TensorSpec((self.tile_dims,self.tile_dims,3),tf.uint8),
+                   tf.TensorSpec((self.tile_dims,self.tile_dims,1),tf.uint8))
+        shard=lambda s: tf.data.Dataset.from_generator(self._generator,
+                                                       args=(s,shuffle),
+                                                       output_signature=signature)
+        dataset = tf.data.Dataset.range(self.num_shards)
+        dataset = dataset.interleave(shard,
+                                     cycle_length=self.num_shards,
+                                     num_parallel_calls=AUTO,
+                                     deterministic=not shuffle)
+        dataset = dataset.map(lambda x, y: (tf.cast(x,tf.float16),tf.cast(y,tf.float16)), num_parallel_calls=AUTO)
+        if self.task_type=='multi':
+            dataset = dataset.map(lambda x, y: (x, tf.one_hot(tf.cast(y[:,:,0], tf.int32), depth=3, dtype=tf.float32)), num_parallel_calls=4)
+        dataset = dataset.batch(self.batch_size, drop_remainder=True)
+        if shuffle:
+            dataset = dataset.prefetch(AUTO)
+        self.dataset=dataset
+
+
+if  __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-dp', '--dbpath', required=True, help='path to lmdb database')
+    ap.add_argument('-td', '--tiledims', default=1024, help='tile dims')
+    args = vars(ap.parse_args())
+
+    loader=LMDBLoader(args['dbpath'],'test',int(args['tiledims']),'binary',1)
+    loader.record_size()
+    print('The number is: {}'.format(loader.tile_nums), flush=True)
@@ -72,7 +72,7 @@ class TFRecordLoader():
             #'dims': tf.io.FixedLenFeature((), tf.int64)
                }
         example = tf.io.parse_single_example(serialized, data)
-        image = tf.image.decode_png(example['image'])
+        image = tf.io.decode_image(example['image'], expand_animations=False)
         mask = tf.image.decode_png(example['mask'])
         #imgname = example['imageName']
  
@@ -93,7 +93,7 @@ class TFRecordLoader():
             'dims': tf.io.FixedLenFeature((), tf.int64)
                }
         example = tf.io.parse_single_example(serialized, data)
-        image = tf.image.decode_png(example['image'])
+        image = tf.io.decode_image(example['image'], expand_animations=False)
         mask = tf.image.decode_png(example['mask'])
         return image, example['imageName'], mask, example['maskName']
 
@@ -13,6 +13,9 @@ import numpy as np
 import staintools
 import tensorflow as tf
 
+from pyslide.io.archive_io import ArchiveRead
+from data.dedup import dedupFiles
+
 __author__= 'Gregory Verghese'
 __email__='gregory.verghese@gmail.com'
 
@@ -179,7 +182,7 @@ def doConversion(imgs, masks, shardNum, num, outPath, outDir):
     convert(shardImgs, shardMasks, os.path.join(outPath,outDir,str(i)+'.tfrecords'), dim=None)
 
 
-def getFiles(imagePath, maskPath, outPath, config, shardSize=0.1):
+def getFiles(imagePath, maskPath, outPath, config, shardSize=0.1, dedup=None):
     '''
     gets images paths and split into train, valid and test sets
     Args:
@@ -187,6 +190,8 @@ def getFiles(imagePath, maskPath, outPath, config, shardSize=0.1):
         maskPath: path to mask files
         outPath: path to save down files
         config: config file path containig names of test images
+        dedup: optional max hash distance for near duplicate
+            removal from the training set
     '''
     with open(config) as jsonFile:
         configFile = json.load(jsonFile)
@@ -216,6 +221,10 @@ def getFiles(imagePath, maskPath, outPath, config, shardSize=0.1):
     '''
     print('train:{}, valid: {}, test: {}'.format(len(trainImgs), len(validImgs), len(testImgs)))
     print('train:{}, valid: {}, test: {}'.format(len(trainMasks), len(validMasks), len(testMasks)))
+
+    if dedup is not None:
+        trainImgs, trainMasks, report = dedupFiles(trainImgs, trainMasks, dedup)
+        report.to_csv(os.path.join(outPath, 'train_dedup.csv'), index=False)
      
     trainShardNum, tNum = getShardNumber(trainImgs, trainMasks)
     doConversion(trainImgs, trainMasks, trainShardNum, tNum, outPath, 'train')
@@ -232,6 +241,147 @@ def getFiles(imagePath, maskPath, outPath, config, shardSize=0.1):
     print('Number of test shards: {}'.format(testShardNum))
     
 
+def pngHeight(data):
+    '''
+    image height from the png IHDR chunk without decoding
+    Args:
+        data: png bytes
+    Returns:
+        height
+    '''
+    return int.from_bytes(data[20:24], 'big')
+
+
+def jpegHeight(data):
+    '''
+    read image height from the jpeg start of frame marker
+    Args:
+        data: jpeg bytes
+    Returns:
+        height
+    '''
+    i = 2
+    while i < len(data):
+        marker, length = data[i+1], int.from_bytes(data[i+2:i+4], 'big')
+        if marker in (0xC0, 0xC1, 0xC2):
+            return int.from_bytes(data[i+5:i+7], 'big')
+        i += 2+length
+    raise ValueError('no jpeg frame header')
+
+
+def convertArchive(archive, names, tfRecordPath):
+    '''
+    serialize patches from a packed archive as a tfrecord file.
+    image png (or native jpeg) bytes are copied through without
+    re-encoding
+    Args:
+        archive: pyslide.io.archive_io.ArchiveRead
+        names: patch names
+        tfRecordPath: path to save tfrecords
+    '''
+    numImgs = len(names)
+    check=[]
+    with tf.io.TFRecordWriter(tfRecordPath) as writer:
+        for i, name in enumerate(names):
+            printProgress(i,numImgs)
+            if not archive.exists(name, 'mask'):
+                if DEBUG: print("mask does not exist")
+                check.append(name)
+                continue
+
+            image = archive.read_bytes(name, 'image')
+            mask = archive.read(name, 'mask')
+            if mask.ndim == 2:
+                mask = np.stack([mask]*3, axis=-1)
+            mask = tf.image.encode_png(mask)
+
+            data = {
+                'image': wrapBytes(image),
+                'mask': wrapBytes(mask),
+                'imageName': wrapBytes(name.encode('utf-8')),
+                'maskName': wrapBytes(name.encode('utf-8')),
+                'dims': wrapInt64(jpegHeight(image) if archive.codec(name) == 'jpeg' else pngHeight(image))
+                }
+
+            features = tf.train.Features(feature=data)
+            example = tf.train.Example(features=features)
+            serialized = example.SerializeToString()
+            writer.write(serialized)
+
+        print('Number of errors: {}'.format(len(check)))
+
+
+def getArchiveShardNumber(archive, names, shardSize=0.25, unit=10**9):
+    '''
+    calculate the number of shards from archive index lengths
+    Args:
+        archive: ArchiveRead
+        names: patch names
+        shardSize: memory size of each shard
+        unit: gb
+    Returns:
+        shardNum: number of shards
+        imgPerShard: number of images in each shard
+    '''
+    index = archive.index[archive.index['name'].isin(names)]
+    totalMem = index['length'].sum()/unit
+    print('Total memory: {}'.format(totalMem))
+    shardNum = max(1, int(np.ceil(totalMem/shardSize)))
+    imgPerShard = int(np.ceil(len(names)/shardNum))
+
+    return shardNum, imgPerShard
+
+
+def doArchiveConversion(archive, names, shardNum, num, outPath, outDir):
+    '''
+    split archive patches into shards for saving down
+    Args:
+        archive: ArchiveRead
+        names: patch names
+        shardNum: number of shards
+        num: number of images per shard
+        outPath: path to save files
+        outDir: directory to save files
+    '''
+    for i in range(0, shardNum):
+        shardNames = names[i*num:num*(i+1)]
+        convertArchive(archive, shardNames, os.path.join(outPath,outDir,str(i)+'.tfrecords'))
+
+
+def getArchiveFiles(archivePath, outPath, config):
+    '''
+    list patches from a packed archive index (no globbing) and
+    split into train, valid and test sets
+    Args:
+        archivePath: archive directory written by Patch.to_archive
+        outPath: path to save down files
+        config: config file path containig names of test images
+    '''
+    with open(config) as jsonFile:
+        configFile = json.load(jsonFile)
+
+    validFiles=configFile['validFiles']
+    testFiles = configFile['testFiles']
+    archive = ArchiveRead(archivePath)
+    names = archive.names('image')
+    print('Total images: {}'.format(len(names)))
+
+    trainNames = [n for n in names if not any([v for v in validFiles+testFiles if v in n])]
+    validNames = [n for n in names if any([v for v in validFiles if v in n])]
+    testNames = [n for n in names if any([v for v in testFiles if v in n])]
+    print('train:{}, valid: {}, test: {}'.format(len(trainNames), len(validNames), len(testNames)))
+
+    for outDir, split, shardSize in [('train', trainNames, 0.25),
+                                     ('validation', validNames, 0.1),
+                                     ('test', testNames, 0.1)]:
+        if len(split) == 0:
+            continue
+        shardNum, num = getArchiveShardNumber(archive, split, shardSize)
+        doArchiveConversion(archive, split, shardNum, num, outPath, outDir)
+        print('Number of {} shards: {}'.format(outDir, shardNum))
+    archive.close()
+
+
 def basicConvert(imagePath, maskPath, outPath, shardSize=0.1):
     '''
     gets images paths and convert to tfrecords without splitting into test, validate and train
@@ -275,18 +425,23 @@ def basicConvert(imagePath, maskPath, outPath, shardSize=0.1):
 if __name__ == '__main__':
 
     ap = argparse.ArgumentParser()
-    ap.add_argument('-fp', '--filepath', required=True, help='path to images')
-    ap.add_argument('-mp', '--maskpath', required=True, help='path to mask')
+    ap.add_argument('-fp', '--filepath', help='path to images')
+    ap.add_argument('-mp', '--maskpath', help='path to mask')
+    ap.add_argument('-ap', '--archivepath', help='packed patch archive (replaces filepath/maskpath)')
     ap.add_argument('-op', '--outpath', required=True, help='path for tfRecords to be wrriten to')
     ap.add_argument('-cf', '--configfile', help='path to config file')
+    ap.add_argument('-dd', '--dedup', default=None, help='max hash distance for near duplicate removal')
     args = vars(ap.parse_args())
     os.makedirs(os.path.join(args['outpath'],'train'),exist_ok=True)
     os.makedirs(os.path.join(args['outpath'],'test'),exist_ok=True)
     os.makedirs(os.path.join(args['outpath'],'validation'),exist_ok=True)
 
     #getFiles(args['filepath'], args['maskpath'], args['outpath'], args['configfile'])
-    if(args['configfile']):
-        getFiles(args['filepath'], args['maskpath'], args['outpath'], args['configfile'])
+    if(args['archivepath']):
+        getArchiveFiles(args['archivepath'], args['outpath'], args['configfile'])
+    elif(args['configfile']):
+        dedup = int(args['dedup']) if args['dedup'] is not None else None
+        getFiles(args['filepath'], args['maskpath'], args['outpath'], args['configfile'], dedup=dedup)
     else:
         basicConvert(args['filepath'], args['maskpath'], args['outpath'])
 
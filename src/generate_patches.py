@@ -17,6 +17,7 @@ import matplotlib.pyplot as plt
 
 from pyslide.slide import Annotations,Slide
 from pyslide.patching import Patch
+from pyslide.io.manifest import Manifest
 #from utilities import mask2rgb
 from pyslide.util.utilities import detect_tissue_section
 from pyslide.util.utilities import match_annotations_to_tissue_contour
@@ -38,7 +39,7 @@ TISSUE_MASK_PATH='/SAN/colcc/WSI_LymphNodes_BreastCancer/HollyR/data/tissue_mask
 
 TESTIMS = True
 
-def patch_slides(wsi_path, ann_path,tissue_mask_path, save_path, classes=[],wsi_mask=True, wsi_mask_path="", filter_path=""):
+def patch_slides(wsi_path, ann_path,tissue_mask_path, save_path, classes=[],wsi_mask=True, wsi_mask_path="", filter_path="", names=None):
     print("in patch_images")
     draw_contours=False
     wsi_paths=glob.glob(os.path.join(wsi_path,'*.ndpi'))
@@ -49,15 +50,17 @@ def patch_slides(wsi_path, ann_path,tissue_mask_path, save_path, classes=[],wsi_
     filtered=[os.path.basename(f)[:-4] for f in filtered]
     #print(len(filtered))
     
-    #presumably this is so that we can skip ones we have already done?
-    saved=glob.glob(os.path.join(save_path,'*'))
-    saved=[os.path.basename(s) for s in saved]
-    print("saved: ",saved)    
     for curr_path in wsi_paths:
         #remove ".ndpi" extension
         name=os.path.basename(curr_path)[:-5]
+        #restrict to a subset of slides (run_queue.py runs one per job)
+        if names is not None and name not in names:
+            continue
 
-        if name in saved:
+        #skip slides whose manifest has the complete marker. partially
+        #saved slides resume from the first missing patch in Patch.save,
+        #which seeds a missing manifest from the pngs already on disk
+        if Manifest.is_complete(os.path.join(save_path,name,'manifest.txt')):
             print('skipping: ',name)
             continue
         print('slide',name)
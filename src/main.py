@@ -37,6 +37,7 @@ from models import fcn8,unet,mobile,resunet,resunet_a,unet_mini,atten_unet
 from models import multiscale,multi_atten,deeplabv3
 from models import deeplabv3
 from data.tfrecord_read import TFRecordLoader
+from data.lmdb_read import LMDBLoader
 #from utilities import decay_schedules
 from utilities.evaluation import diceCoef
 from predict import test_predictions
@@ -102,18 +103,27 @@ def get_gpu_memory_usage():
 
 def data_loader(path,config):
     
-    #load training files
-    train_path = os.path.join(path,'train','*.tfrecords')
-    train_files = glob.glob(train_path)
-    if DEBUG: print(len(train_files))
-    #train_files = train_files[:20]
-    #print(len(train_files))
-
-    train_loader=TFRecordLoader(train_files,
+    #load training files. config data_format: tfrecords (default) or lmdb
+    #lmdb expects path/train and path/validation databases from Patch.to_lmdb
+    data_format=config.get('data_format','tfrecords')
+    if data_format=='lmdb':
+        train_loader=LMDBLoader(os.path.join(path,'train'),
                                 'train',
                                 config['image_dims'],
                                 config['task_type'],
                                 config['batch_size'])
+    else:
+        train_path = os.path.join(path,'train','*.tfrecords')
+        train_files = glob.glob(train_path)
+        if DEBUG: print(len(train_files))
+        #train_files = train_files[:20]
+        #print(len(train_files))
+
+        train_loader=TFRecordLoader(train_files,
+                                    'train',
+                                    config['image_dims'],
+                                    config['task_type'],
+                                    config['batch_size'])
 
     ##HOLLY: this might be an error as not assigned to anything
     train_loader.record_size()
@@ -132,16 +142,23 @@ def data_loader(path,config):
     train_loader.normalize(norm_methods,norm_parameters)
     
     #load validation files
-    valid_path = os.path.join(path,'validation','*.tfrecords')
-    valid_files = glob.glob(valid_path)
-    print(valid_path)
-    print(len(valid_files))
-    valid_loader=TFRecordLoader(valid_files,
-                               'test',
-                               config['image_dims'],
-                               config['task_type'],
-                               config['batch_size']
-                               )
+    if data_format=='lmdb':
+        valid_loader=LMDBLoader(os.path.join(path,'validation'),
+                                'test',
+                                config['image_dims'],
+                                config['task_type'],
+                                config['batch_size'])
+    else:
+        valid_path = os.path.join(path,'validation','*.tfrecords')
+        valid_files = glob.glob(valid_path)
+        print(valid_path)
+        print(len(valid_files))
+        valid_loader=TFRecordLoader(valid_files,
+                                   'test',
+                                   config['image_dims'],
+                                   config['task_type'],
+                                   config['batch_size']
+                                   )
 
     valid_loader.record_size()
     print(f'tiles: n={valid_loader.tile_nums}; steps:n={valid_loader.steps}')
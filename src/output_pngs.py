@@ -35,7 +35,7 @@ WSI_PATH='/SAN/colcc/WSI_LymphNodes_BreastCancer/HollyR/data/wsi/test'
 ANNOTATIONS_PATH='/SAN/colcc/WSI_LymphNodes_BreastCancer/HollyR/data/annotations'
 
 
-def create_pngs(wsi_path, ann_path, save_path, wsi_mask_path):
+def create_pngs(wsi_path, ann_path, save_path, wsi_mask_path, names=None):
     print("in create_pngs")
     wsi_paths=glob.glob(os.path.join(wsi_path,'*.ndpi'))
     annotations_paths=glob.glob(os.path.join(ann_path,'*'))
@@ -45,6 +45,8 @@ def create_pngs(wsi_path, ann_path, save_path, wsi_mask_path):
     for curr_path in wsi_paths:
         #remove ".ndpi" extension
         name=os.path.basename(curr_path)[:-5]
+        if names is not None and name not in names:
+            continue
         print(name)
 
         #get the paths for all the annotations that match the name of the image
@@ -0,0 +1,369 @@
+"""
+plan_jobs.py: dry-run cost planner for patching and prediction jobs
+
+Estimates, per slide, the number of grid cells (before and after tissue
+pruning), read volume per pyramid level, output bytes per codec, peak
+memory per stage and runtime, without decoding any patch pixels. Only
+the slide header, the low resolution thumbnail level and the tiff tile
+byte counts are read. Runtime and codec sizes come from a calibration
+json written by the calibrate sub-command, which times a small sample
+of real patches once per scanner/protocol.
+
+Slides are then packed longest first into jobs that fit the scheduler
+h_rt limit, with suggested -l h_rt/tmem values for the qsub scripts in
+bash/.
+
+    python plan_jobs.py calibrate -wp slide.ndpi -cp calibration.json
+    python plan_jobs.py patch -wp wsi_dir -cp calibration.json -op plan.csv
+    python plan_jobs.py predict -ip images_dir -cp calibration.json
+"""
+
+import os
+import glob
+import json
+import math
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+from pyslide.slide import Slide, Annotations
+from pyslide.patching import Patch
+from pyslide.io.archive_io import encode_png
+
+#used until a calibration file is written
+DEFAULT_CALIBRATION={'read_s':0.05,
+                     'mask_s':0.0,
+                     'encode_s':{'raw':0.0,'png':0.03,'jpeg':0.0},
+                     'ratio':{'raw':1.0,'png':0.5},
+                     'tiles_per_s':2.0}
+
+MB=2**20
+
+
+def level_bytes(path,dims):
+    """
+    compressed bytes stored for the tiff page matching dims
+    :param path: slide path
+    :param dims: (w,h) of level
+    :return bytes or None if not readable by tifffile
+    """
+    try:
+        with tifffile.TiffFile(path) as tif:
+            for page in tif.pages:
+                if (page.imagewidth,page.imagelength)==tuple(dims):
+                    return int(sum(page.databytecounts))
+    except Exception:
+        return None
+    return None
+
+
+def tissue_cells(patch,min_tissue):
+    """
+    count grid cells with tissue fraction at least min_tissue
+    using the thumbnail tissue map only
+    :param patch: Patch with generated patches
+    :param min_tissue: min tissue fraction
+    :return number of cells
+    """
+    tissue,_,ds=patch._thumbnail_maps()
+    w=max(1,int(patch.size[0]*patch._downsample/ds))
+    h=max(1,int(patch.size[1]*patch._downsample/ds))
+    num=0
+    for p in patch.patches:
+        tx,ty=int(p['x']/ds),int(p['y']/ds)
+        cell=tissue[ty:ty+h,tx:tx+w]
+        if cell.size and cell.mean()>=min_tissue:
+            num+=1
+    return num
+
+
+def slide_annotations(ann_path,slide_path,labels):
+    """
+    qupath annotations of a slide, matched on name as in
+    generate_patches.patch_slides
+    :param ann_path: annotations directory
+    :param slide_path: slide path
+    :param labels: annotation classes
+    :return Annotations or None
+    """
+    if ann_path is None:
+        return None
+    name=os.path.basename(slide_path)[:-5]
+    paths=[a for a in glob.glob(os.path.join(ann_path,'*')) if name in a]
+    if not paths:
+        return None
+    return Annotations(paths,source='qupath',labels=labels)
+
+
+def plan_slide(slide_path,size,step,mag_level,calibration,
+               min_tissue=0.1,prune=False,mask_flag=True,workers=0,border=None,
+               annotations=None):
+    """
+    cost estimate for patching one slide
+    :param slide_path: slide path
+    :param size: patch (w,h) at mag_level
+    :param step: patch step at mag_level
+    :param mag_level: pyramid level patches are read from
+    :param calibration: calibration dict
+    :param min_tissue: tissue fraction for pruning
+    :param prune: cost only tissue cells (else the full grid)
+    :param mask_flag: patches written with masks
+    :param workers: extraction worker processes (slot pool)
+    :param border: optional [[xmin,xmax],[ymin,ymax]]
+    :param annotations: slide Annotations, masks are only costed
+        with annotations
+    :return dict of estimates
+    """
+    slide=Slide(slide_path,annotations=annotations)
+    w,h=slide.dims
+    border=[[0,w],[0,h]] if border is None else border
+    patch=Patch(slide,size,mag_level=mag_level,border=border)
+    cells=patch.generate_patches(step)
+    kept=tissue_cells(patch,min_tissue)
+    num=kept if prune else cells
+    pw,ph=size
+
+    level_dims=slide.level_dimensions[mag_level]
+    stored=level_bytes(slide_path,level_dims)
+    #area of the level covered by the patches, overlap counted
+    fraction=min(1.0,num*pw*ph/float(level_dims[0]*level_dims[1]))
+    read_compressed=stored*fraction if stored is not None else float('nan')
+    read_decoded=num*pw*ph*4
+
+    ratio=calibration['ratio']
+    image_bytes=num*pw*ph*3
+    mask_bytes=num*pw*ph if mask_flag else 0
+    outputs={f'out_{codec}_mb':(image_bytes*r+mask_bytes*ratio.get('png',1.0))/MB
+             for codec, r in ratio.items()}
+    if stored is not None:
+        outputs['out_jpeg_mb']=(read_compressed+mask_bytes*ratio.get('png',1.0))/MB
+
+    #peak memory: RGBA read + RGB copy per patch in flight, slot
+    #pool, and the level 0 slide mask extract_mask builds per call
+    extract_mem=pw*ph*7*max(1,workers)+(2*workers*pw*ph*3 if workers else 0)
+    mask_mem=w*h if mask_flag and slide.annotations is not None else 0
+    thumb_level=slide.get_best_level_for_downsample(32)
+    tw,th=slide.level_dimensions[thumb_level]
+    thumb_mem=tw*th*4
+
+    per_patch=calibration['read_s']+calibration['mask_s']*(mask_mem>0)
+    runtime=num*per_patch/max(1,workers)
+    encode_s=calibration['encode_s']
+    row={'name':slide.name,
+         'path':slide_path,
+         'cells':cells,
+         'tissue_cells':kept,
+         'level':mag_level,
+         'read_level_mb':read_compressed/MB,
+         'read_decoded_mb':read_decoded/MB,
+         'thumb_level':thumb_level,
+         'read_thumb_mb':tw*th*4/MB,
+         'mem_extract_mb':extract_mem/MB,
+         'mem_mask_mb':mask_mem/MB,
+         'mem_thumb_mb':thumb_mem/MB,
+         'mem_peak_mb':max(extract_mem,mask_mem,thumb_mem)/MB}
+    row.update(outputs)
+    for codec, s in encode_s.items():
+        row[f'runtime_{codec}_s']=runtime+num*s/max(1,workers)
+    slide.close()
+    return row
+
+
+def png_dims(path):
+    """
+    png (w,h) from the IHDR chunk without decoding
+    """
+    with open(path,'rb') as f:
+        header=f.read(24)
+    return int.from_bytes(header[16:20],'big'), int.from_bytes(header[20:24],'big')
+
+
+def plan_prediction(image_path,tile_dim,step,calibration,batch_size=8,
+                    views=1,readers=2,writers=2,probability=False):
+    """
+    cost estimate for sliding window prediction on one image
+    (predict.test_predictions)
+    :param image_path: png image path
+    :param tile_dim: tile dims
+    :param step: sliding window step
+    :param calibration: calibration dict
+    :param batch_size: tiles per inference batch
+    :param views: test time augmentation views per tile
+    :param readers: reader threads
+    :param writers: writer threads
+    :param probability: float32 probability canvases
+    :return dict of estimates
+    """
+    w,h=png_dims(image_path)
+    tiles=len(range(0,w-step,step))*len(range(0,h-step,step))
+    image=w*h*3
+    mask=w*h*3
+    canvas=w*h*(4 if probability else 1)
+    #images and masks loaded ahead by the readers, plus the one
+    #being tiled
+    loaded=(readers+2)*(image+mask)
+    #uint8 batch, its float32 normalized copy and the tta views
+    #with their outputs; batches span at most two open canvases
+    batch=batch_size*tile_dim*tile_dim*(3+3*4+views*(3*4+4))
+    #up to writers+1 finished predictions and masks in the writer
+    #pool, each with a thresholded/scaled working copy
+    writes=(writers+1)*(canvas+mask+w*h*3)
+    mem=loaded+batch+2*canvas+writes
+    return {'name':os.path.basename(image_path)[:-4],
+            'path':image_path,
+            'tiles':tiles,
+            'mem_batch_mb':batch/MB,
+            'mem_writers_mb':writes/MB,
+            'mem_peak_mb':mem/MB,
+            'runtime_s':tiles*views/calibration['tiles_per_s']}
+
+
+def split_jobs(costs,limit_s,safety=1.5):
+    """
+    pack slides into jobs longest first so each job finishes
+    inside the scheduler limit
+    :param costs: list of runtime estimates (s)
+    :param limit_s: h_rt limit in seconds
+    :param safety: runtime multiplier
+    :return job index per slide
+    """
+    order=np.argsort(costs)[::-1]
+    jobs=[]
+    assignment=[0]*len(costs)
+    for i in order:
+        cost=costs[i]*safety
+        fits=[j for j, load in enumerate(jobs) if load+cost<=limit_s]
+        if fits:
+            j=min(fits,key=lambda k: jobs[k])
+        else:
+            jobs.append(0.0)
+            j=len(jobs)-1
+        jobs[j]+=cost
+        assignment[i]=j
+    return assignment
+
+
+def calibrate(slide_path,size,mag_level,num=32,border=None,annotations=None):
+    """
+    time reading and encoding a sample of real patches, and mask
+    extraction when the slide has annotations
+    :param slide_path: slide path
+    :param size: patch (w,h)
+    :param mag_level: pyramid level
+    :param num: number of sample patches
+    :param annotations: optional slide Annotations
+    :return calibration dict
+    """
+    slide=Slide(slide_path,annotations=annotations)
+    w,h=slide.dims
+    border=[[0,w],[0,h]] if border is None else border
+    patch=Patch(slide,size,mag_level=mag_level,border=border)
+    patch.generate_patches(size[0])
+    sample=patch.patches[::max(1,len(patch.patches)//num)][:num]
+
+    start=time.perf_counter()
+    images=[patch.extract_patch(p['x'],p['y']) for p in sample]
+    read_s=(time.perf_counter()-start)/len(sample)
+
+    start=time.perf_counter()
+    encoded=[encode_png(image) for image in images]
+    png_s=(time.perf_counter()-start)/len(sample)
+    png_ratio=sum(len(e) for e in encoded)/float(sum(i.nbytes for i in images))
+
+    calibration=dict(DEFAULT_CALIBRATION)
+    if annotations is not None:
+        #every extract_mask call draws the level 0 mask, so a few
+        #patches are enough
+        masks=sample[:4]
+        start=time.perf_counter()
+        for p in masks:
+            patch.extract_mask(p['x'],p['y'])
+        calibration['mask_s']=(time.perf_counter()-start)/len(masks)
+    calibration.update({'read_s':read_s,
+                        'encode_s':{'raw':0.0,'png':png_s,'jpeg':0.0},
+                        'ratio':{'raw':1.0,'png':png_ratio},
+                        'slide':os.path.basename(slide_path),
+                        'size':list(size),
+                        'mag_level':mag_level})
+    slide.close()
+    return calibration
+
+
+def hrt(seconds):
+    seconds=int(math.ceil(seconds))
+    return f'{seconds//3600:d}:{seconds%3600//60:02d}:{seconds%60:02d}'
+
+
+def summarise(df,runtime_col,limit_s,safety):
+    df['job']=split_jobs(list(df[runtime_col]),limit_s,safety)
+    jobs=df.groupby('job').agg(slides=('name','count'),
+                               runtime_s=(runtime_col,'sum'),
+                               mem_peak_mb=('mem_peak_mb','max'))
+    jobs['h_rt']=[hrt(min(limit_s,r*safety)) for r in jobs['runtime_s']]
+    jobs['tmem']=[f'{int(math.ceil(m*safety/1024))}G' for m in jobs['mem_peak_mb']]
+    print(df.drop(columns=['path']).to_string())
+    print(jobs.to_string())
+    return df, jobs
+
+
+if __name__=='__main__':
+    ap=argparse.ArgumentParser(description='dry-run cost planner')
+    ap.add_argument('mode',choices=['calibrate','patch','predict'])
+    ap.add_argument('-wp','--wsi_path',help='slide or directory of slides')
+    ap.add_argument('-ip','--image_path',help='directory of test pngs (predict)')
+    ap.add_argument('-ap','--ann_path',default=None,help='annotations directory (mask costs)')
+    ap.add_argument('-lb','--labels',nargs='+',default=['GC','sinus'],help='annotation classes')
+    ap.add_argument('-ext','--extension',default='ndpi',help='slide extension')
+    ap.add_argument('-cp','--calibration_path',default=None,help='calibration json')
+    ap.add_argument('-s','--size',default=1024,help='patch/tile size')
+    ap.add_argument('-st','--step',default=512,help='step')
+    ap.add_argument('-ml','--mag_level',default=2,help='magnification level')
+    ap.add_argument('-mt','--min_tissue',default=0.1,help='tissue fraction for pruning')
+    ap.add_argument('-pr','--prune',action='store_true',help='cost only tissue cells')
+    ap.add_argument('-c','--codec',default='png',help='output codec for runtime')
+    ap.add_argument('-w','--workers',default=0,help='extraction worker processes')
+    ap.add_argument('-hr','--h_rt',default=72,help='scheduler limit in hours')
+    ap.add_argument('-sf','--safety',default=1.5,help='runtime and memory multiplier')
+    ap.add_argument('-bs','--batch_size',default=8,help='tiles per inference batch (predict)')
+    ap.add_argument('-ta','--tta',nargs='+',default=None,help='test time augmentation views (predict)')
+    ap.add_argument('-nr','--readers',default=2,help='reader threads (predict)')
+    ap.add_argument('-nw','--writers',default=2,help='writer threads (predict)')
+    ap.add_argument('-pb','--probability',action='store_true',help='probability maps saved (predict)')
+    ap.add_argument('-op','--save_path',default=None,help='csv of per slide estimates')
+    args=ap.parse_args()
+
+    size=(int(args.size),int(args.size))
+    if args.mode=='calibrate':
+        annotations=slide_annotations(args.ann_path,args.wsi_path,args.labels)
+        calibration=calibrate(args.wsi_path,size,int(args.mag_level),annotations=annotations)
+        print(calibration)
+        with open(args.calibration_path,'w') as f:
+            json.dump(calibration,f,indent=2)
+    else:
+        calibration=DEFAULT_CALIBRATION
+        if args.calibration_path is not None:
+            with open(args.calibration_path) as f:
+                calibration=json.load(f)
+        limit_s=float(args.h_rt)*3600
+        if args.mode=='patch':
+            paths=[args.wsi_path]
+            if os.path.isdir(args.wsi_path):
+                paths=sorted(glob.glob(os.path.join(args.wsi_path,'*.'+args.extension)))
+            rows=[plan_slide(p,size,int(args.step),int(args.mag_level),calibration,
+                             float(args.min_tissue),args.prune,True,int(args.workers),
+                             annotations=slide_annotations(args.ann_path,p,args.labels))
+                  for p in paths]
+            runtime_col=f'runtime_{args.codec}_s'
+        else:
+            paths=sorted(glob.glob(os.path.join(args.image_path,'*.png')))
+            views=1 if args.tta is None else 8 if args.tta==['all'] else len(args.tta)
+            rows=[plan_prediction(p,int(args.size),int(args.step),calibration,int(args.batch_size),
+                                  views,int(args.readers),int(args.writers),args.probability)
+                  for p in paths]
+            runtime_col='runtime_s'
+        df,jobs=summarise(pd.DataFrame(rows),runtime_col,limit_s,float(args.safety))
+        if args.save_path is not None:
+            df.to_csv(args.save_path,index=False)
@@ -20,7 +20,7 @@ def getFiles(filesPath, ext):
     return filesLst
 
 
-def analyseNodes(wsiPath,maskPath,savePath):
+def analyseNodes(wsiPath,maskPath,savePath,names=None,outPath='/home/verghese/node_details_cancer_90552.csv'):
     cancerPts='/home/verghese/cancer-points-training'
     print(maskPath)
     print('analysing lymph nodes...',flush=True)
@@ -32,6 +32,8 @@ def analyseNodes(wsiPath,maskPath,savePath):
     all_ln_status=pd.read_csv('/home/verghese/ln_status_3.csv',index_col=['image_name'])
 
     totalMasks=[t for t in totalMasks if 'image' not in t]
+    if names is not None:
+        totalMasks=[t for t in totalMasks if os.path.basename(t)[:-4] in names]
     names=[]
     lnIdx=[]
     lnAreas=[]
@@ -262,7 +264,7 @@ def analyseNodes(wsiPath,maskPath,savePath):
     for k,v in stats.items():
         print(k, len(v))
         statsDf=pd.DataFrame(stats)
-    statsDf.to_csv('/home/verghese/node_details_cancer_90552.csv')
+    statsDf.to_csv(outPath)
 
 
 
@@ -5,7 +5,12 @@ predict.py: inference on LNs using trained model
 
 import os
 import glob
+import time
+import json
 import argparse
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import cv2
 import numpy as np
@@ -18,12 +23,44 @@ import torch.nn as nn
 from torchvision import transforms as T
 
 from networks.unet_multi import UNet_multi 
-from utilities.evaluation import diceCoef
+from utilities.evaluation import diceCoef, probabilityHistograms, thresholdSweep
 from utilities.augmentation import Augment, Normalize
-from stitching import Canvas, stitch
+from stitching import Canvas, BlendCanvas, stitch
+from tile_cache import TileCache, model_hash
+from pyslide.slide import Slide
+from pyslide.io.pyramid_io import DeepZoomWrite, write_tiff, write_probability_pyramid, ProbabilityPyramid
+from pyslide.util.utilities import curve_order
 
 DEBUG = True
 
+#test time augmentation views (transform, inverse) on NHWC batches
+TTA_TRANSFORMS={
+    'identity':(lambda x: x, lambda x: x),
+    'fliplr':(lambda x: tf.reverse(x,[2]), lambda x: tf.reverse(x,[2])),
+    'flipud':(lambda x: tf.reverse(x,[1]), lambda x: tf.reverse(x,[1])),
+    'rot90':(lambda x: tf.image.rot90(x,1), lambda x: tf.image.rot90(x,3)),
+    'rot180':(lambda x: tf.image.rot90(x,2), lambda x: tf.image.rot90(x,2)),
+    'rot270':(lambda x: tf.image.rot90(x,3), lambda x: tf.image.rot90(x,1)),
+    'transpose':(lambda x: tf.transpose(x,[0,2,1,3]), lambda x: tf.transpose(x,[0,2,1,3])),
+    'transverse':(lambda x: tf.image.rot90(tf.transpose(x,[0,2,1,3]),2),
+                  lambda x: tf.transpose(tf.image.rot90(x,2),[0,2,1,3]))
+}
+
+def prefetch(function, items, workers=2, depth=4):
+    """
+    map function over items on worker threads with at most depth
+    results in flight, yielding results in order
+    """
+    with ThreadPoolExecutor(workers) as pool:
+        pending=deque()
+        for item in items:
+            pending.append(pool.submit(function,item))
+            if len(pending)>=depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def dice_coef(y_true,y_pred,idx=[0,2,3],smooth=1):
         y_true=y_true.type(torch.float32)
         y_pred=y_pred.type(torch.float32)
@@ -41,7 +78,14 @@ class Predict():
                  step, 
                  normalize=[], 
                  channel_means=[],
-                 channel_std=[]):
+                 channel_std=[],
+                 order='row',
+                 batch_size=8,
+                 blend=None,
+                 probability=False,
+                 cache=None,
+                 tta=None,
+                 readers=2):
 
         self.model=model
         self.threshold=threshold
@@ -50,28 +94,92 @@ class Predict():
         self.normalize=normalize
         self.channel_means=[float(m) for m in channel_means]
         self.channel_std=[float(s) for s in channel_std]
+        self.order=order
+        self.batch_size=batch_size
+        self.blend=blend
+        self.probability=probability
+        self.cache=cache
+        self.tta=self._tta_views(tta)
+        self.readers=readers
+        self.tiles=0
+        self.elapsed=0.0
+        if cache is not None:
+            config={'tile_dim':tile_dim,'normalize':list(normalize),
+                    'channel_means':self.channel_means,'channel_std':self.channel_std,
+                    'tta':self.tta}
+            self._cache_prefix=TileCache.key(model_hash(model),json.dumps(config,sort_keys=True))
+        #one trace for every batch: the last batch is zero padded.
+        #tiles go in as raw uint8 and are normalized in the graph
+        spec=tf.TensorSpec([batch_size,tile_dim,tile_dim,3],tf.uint8)
+        self._norm=Normalize(self.channel_means,self.channel_std)
+        self._infer=tf.function(self._forward,input_signature=[spec])
+
+
+    @staticmethod
+    def _tta_views(tta):
+        if tta is None:
+            return None
+        views=list(TTA_TRANSFORMS) if tta=='all' or list(tta)==['all'] else list(tta)
+        unknown=[v for v in views if v not in TTA_TRANSFORMS]
+        if unknown:
+            raise ValueError(f'unknown tta transforms {unknown}')
+        return views
+
+
+    def _forward(self, tiles):
+        tiles=self._normalize(tf.cast(tiles,tf.float32))
+        if self.tta is None:
+            logits=self.model(tiles,training=False)
+        else:
+            #all views of the batch in one call, inverted and averaged
+            views=tf.concat([TTA_TRANSFORMS[v][0](tiles) for v in self.tta],axis=0)
+            outputs=tf.split(self.model(views,training=False),len(self.tta),axis=0)
+            logits=tf.add_n([TTA_TRANSFORMS[v][1](o) for v, o in zip(self.tta,outputs)])/len(self.tta)
+        #blending thresholds once after tiles are averaged and
+        #cached outputs are kept unthresholded
+        if self.blend is not None or self.probability or self.cache is not None:
+            return tf.cast(logits, tf.float32)
+        return tf.cast((logits>self.threshold), tf.float32)
+
+
+    def _canvas(self, y_dim, x_dim, path=None):
+        if self.blend is not None:
+            return BlendCanvas(y_dim,x_dim,self.tile_dim,self.blend,path=path)
+        return Canvas(y_dim,x_dim,path,np.float32 if self.probability else np.uint8)
+
+
+    def _finish(self, canvas):
+        #probability maps are returned unthresholded
+        if self.blend is not None and self.probability:
+            return canvas.probabilities()
+        elif self.blend is not None:
+            return canvas.threshold(self.threshold)
+        return canvas.canvas
+
+
+    @property
+    def tiles_per_second(self):
+        return self.tiles/self.elapsed if self.elapsed else 0.0
 
 
     def _patching(self, x_dim, y_dim):
-        for x in range(0, x_dim-self.step, self.step):
-            for y in range(0, y_dim-self.step, self.step):
-                x_new = x_dim-self.tile_dim if x+self.tile_dim>x_dim else x
-                y_new = y_dim-self.tile_dim if y+self.tile_dim>y_dim else y
-                yield x_new, y_new
-
-
-    def _normalize(self, image, mask):
-   
-        norm=Normalize(self.channel_means, self.channel_std)
-        data=[(image,mask)]
-        print(self.normalize)
+        #tiles visited in self.order (row, morton or hilbert)
+        cells=[(i,j) for i in range(len(range(0, x_dim-self.step, self.step)))
+                     for j in range(len(range(0, y_dim-self.step, self.step)))]
+        for k in curve_order(cells,self.order):
+            x, y = cells[k][0]*self.step, cells[k][1]*self.step
+            x_new = x_dim-self.tile_dim if x+self.tile_dim>x_dim else x
+            y_new = y_dim-self.tile_dim if y+self.tile_dim>y_dim else y
+            yield x_new, y_new
+
+
+    def _normalize(self, tiles):
+        #float32 normalization of a batch of tiles inside the traced
+        #graph, so memory scales with the batch rather than the image
+        #(StandardizeImage standardizes each tile)
         for method in self.normalize:
-            #print(str(method))
-            f=lambda x: getattr(norm,'get'+method)(x[0],x[1])
-            data=list(map(f, data))
-        image,mask=data[0][0],data[0][1]
-
-        return image,mask
+            tiles,_=getattr(self._norm,'get'+method)(tiles,None)
+        return tiles
 
     
     def get_transform(self,img):
@@ -84,22 +192,213 @@ class Predict():
         return img
 
 
-    def _predict(self, image):
+    def _place(self, canvases, key, x, y, prediction, margin):
+        #add one tile output (t,t,C) to its canvas, return the
+        #finished canvas after the image's last tile
+        c=canvases[key]
+        if self.cache is not None and self.blend is None and not self.probability:
+            prediction=(prediction>self.threshold).astype(np.float32)
+        if self.blend is not None:
+            c[0].add(prediction[:,:,0],y,x)
+        else:
+            #stitch takes (row,col) offsets and (cols,rows) dims
+            stitch(c[0], prediction[None], y, x, c[3], c[2], self.tile_dim, self.step, margin)
+        c[1]-=1
+        if c[1]==0:
+            del canvases[key]
+            return self._finish(c[0])
+        return None
+
+
+    def _flush(self, batch, meta, canvases, margin):
+        #run one batch and scatter each tile into its image canvas
+        n=len(batch)
+        tiles=np.zeros((self.batch_size,self.tile_dim,self.tile_dim,3),np.uint8)
+        tiles[:n]=np.stack(batch)
+        start=time.perf_counter()
+        predictions=np.asarray(self._infer(tiles))
+        self.elapsed+=time.perf_counter()-start
+        self.tiles+=n
+        for k, (key,x,y,cache_key) in enumerate(meta):
+            if cache_key is not None:
+                self.cache.put(cache_key,predictions[k])
+            canvas=self._place(canvases,key,x,y,predictions[k],margin)
+            if canvas is not None:
+                yield key, canvas
+
+
+    def _predict_tiles(self, tiles, canvases):
+        """
+        batch tiles and stitch predictions into canvases. With a
+        cache, tiles already predicted by this model skip inference
+        :param tiles: iterable of (key,x,y,tile,tile_id). tile is a
+            raw uint8 array or a function reading it (only called when needed),
+            None for an image without tiles. tile_id identifies the
+            tile for the cache instead of hashing its pixels
+        :param canvases: dict key: [Canvas,tiles left,y_dim,x_dim]
+        :yield key, canvas once all tiles of an image are done
+        """
         margin=int((self.tile_dim-self.step)/2)
-        y_dim, x_dim, _ = image.shape
-        c=Canvas(y_dim,x_dim)
+        batch,meta=[],[]
+        for key, x, y, tile, tile_id in tiles:
+            if tile is None:
+                yield key, self._finish(canvases.pop(key)[0])
+                continue
+            cache_key=None
+            if self.cache is not None:
+                if tile_id is None:
+                    tile=tile() if callable(tile) else tile
+                    tile_id=np.asarray(tile,np.uint8)
+                cache_key=self.cache.key(self._cache_prefix,tile_id)
+                cached=self.cache.get(cache_key)
+                if cached is not None:
+                    canvas=self._place(canvases,key,x,y,cached.astype(np.float32),margin)
+                    if canvas is not None:
+                        yield key, canvas
+                    continue
+            batch.append(tile() if callable(tile) else tile)
+            meta.append((key,x,y,cache_key))
+            if len(batch)==self.batch_size:
+                yield from self._flush(batch,meta,canvases,margin)
+                batch,meta=[],[]
+        if batch:
+            yield from self._flush(batch,meta,canvases,margin)
+
+
+    def predict_stream(self, images):
+        """
+        batched sliding window prediction over a stream of images.
+        Batches are filled across image boundaries
+        :param images: iterable of (key, image), uint8 (h,w,3)
+        :yield key, prediction once all tiles of an image are done
+        """
+        canvases={}
+        def tiles():
+            for key, image in images:
+                y_dim, x_dim, _ = image.shape
+                coords=list(self._patching(x_dim,y_dim))
+                canvases[key]=[self._canvas(y_dim,x_dim),len(coords),y_dim,x_dim]
+                if not coords:
+                    yield key, None, None, None, None
+                for x, y in coords:
+                    yield key, x, y, image[y:y+self.tile_dim,x:x+self.tile_dim,:], None
+        yield from self._predict_tiles(tiles(),canvases)
+
+
+    @staticmethod
+    def _tissue_map(slide, tissue_mask=None, roi=None, downsample=32):
+        """
+        low resolution map of where tiles are predicted
+        :param slide: Slide
+        :param tissue_mask: None (otsu on saturation of the thumbnail),
+            False (everywhere), or mask ndarray/path at any scale
+        :param roi: optional list of polygons [(x,y),...] at level 0
+        :return keep: bool ndarray
+        :return ds: level 0 pixels per map pixel
+        """
+        level=slide.get_best_level_for_downsample(downsample)
+        ds=slide.level_downsamples[level]
+        w,h=slide.level_dimensions[level]
+        if tissue_mask is False:
+            keep=np.ones((h,w),np.uint8)
+        elif tissue_mask is None:
+            thumb=np.array(slide.read_region((0,0),level,(w,h)).convert('RGB'))
+            sat=cv2.cvtColor(thumb,cv2.COLOR_RGB2HSV)[:,:,1]
+            _,keep=cv2.threshold(sat,0,255,cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+        else:
+            if isinstance(tissue_mask,str):
+                tissue_mask=cv2.imread(tissue_mask,cv2.IMREAD_GRAYSCALE)
+            tissue_mask=np.asarray(tissue_mask).astype(np.uint8)
+            keep=cv2.resize(tissue_mask,(w,h),interpolation=cv2.INTER_NEAREST)
+        keep=keep>0
+        if roi is not None:
+            roi_mask=np.zeros((h,w),np.uint8)
+            cv2.fillPoly(roi_mask,[np.int32(np.array(p)/ds) for p in roi],1)
+            keep&=roi_mask>0
+        return keep, ds
+
+
+    def predict_slide(self,
+                      slide_path,
+                      level,
+                      save_path,
+                      tissue_mask=None,
+                      roi=None,
+                      name=None,
+                      min_tissue=0.0,
+                      pyramid=None):
+        """
+        sliding window prediction streamed from a slide at level,
+        without exporting the region as png first. Tiles without
+        tissue or outside the roi are skipped and predictions are
+        written into a .npy memmap canvas as batches finish, so
+        memory is bounded by the batch rather than the slide
+        :param slide_path: path to wsi
+        :param level: pyramid level tiles are read from
+        :param save_path: directory for {name}.npy (and pyramid)
+        :param tissue_mask: see _tissue_map
+        :param roi: optional list of polygons [(x,y),...] at level 0
+        :param name: output name (default slide name)
+        :param min_tissue: tiles with tissue fraction <= this are skipped
+        :param pyramid: also write a dzi or tiff pyramid, or prob for
+            a uint8 probability pyramid (needs self.probability)
+        :return canvas: np.memmap (1,h,w,1) 0/255, or float32
+            probabilities when self.probability
+        """
+        slide=Slide(slide_path)
+        name=slide.name if name is None else name
+        x_dim, y_dim = slide.level_dimensions[level]
+        d=slide.level_downsamples[level]
+        keep,ds=self._tissue_map(slide,tissue_mask,roi)
+        size=max(1,int(self.tile_dim*d/ds))
+        coords=[]
         for x, y in self._patching(x_dim,y_dim):
-            patch=image[y:y+self.tile_dim,x:x+self.tile_dim,:]
-            patch=np.expand_dims(patch,axis=0)
-            logits=self.model(patch)
-            #print("logits:",logits.shape)
-            prediction=tf.cast((logits>self.threshold), tf.float32)
-            #print("preds:",prediction.shape)
-            stitch(c, prediction, y, x, y_dim, x_dim, self.tile_dim, self.step, margin)
-            #plt.imshow(c.canvas[0,:,:,:])
-            #plt.show()
-   
-        return c.canvas.astype(np.uint8)
+            tx,ty=int(x*d/ds),int(y*d/ds)
+            cell=keep[ty:ty+size,tx:tx+size]
+            if cell.size and cell.mean()>min_tissue:
+                coords.append((x,y))
+        if DEBUG: print(f'{name}: {len(coords)} tiles with tissue')
+
+        c=self._canvas(y_dim,x_dim,os.path.join(save_path,name+'.npy'))
+        canvas=None
+        slide_id=f'{slide.name}:{os.path.getsize(slide_path)}:{level}'
+        def read(x, y):
+            tile=slide.read_region((int(x*d),int(y*d)),level,(self.tile_dim,self.tile_dim))
+            return np.array(tile.convert('RGB'))
+        def tiles():
+            #with a cache tiles are only read on a miss, otherwise
+            #reader threads prefetch while the model runs
+            if self.cache is not None:
+                for x, y in coords:
+                    yield name, x, y, functools.partial(read,x,y), f'{slide_id}:{x}:{y}'
+                return
+            tiles=prefetch(lambda c: read(*c),coords,self.readers,2*self.batch_size)
+            for (x, y), tile in zip(coords,tiles):
+                yield name, x, y, tile, None
+        for _, canvas in self._predict_tiles(tiles(),{name:[c,len(coords),y_dim,x_dim]}):
+            pass
+        slide.close()
+
+        if canvas is None:
+            canvas=self._finish(c)
+        if not self.probability:
+            for r in range(0,y_dim,4096):
+                canvas[0,r:r+4096]*=255
+        canvas.flush()
+        if pyramid=='dzi':
+            DeepZoomWrite(save_path,name).write(canvas)
+        elif pyramid=='tiff':
+            write_tiff(canvas,os.path.join(save_path,name+".tiff"))
+        elif pyramid=='prob':
+            metadata={'name':name,'level':level,'downsample':d,'threshold':self.threshold,
+                      'tile_dim':self.tile_dim,'step':self.step}
+            write_probability_pyramid(canvas,os.path.join(save_path,name+"_prob.tiff"),metadata=metadata)
+        return canvas
+
+
+    def _predict(self, image):
+        for _, prediction in self.predict_stream([(0,image)]):
+            return prediction
 
     
 
@@ -114,7 +413,18 @@ def test_predictions(model,
                      step=512,
                      normalize=[],
                      channel_means=[],
-                     channel_std=[]
+                     channel_std=[],
+                     pyramid=None,
+                     order='row',
+                     image_names=None,
+                     results_path=None,
+                     batch_size=8,
+                     blend=None,
+                     probability=None,
+                     cache=None,
+                     tta=None,
+                     readers=2,
+                     writers=2
                      ):
     dices=[]
     names=[]
@@ -125,37 +435,76 @@ def test_predictions(model,
     #added sorted to make sure we have the right mask to image
     image_paths=sorted(glob.glob(os.path.join(test_path,'images',feature,'*')))
     mask_paths=sorted(glob.glob(os.path.join(test_path,'masks',feature,'*')))
+    if image_names is not None:
+        image_paths=[i for i in image_paths if os.path.basename(i)[:-9] in image_names]
     #if DEBUG: print("mask paths: ",mask_paths)
     #if DEBUG: print("image paths: ",image_paths)
     if DEBUG: print("means",channel_means)
     if DEBUG: print("stds",channel_std)
-    predict=Predict(model,threshold,tile_dim,step,normalize,channel_means,channel_std)
-
-    for i, i_path in enumerate(image_paths):
+    #a probability pyramid replaces the binary prediction and mask images
+    if pyramid=='prob' and probability is None:
+        probability='uint8'
+    predict=Predict(model,threshold,tile_dim,step,normalize,channel_means,channel_std,order,batch_size,blend,probability is not None,cache,tta,readers)
+    metadata={'threshold':threshold,'tile_dim':tile_dim,'step':step,'feature':feature}
+    masks={}
+
+    #stages: reader threads load the next uint8 images while the model
+    #runs on this thread; dice and writing go to a writer pool
+    def load(i_path):
         name=os.path.basename(i_path)[:-9]
-        names.append(name)
-        if DEBUG: print(name)
         m_path=[m for m in mask_paths if name in m][0]
         mask=cv2.imread(m_path)
         image=cv2.imread(i_path)
         image=cv2.cvtColor(image,cv2.COLOR_BGR2RGB)
-        image,mask=predict._normalize(image,mask)
-        prediction=predict._predict(image)
-        mask=np.expand_dims(mask,axis=0)
+        return name, image, mask
+
+    def load_images():
+        for name, image, mask in prefetch(load,image_paths,readers,readers+1):
+            if DEBUG: print(name)
+            masks[name]=mask
+            yield name, image
+
+    def finish(name, prediction, mask):
+        if probability is not None:
+            fmt='tiff' if pyramid=='prob' else 'npy'
+            writeProbabilities(prediction,save_path,name,probability,fmt,metadata)
+            prediction=(prediction>threshold).astype(np.uint8)
         #if DEBUG: print("shapes:",prediction.shape,mask.shape)
         
-        dices.append(diceCoef(prediction,mask[:,:,:,0:1]))
-        writePredictionsToImage(prediction,save_path,name)
-        writePredictionsToImage(mask,save_path,str("mask_"+name)) 
-        if DEBUG: print(names[i],dices[i])
+        dice=diceCoef(prediction,mask[:,:,:,0:1])
+        if pyramid is None:
+            writePredictionsToImage(prediction,save_path,name)
+            writePredictionsToImage(mask,save_path,str("mask_"+name)) 
+        elif pyramid!='prob':
+            writePredictionsToPyramid(prediction,save_path,name,pyramid)
+            writePredictionsToPyramid(mask,save_path,str("mask_"+name),pyramid)
+        if DEBUG: print(name,dice)
+        return dice
+
+    start=time.perf_counter()
+    with ThreadPoolExecutor(writers) as pool:
+        futures=[]
+        in_flight=deque()
+        for name, prediction in predict.predict_stream(load_images()):
+            names.append(name)
+            mask=np.expand_dims(masks.pop(name),axis=0)
+            futures.append(pool.submit(finish,name,prediction,mask))
+            in_flight.append(futures[-1])
+            while len(in_flight)>writers:
+                in_flight.popleft().result()
+        dices=[f.result() for f in futures]
 	#cv2.imwrite(os.path.join(save_path,'predictions',name+'.png'),prediction[0,:,:,:]*255)
     #print(dices)
     #convert list of [1,] tensors to list of floats so easy to view in csv
     da = [dt.numpy() for dt in dices]
     dices_vals = [(list(db))[0] for db in da]
     if DEBUG: print("dice vals:",dices_vals)
+    print(f'{len(names)} images in {time.perf_counter()-start:.1f}s, model {predict.tiles} tiles, {predict.tiles_per_second:.1f} tiles/s')
+    if cache is not None: print(cache, f'hit rate: {cache.hit_rate:.1%}')
     dice_df=pd.DataFrame({'names':names,'dices':dices,'dicevals':dices_vals})
-    dice_df.to_csv(os.path.join(save_path,'results-'+str(threshold)+'.csv'))
+    if results_path is None:
+        results_path=os.path.join(save_path,'results-'+str(threshold)+'.csv')
+    dice_df.to_csv(results_path)
     #if DEBUG: print(dice_df)
     return dices_vals
 
@@ -177,13 +526,99 @@ def writePredictionsToImage(img,save_path,name):
     cv2.imwrite(os.path.join(save_path,name+".png"),img_out)
 
 
+## writeProbabilities
+## save the raw probability map quantized to uint8 (p*255) or float16,
+## as {name}_prob.npy or as a tiled pyramid {name}_prob.tiff
+## (ProbabilityPyramid reads regions/levels back), so thresholds can
+## be swept without rerunning inference (sweep_thresholds)
+##
+def writeProbabilities(prob,save_path,name,dtype='uint8',fmt='npy',metadata=None):
+
+    if fmt=='tiff':
+        meta=dict(metadata or {},name=name)
+        write_probability_pyramid(prob,os.path.join(save_path,name+"_prob.tiff"),dtype,metadata=meta)
+        return
+    prob = prob[0,:,:,0]
+    if dtype=='uint8':
+        prob = np.rint(np.clip(prob,0,1)*255).astype(np.uint8)
+    elif dtype=='float16':
+        prob = prob.astype(np.float16)
+    else:
+        raise ValueError(f'unknown probability dtype {dtype}')
+    np.save(os.path.join(save_path,name+"_prob.npy"),prob)
+
+
+def sweep_thresholds(save_path,test_path,feature,thresholds,levels=256,strip=1024):
+    """
+    dice and iou at every threshold from saved probability maps,
+    one pass over each image
+    :param save_path: folder with {name}_prob.tiff or {name}_prob.npy
+        (the tiff is used when an image has both)
+    :param test_path: path to test images and masks
+    :param feature: morphological feature
+    :param thresholds: list of thresholds
+    :param levels: quantization levels for float16 maps
+    :param strip: rows read at a time
+    :return dataframe threshold, dices, ious and one dice column per image
+    """
+    mask_paths=sorted(glob.glob(os.path.join(test_path,'masks',feature,'*')))
+    #one probability map per image, preferring the tiff
+    prob_paths={}
+    for ext in ('npy','tiff'):
+        for p_path in glob.glob(os.path.join(save_path,'*_prob.'+ext)):
+            prob_paths[os.path.basename(p_path).rsplit('_prob',1)[0]]=p_path
+    results={'threshold':list(thresholds)}
+    dices,ious=[],[]
+    for name, p_path in sorted(prob_paths.items()):
+        m_path=[m for m in mask_paths if name in m][0]
+        mask=cv2.imread(m_path)[:,:,0]
+        if p_path.endswith('.tiff'):
+            pyramid=ProbabilityPyramid(p_path)
+            read=lambda r: pyramid.raw(0,r,None,strip)
+        else:
+            prob=np.load(p_path,mmap_mode='r')
+            read=lambda r: prob[r:r+strip]
+        pos,neg=0,0
+        for r in range(0,mask.shape[0],strip):
+            p,n=probabilityHistograms(read(r),mask[r:r+strip],levels)
+            pos,neg=pos+p,neg+n
+        if p_path.endswith('.tiff'):
+            pyramid.close()
+        d,i=thresholdSweep(pos,neg,thresholds)
+        results[name]=d
+        dices.append(d)
+        ious.append(i)
+    results['dices']=[list(d) for d in zip(*dices)]
+    results['ious']=[list(i) for i in zip(*ious)]
+    return pd.DataFrame(results)
+
+
+## writePredictionsToPyramid
+## write prediction as tiled multi-resolution pyramid (dzi or tiff)
+## so large canvases open quickly in viewers and QC scripts
+##
+def writePredictionsToPyramid(img,save_path,name,fmt='dzi'):
+
+    img_out = img[0,:,:,0:1]*255
+
+    if fmt=='dzi':
+        DeepZoomWrite(save_path,name).write(img_out)
+    elif fmt=='tiff':
+        write_tiff(img_out,os.path.join(save_path,name+".tiff"))
+    else:
+        raise ValueError(f'unknown pyramid format {fmt}')
+
+
 
 
 
 if __name__=='__main__':
     ap=argparse.ArgumentParser(description='model inference')
     ap.add_argument('-mp','--model_path',required=True,help='path to trained model')
-    ap.add_argument('-tp','--test_path',required=True,help='path to test images and masks')
+    ap.add_argument('-tp','--test_path',default=None,help='path to test images and masks')
+    ap.add_argument('-wp','--wsi_path',default=None,help='slide or directory of slides to predict directly')
+    ap.add_argument('-l','--level',default=0,help='slide level for -wp')
+    ap.add_argument('-ext','--extension',default='ndpi',help='slide extension for -wp')
     ap.add_argument('-sp','--save_path',required=True,help='experiment folder for saving results')
     ap.add_argument('-f','--feature',required=True,help='morphological feature')
     ap.add_argument('-th','--threshold',default=0.75,help='activation threshold')
@@ -192,6 +627,16 @@ if __name__=='__main__':
     ap.add_argument('-n','--normalize',nargs='+',default=["Scale","StandardizeDataset"],help='normalization methods')
     ap.add_argument('-cm','--means',nargs='+',default=[0.675,0.460,0.690],help='channel mean')
     ap.add_argument('-cs','--std',nargs='+', default=[0.180,0.269,0.218],help='channel std')
+    ap.add_argument('-pf','--pyramid',default=None,choices=['dzi','tiff','prob'],help='write tiled pyramids instead of pngs (prob: probability pyramid)')
+    ap.add_argument('-o','--order',default='row',choices=['row','morton','hilbert'],help='tile traversal order')
+    ap.add_argument('-bs','--batch_size',default=8,help='tiles per inference batch')
+    ap.add_argument('-bl','--blend',default=None,choices=['gaussian','cosine'],help='blend overlapping tile probabilities')
+    ap.add_argument('-pr','--probability',default=None,choices=['uint8','float16'],help='also save probability maps')
+    ap.add_argument('-ta','--tta',nargs='+',default=None,help=f'test time augmentation views ({", ".join(TTA_TRANSFORMS)} or all)')
+    ap.add_argument('-nr','--readers',default=2,help='reader threads')
+    ap.add_argument('-nw','--writers',default=2,help='writer threads')
+    ap.add_argument('-cp','--cache_path',default=None,help='directory of cached tile predictions')
+    ap.add_argument('-cb','--cache_mb',default=4096,help='tile cache size budget in MB')
     args=ap.parse_args()
 
     #model=UNet_multi(3,2)
@@ -211,16 +656,40 @@ if __name__=='__main__':
     if DEBUG: print("save_path:",save_path)
     os.makedirs(save_path,exist_ok=True)
     #os.makedirs(os.path.join(save_path,'predictions'),exist_ok=True)
-    test_predictions(model,
-                     args.test_path,
-                     save_path,
-                     args.feature,
-                     float(args.threshold),
-                     int(args.tile_dim),
-                     int(args.step),
-                     args.normalize,
-                     cm,
-                     cs)
+    cache=None
+    if args.cache_path is not None:
+        cache=TileCache(args.cache_path,float(args.cache_mb))
+    if args.wsi_path is not None:
+        slide_paths=[args.wsi_path]
+        if os.path.isdir(args.wsi_path):
+            slide_paths=sorted(glob.glob(os.path.join(args.wsi_path,'*.'+args.extension)))
+        predict=Predict(model,float(args.threshold),int(args.tile_dim),int(args.step),
+                        args.normalize,cm,cs,args.order,int(args.batch_size),args.blend,
+                        args.pyramid=='prob',cache,args.tta,int(args.readers))
+        for slide_path in slide_paths:
+            predict.predict_slide(slide_path,int(args.level),save_path,pyramid=args.pyramid)
+        print(f'{predict.tiles} tiles, {predict.tiles_per_second:.1f} tiles/s')
+        if cache is not None: print(cache, f'hit rate: {cache.hit_rate:.1%}')
+    else:
+        test_predictions(model,
+                         args.test_path,
+                         save_path,
+                         args.feature,
+                         float(args.threshold),
+                         int(args.tile_dim),
+                         int(args.step),
+                         args.normalize,
+                         cm,
+                         cs,
+                         args.pyramid,
+                         args.order,
+                         batch_size=int(args.batch_size),
+                         blend=args.blend,
+                         probability=args.probability,
+                         cache=cache,
+                         tta=args.tta,
+                         readers=int(args.readers),
+                         writers=int(args.writers))
     
 
 
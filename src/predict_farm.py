@@ -0,0 +1,182 @@
+"""
+predict_farm.py: multi-process CPU inference across a cohort of slides
+
+Starts N worker processes, each pinned to its own block of cores with
+a matching tensorflow intra-op thread count, loading its own copy of
+the model once. Slides are handed out largest first from a shared
+queue and predicted with Predict.predict_slide; every worker reports
+one row per slide (tiles, runtime, positive area) which the driver
+merges into farm_results.csv with the aggregate throughput. Workers
+are spawned rather than forked so no tensorflow state is inherited.
+
+    python predict_farm.py -mp model.h5 -wp wsi -sp predictions -w 4
+"""
+
+import os
+import glob
+import time
+import queue
+import argparse
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+
+def _worker(rank,tasks,results,model_path,cores,predict_config,slide_config,cache_path,cache_mb):
+    """
+    worker process: pin cores and threads, load the model once and
+    predict slides from the task queue until a None sentinel
+    """
+    threads=str(len(cores))
+    os.environ['OMP_NUM_THREADS']=threads
+    os.environ['TF_NUM_INTRAOP_THREADS']=threads
+    os.environ['TF_NUM_INTEROP_THREADS']='1'
+    os.sched_setaffinity(0,cores)
+    import cv2
+    import tensorflow as tf
+    from tensorflow.keras.models import load_model
+    from predict import Predict
+    from tile_cache import TileCache
+    cv2.setNumThreads(1)
+    tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    model=load_model(model_path,compile=False)
+    cache=TileCache(cache_path,cache_mb) if cache_path is not None else None
+    predict=Predict(model,cache=cache,**predict_config)
+    #binary canvases are 0/255, probability canvases are thresholded
+    cut=predict.threshold if predict.probability else 0
+    while True:
+        slide_path=tasks.get()
+        if slide_path is None:
+            break
+        row={'path':slide_path,'worker':rank}
+        start=time.perf_counter()
+        tiles,elapsed=predict.tiles,predict.elapsed
+        try:
+            canvas=predict.predict_slide(slide_path,**slide_config)
+            positive=sum(int(np.count_nonzero(canvas[0,r:r+4096]>cut))
+                         for r in range(0,canvas.shape[1],4096))
+            row.update({'status':'done',
+                        'height':canvas.shape[1],
+                        'width':canvas.shape[2],
+                        'positive_px':positive,
+                        'positive_fraction':positive/float(canvas.shape[1]*canvas.shape[2])})
+        except Exception:
+            row.update({'status':'failed','error':traceback.format_exc()})
+        row.update({'tiles':predict.tiles-tiles,
+                    'model_s':predict.elapsed-elapsed,
+                    'seconds':time.perf_counter()-start})
+        results.put(row)
+
+
+def core_blocks(workers,threads=None):
+    """
+    split available cores into one block per worker
+    :param workers: number of workers
+    :param threads: cores per worker (default all cores split evenly)
+    :return list of core sets
+    """
+    cores=sorted(os.sched_getaffinity(0))
+    threads=max(1,len(cores)//workers) if threads is None else threads
+    return [set(cores[(i*threads)%len(cores):(i*threads)%len(cores)+threads] or cores[:threads])
+            for i in range(workers)]
+
+
+def run_farm(model_path,slide_paths,workers,predict_config,slide_config,
+             threads=None,cache_path=None,cache_mb=4096):
+    """
+    predict slides on a pool of worker processes
+    :param model_path: trained model
+    :param slide_paths: list of slide paths
+    :param workers: number of worker processes
+    :param predict_config: Predict keyword arguments
+    :param slide_config: predict_slide keyword arguments
+    :param threads: cores/intra-op threads per worker
+    :param cache_path: optional shared tile cache directory
+    :param cache_mb: size budget of the shared cache in MB
+    :return dataframe of per slide results
+    """
+    ctx=mp.get_context('spawn')
+    tasks=ctx.Queue()
+    results=ctx.Queue()
+    for path in sorted(slide_paths,key=os.path.getsize,reverse=True):
+        tasks.put(path)
+    for _ in range(workers):
+        tasks.put(None)
+
+    start=time.perf_counter()
+    procs=[ctx.Process(target=_worker,
+                       args=(i,tasks,results,model_path,cores,predict_config,slide_config,cache_path,cache_mb))
+           for i, cores in enumerate(core_blocks(workers,threads))]
+    for p in procs:
+        p.start()
+
+    rows=[]
+    while len(rows)<len(slide_paths):
+        try:
+            row=results.get(timeout=5)
+        except queue.Empty:
+            if not any(p.is_alive() for p in procs):
+                break
+            continue
+        rows.append(row)
+        print(f"{len(rows)}/{len(slide_paths)} {os.path.basename(row['path'])} "
+              f"{row['status']} {row['tiles']} tiles {row['seconds']:.1f}s (worker {row['worker']})")
+    for p in procs:
+        p.join()
+    wall=time.perf_counter()-start
+
+    #slides lost with a crashed worker
+    seen={r['path'] for r in rows}
+    rows+=[{'path':p,'status':'failed','error':'worker exited'} for p in slide_paths if p not in seen]
+    df=pd.DataFrame(rows)
+    tiles=df['tiles'].sum()
+    print(f'{(df.status=="done").sum()}/{len(df)} slides, {tiles:.0f} tiles in {wall:.1f}s: '
+          f'{tiles/wall:.1f} tiles/s, {3600*len(seen)/wall:.1f} slides/h with {workers} workers')
+    return df
+
+
+if __name__=='__main__':
+    ap=argparse.ArgumentParser(description='multi-process slide inference')
+    ap.add_argument('-mp','--model_path',required=True,help='path to trained model')
+    ap.add_argument('-wp','--wsi_path',required=True,help='directory of slides')
+    ap.add_argument('-sp','--save_path',required=True,help='folder for predictions')
+    ap.add_argument('-ext','--extension',default='ndpi',help='slide extension')
+    ap.add_argument('-w','--workers',default=2,help='worker processes')
+    ap.add_argument('-t','--threads',default=None,help='cores per worker (default split evenly)')
+    ap.add_argument('-l','--level',default=0,help='slide level')
+    ap.add_argument('-th','--threshold',default=0.75,help='activation threshold')
+    ap.add_argument('-td','--tile_dim',default=1024,help='tile dims')
+    ap.add_argument('-s','--step',default=512,help='sliding window size')
+    ap.add_argument('-n','--normalize',nargs='+',default=["Scale","StandardizeDataset"],help='normalization methods')
+    ap.add_argument('-cm','--means',nargs='+',default=[0.675,0.460,0.690],help='channel mean')
+    ap.add_argument('-cs','--std',nargs='+', default=[0.180,0.269,0.218],help='channel std')
+    ap.add_argument('-bs','--batch_size',default=8,help='tiles per inference batch')
+    ap.add_argument('-bl','--blend',default=None,choices=['gaussian','cosine'],help='blend overlapping tile probabilities')
+    ap.add_argument('-ta','--tta',nargs='+',default=None,help='test time augmentation views')
+    ap.add_argument('-pf','--pyramid',default=None,choices=['dzi','tiff','prob'],help='also write pyramids')
+    ap.add_argument('-cp','--cache_path',default=None,help='shared tile cache directory')
+    ap.add_argument('-cb','--cache_mb',default=4096,help='tile cache size budget in MB')
+    args=ap.parse_args()
+
+    os.makedirs(args.save_path,exist_ok=True)
+    slide_paths=sorted(glob.glob(os.path.join(args.wsi_path,'*.'+args.extension)))
+    predict_config={'threshold':float(args.threshold),
+                    'tile_dim':int(args.tile_dim),
+                    'step':int(args.step),
+                    'normalize':args.normalize,
+                    'channel_means':[float(m) for m in args.means],
+                    'channel_std':[float(s) for s in args.std],
+                    'batch_size':int(args.batch_size),
+                    'blend':args.blend,
+                    'probability':args.pyramid=='prob',
+                    'tta':args.tta}
+    slide_config={'level':int(args.level),
+                  'save_path':args.save_path,
+                  'pyramid':args.pyramid}
+    df=run_farm(args.model_path,slide_paths,int(args.workers),predict_config,slide_config,
+                int(args.threads) if args.threads else None,args.cache_path,float(args.cache_mb))
+    df.to_csv(os.path.join(args.save_path,'farm_results.csv'),index=False)
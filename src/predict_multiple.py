@@ -1,49 +1,32 @@
 #call predict multiple times
-from predict import test_predictions
+from predict import test_predictions, sweep_thresholds
 from tensorflow.keras.models import load_model
 import datetime
-import pandas as pd
 import os
 import argparse
 import ast
 
-def predict_multiple(model, test_path, save_path, feature,step,normalize,means,std):
-    results={}
+def predict_multiple(model, test_path, save_path, feature,step,normalize,means,std,probability='uint8'):
     
-    results['threshold'] = [i / 100 for i in range(50, 101, 5)]
-    results['dices']=[]
-    results['14']=[]
-    results['32']=[]
-    results['38']=[]
-    results['42']=[]
-    results['48']=[]
-    #go from 0.5 to 1 in increments of 
-    # Loop through threshold values from 0.5 to 1 with 0.05 increments
-    for threshold in results['threshold']:
-        #curr_save_path=(save_path+'_'+str(threshold))
-        curr_save_path=f"{save_path}_{threshold:.2f}"
-        os.makedirs(curr_save_path,exist_ok=True)
-        print(f"Running test_predictions with threshold: {threshold}")
-        print("saving to: ",curr_save_path)
-        dices=test_predictions(model,
-                         test_path,
-                         curr_save_path,
-                         args.feature,
-                         threshold,
-                         1024,
-                         step,
-                         normalize,
-                         means,    
-                         std
-                         )
-        results['dices'].append(dices)
-        results['14'].append(dices[0])
-        results['32'].append(dices[1])
-        results['38'].append(dices[2])
-        results['42'].append(dices[3])
-        results['48'].append(dices[4])
-
-    results_df = pd.DataFrame(results)
+    thresholds = [i / 100 for i in range(50, 101, 5)]
+    #inference runs once: probability maps are saved and every
+    #threshold is scored from per image histograms
+    print(f"Running test_predictions once, sweeping thresholds: {thresholds}")
+    print("saving to: ",save_path)
+    test_predictions(model,
+                     test_path,
+                     save_path,
+                     feature,
+                     thresholds[0],
+                     1024,
+                     step,
+                     normalize,
+                     means,    
+                     std,
+                     probability=probability
+                     )
+    results_df = sweep_thresholds(save_path,test_path,feature,thresholds)
+    print(results_df)
     results_df.to_csv(os.path.join(save_path,'results-multiple.csv'))
 
 if __name__=='__main__':
@@ -56,6 +39,7 @@ if __name__=='__main__':
     ap.add_argument('-n','--normalize',nargs='+',default=["Scale","StandardizeDataset"],help='normalization methods')
     ap.add_argument('-cm','--means',nargs='+',default=[0.675,0.460,0.690],help='channel mean')
     ap.add_argument('-cs','--std',nargs='+', default=[0.180,0.269,0.218],help='channel std')
+    ap.add_argument('-pr','--probability',default='uint8',choices=['uint8','float16'],help='saved probability map dtype')
     args=ap.parse_args()
     cm=[float(x) for x in args.means]
     cs=[float(x) for x in args.std] 
@@ -77,7 +61,8 @@ if __name__=='__main__':
                      int(args.step),
                      args.normalize,
                      cm,
-                     cs)
+                     cs,
+                     args.probability)
 
 
 
@@ -7,11 +7,19 @@ import argparse
 import cv2
 import numpy as np
 
+from pyslide.io.archive_io import ArchiveRead
 
-def calculate_std_mean(path):
 
-    images = glob.glob(os.path.join(path,'*'))
-    image_shape = cv2.imread(images[0]).shape
+def calculate_std_mean(path, archive=False):
+
+    if archive:
+        reader = ArchiveRead(path)
+        images = reader.names()
+        read = lambda name: cv2.cvtColor(reader.read(name), cv2.COLOR_RGB2BGR)
+    else:
+        images = glob.glob(os.path.join(path,'*'))
+        read = cv2.imread
+    image_shape = read(images[0]).shape
     channel_num = image_shape[-1]
     channel_values = np.zeros((channel_num))
     channel_values_sq = np.zeros((channel_num))
@@ -20,14 +28,14 @@ def calculate_std_mean(path):
     print('total number pixels: {}'.format(pixel_num))
 
     for path in images:
-        image = cv2.imread(path)
+        image = read(path)
         image = (image/255.0).astype('float64')
         channel_values += np.sum(image, axis=(0,1), dtype='float64')
 
     mean=channel_values/pixel_num
 
     for path in images:
-        image = cv2.imread(path)
+        image = read(path)
         image = (image/255.0).astype('float64')
         channel_values_sq += np.sum(np.square(image-mean), axis=(0,1), dtype='float64')
 
@@ -41,9 +49,10 @@ if __name__ == '__main__':
 
     ap = argparse.ArgumentParser()
     ap.add_argument('-p', '--path', required=True, help='path to image set')
+    ap.add_argument('-a', '--archive', action='store_true', help='path is a packed patch archive')
     args = vars(ap.parse_args())
 
-    mean, std = calculate_std_mean(args['path'])
+    mean, std = calculate_std_mean(args['path'], args['archive'])
 
     
 
@@ -5,12 +5,24 @@ import glob
 import cv2
 import numpy as np
 
+from pyslide.io.archive_io import ArchiveRead
+
 path = "/SAN/colcc/WSI_LymphNodes_BreastCancer/HollyR/data/patches/10x/10x-1024-512/images"
 output_path = "/SAN/colcc/WSI_LymphNodes_BreastCancer/HollyR/data/patches/10x/10x-1024-512"
+#set to a packed archive directory (Patch.to_archive) to read from its index instead of globbing path
+archive_path = None
+archive = ArchiveRead(archive_path) if archive_path is not None else None
+
+
+def load_image(image_path):
+    # BGR image from file path or archive patch name
+    if archive is None:
+        return cv2.imread(image_path)
+    return cv2.cvtColor(archive.read(image_path), cv2.COLOR_RGB2BGR)
 
 def get_percentage_overexposed_rainbows(image_path):
     # Load the image
-    img = cv2.imread(image_path)
+    img = load_image(image_path)
 
     # Convert the image from RGB to HSV
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
@@ -63,7 +75,10 @@ lower_bound = np.array([30, 60, 130])
 upper_bound = np.array([80,255,255])
 
 
-images = glob.glob(os.path.join(path,'*'))
+if archive is not None:
+    images = archive.names()
+else:
+    images = glob.glob(os.path.join(path,'*'))
 
 
 white_imgs = []
@@ -75,7 +90,7 @@ swirl_imgs = []
 for img_path in images:
     print(img_path)
     #swirl_pct = get_percentage_overexposed_rainbows(img_path)
-    image = cv2.imread(img_path)        
+    image = load_image(img_path)
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     img_mean, img_std = cv2.meanStdDev(image)
     img_mean = img_mean.reshape((3,))
@@ -0,0 +1,379 @@
+"""
+archive_io.py: read and write packed patch archives
+
+Patches are png encoded and appended to uncompressed tar shards of at
+most shard_size bytes ({name}_{i}.tar). A sidecar csv index
+({name}_index.csv) records name,kind,x,y,label,shard,offset,length for
+every member so readers list a slide from one file and fetch any patch
+with a single seek+read, with no per-patch filesystem metadata calls.
+Shards are ordinary tar files and can be unpacked with standard tools.
+The codec column records how each member is encoded (png, or jpeg for
+tiles copied through from the slide without decoding).
+"""
+
+import io
+import os
+import csv
+import glob
+import tarfile
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from pyslide.io.manifest import Manifest
+from pyslide.io.native_tiles import NativeTiles
+
+INDEX_COLUMNS=['name','kind','x','y','label','shard','offset','length','codec']
+EXTENSIONS={'png':'png','jpeg':'jpg'}
+
+
+def encode_png(image):
+    """
+    png encode RGB image or single channel mask
+    :param image: ndarray
+    :return bytes
+    """
+    if image.ndim==3:
+        image=cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
+    status,data=cv2.imencode('.png',image)
+    if not status:
+        raise ValueError('png encoding failed')
+    return data.tobytes()
+
+
+def decode_png(data):
+    """
+    decode png (or jpeg) bytes to RGB image or single channel mask
+    :param data: bytes
+    :return image: ndarray
+    """
+    image=cv2.imdecode(np.frombuffer(data,dtype=np.uint8),cv2.IMREAD_UNCHANGED)
+    if image.ndim==3:
+        image=cv2.cvtColor(image,cv2.COLOR_BGR2RGB)
+    return image
+
+
+class ArchiveWrite():
+    """
+    append-only writer for one slide. Reopening an existing archive
+    resumes after the last indexed member; completed patches are
+    tracked in {name}_manifest.txt
+    :param path: archive directory
+    :param name: slide name
+    :param shard_size: max shard size in bytes
+    :param resume: continue existing archive, else start again
+    """
+    def __init__(self, path, name, shard_size=2e9, resume=True):
+        self.path=path
+        self.name=name
+        self.shard_size=shard_size
+        self.index_path=os.path.join(path,name+'_index.csv')
+        os.makedirs(path,exist_ok=True)
+        self.manifest=Manifest(os.path.join(path,name+'_manifest.txt'))
+        self._tar=None
+        self._shard=0
+        if not resume:
+            self._remove()
+        if os.path.exists(self.index_path):
+            self._recover()
+        new=not os.path.exists(self.index_path)
+        self._index_file=open(self.index_path,'a',newline='')
+        self._index=csv.writer(self._index_file)
+        if new:
+            self._index.writerow(INDEX_COLUMNS)
+            self._index_file.flush()
+
+
+    def _remove(self):
+        """
+        delete existing shards, index and manifest for this slide
+        """
+        for f in glob.glob(os.path.join(self.path,self.name+'_*.tar')):
+            os.remove(f)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        self.manifest.reset()
+
+
+    def _recover(self):
+        """
+        drop a partially written index row and rows whose member
+        data never reached the shard (with every other row and the
+        manifest entry of those patches), truncate the last shard to
+        the end of its last indexed member (restoring the tar end
+        blocks) and remove any later unindexed shard
+        """
+        with open(self.index_path,'rb') as f:
+            text=f.read()
+        if not text.endswith(b'\n'):
+            with open(self.index_path,'wb') as f:
+                f.write(text[:text.rfind(b'\n')+1])
+        index=pd.read_csv(self.index_path)
+        changed='codec' not in index
+        if changed:
+            index['codec']='png'
+        blocks=-(-index['length']//tarfile.BLOCKSIZE)
+        ends=index['offset']+blocks*tarfile.BLOCKSIZE
+        sizes={s:os.path.getsize(self._shard_path(s)) if os.path.exists(self._shard_path(s)) else 0
+               for s in index['shard'].unique()}
+        missing=set(index.loc[ends>index['shard'].map(sizes),'name'])
+        if missing:
+            print(f'{len(missing)} patches missing from shards, rewriting')
+            keep=~index['name'].isin(missing)
+            index,ends=index[keep],ends[keep]
+            self.manifest.retain(self.manifest.completed-missing)
+            changed=True
+        if changed:
+            index.to_csv(self.index_path,index=False)
+        end=0
+        if len(index)>0:
+            self._shard=int(index['shard'].max())
+            end=int(ends[index['shard']==self._shard].max())
+        shard_path=self._shard_path(self._shard)
+        if os.path.exists(shard_path):
+            with open(shard_path,'r+b') as f:
+                f.truncate(end)
+                f.seek(end)
+                f.write(bytes(2*tarfile.BLOCKSIZE))
+        shard=self._shard+1
+        while os.path.exists(self._shard_path(shard)):
+            os.remove(self._shard_path(shard))
+            shard+=1
+
+
+    def __repr__(self):
+        return f'ArchiveWrite(path: {self.path}, name: {self.name})'
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self,*args):
+        self.close()
+
+
+    def _shard_path(self,shard):
+        return os.path.join(self.path,f'{self.name}_{shard}.tar')
+
+
+    def _open_shard(self):
+        self._tar=tarfile.open(self._shard_path(self._shard),'a')
+
+
+    def add(self,name,data,kind='image',x=0,y=0,label=-1,codec='png'):
+        """
+        append encoded patch to current shard and index
+        :param name: patch name
+        :param data: encoded bytes
+        :param kind: image or mask
+        :param x: int x coordinate
+        :param y: int y coordinate
+        :param label: int label
+        :param codec: png or jpeg
+        """
+        if self._tar is None:
+            self._open_shard()
+        if self._tar.offset>0 and self._tar.offset+len(data)>self.shard_size:
+            self._tar.close()
+            self._shard+=1
+            self._open_shard()
+        info=tarfile.TarInfo(f'{kind}/{name}.{EXTENSIONS[codec]}')
+        info.size=len(data)
+        self._tar.addfile(info,io.BytesIO(data))
+        #member data is on disk before its index row and manifest entry
+        self._tar.fileobj.flush()
+        os.fsync(self._tar.fileobj.fileno())
+        #member data is padded to whole tar blocks after the header
+        blocks=-(-len(data)//tarfile.BLOCKSIZE)
+        offset=self._tar.offset-blocks*tarfile.BLOCKSIZE
+        label=-1 if label is None or label!=label else int(label)
+        self._index.writerow([name,kind,int(x),int(y),label,
+                              self._shard,offset,len(data),codec])
+        self._index_file.flush()
+
+
+    def _native_tiles(self,patch):
+        """
+        native tile reader if patches line up with a jpeg tile grid
+        and no filter mask has to be applied, else None
+        """
+        slide=patch.slide
+        if slide.filter_mask is not None:
+            return None
+        level=patch.mag_level
+        tiles=NativeTiles(slide.path,level,slide.level_dimensions[level])
+        if not tiles.aligned(patch.size,patch.step):
+            tiles.close()
+            return None
+        return tiles
+
+
+    def write(self,patch,mask_flag=False,passthrough=False):
+        """
+        write all patches (and masks) of Patch object not
+        already in the manifest, then mark the slide complete.
+        With passthrough, patches that are exactly one native jpeg
+        tile are copied without decoding first; the rest are
+        extracted with patch.extract_patches (worker processes when
+        patch.workers>0) and written as png
+        :param patch: pyslide.patching.Patch object
+        :param mask_flag: boolean write masks
+        :param passthrough: copy compressed tiles where aligned
+        """
+        tiles=self._native_tiles(patch) if passthrough else None
+        if tiles is not None:
+            copied=0
+            for p in patch.patches:
+                if p['name'] in self.manifest:
+                    continue
+                data=tiles.read(p['x'],p['y'],patch._downsample)
+                if data is None:
+                    continue
+                label=p.get('label',-1)
+                self.add(p['name'],data,'image',p['x'],p['y'],label,'jpeg')
+                if mask_flag:
+                    mask=patch.extract_mask(p['x'],p['y'])
+                    self.add(p['name'],encode_png(mask),'mask',p['x'],p['y'],label)
+                self.manifest.add(p['name'])
+                copied+=1
+            tiles.close()
+            print(f'copied {copied} native tiles')
+        for image, p in patch.extract_patches(skip=set(self.manifest.completed)):
+            label=p.get('label',-1)
+            self.add(p['name'],encode_png(image),'image',p['x'],p['y'],label)
+            if mask_flag:
+                mask=patch.extract_mask(p['x'],p['y'])
+                self.add(p['name'],encode_png(mask),'mask',p['x'],p['y'],label)
+            self.manifest.add(p['name'])
+        self.close()
+        self.manifest.mark_complete()
+
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar=None
+        self._index_file.close()
+        self.manifest.close()
+
+
+class ArchiveRead():
+    """
+    random access reader for packed patch archives. Reads every
+    index in the directory (or the one for name) once
+    :param path: archive directory
+    :param name: optional slide name
+    """
+    def __init__(self, path, name=None):
+        self.path=path
+        if name is None:
+            index_paths=sorted(glob.glob(os.path.join(path,'*_index.csv')))
+        else:
+            index_paths=[os.path.join(path,name+'_index.csv')]
+        frames=[]
+        for p in index_paths:
+            df=pd.read_csv(p)
+            df['slide']=os.path.basename(p)[:-len('_index.csv')]
+            if 'codec' not in df:
+                df['codec']='png'
+            frames.append(df)
+        columns=INDEX_COLUMNS+['slide']
+        self.index=pd.concat(frames,ignore_index=True) if frames else pd.DataFrame(columns=columns)
+        self._lookup={(k,n):i for i,(k,n) in enumerate(zip(self.index['kind'],self.index['name']))}
+        self._files={}
+
+
+    def __repr__(self):
+        return f'ArchiveRead(path: {self.path}, n: {len(self.index)})'
+
+
+    def __len__(self):
+        return int((self.index['kind']=='image').sum())
+
+
+    def __contains__(self,name):
+        return self.exists(name)
+
+
+    def exists(self,name,kind='image'):
+        return (kind,name) in self._lookup
+
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        state['_files']={}
+        return state
+
+
+    def names(self,kind='image'):
+        """
+        patch names in index order
+        :param kind: image or mask
+        :return list of names
+        """
+        return list(self.index.loc[self.index['kind']==kind,'name'])
+
+
+    def entries(self,kind='image'):
+        """
+        index rows for kind
+        :return dataframe
+        """
+        return self.index[self.index['kind']==kind]
+
+
+    def _file(self,slide,shard):
+        key=(slide,shard)
+        if key not in self._files:
+            path=os.path.join(self.path,f'{slide}_{shard}.tar')
+            self._files[key]=open(path,'rb')
+        return self._files[key]
+
+
+    def read_bytes(self,name,kind='image'):
+        """
+        raw encoded bytes for patch
+        :param name: patch name
+        :param kind: image or mask
+        :return bytes
+        """
+        row=self.index.iloc[self._lookup[(kind,name)]]
+        f=self._file(row['slide'],int(row['shard']))
+        #positional read so threads can share the handle
+        return os.pread(f.fileno(),int(row['length']),int(row['offset']))
+
+
+    def codec(self,name,kind='image'):
+        """
+        encoding of stored patch (png or jpeg)
+        """
+        return self.index['codec'].iat[self._lookup[(kind,name)]]
+
+
+    def read(self,name,kind='image'):
+        """
+        decoded patch
+        :param name: patch name
+        :param kind: image or mask
+        :return ndarray (RGB image or single channel mask)
+        """
+        return decode_png(self.read_bytes(name,kind))
+
+
+    def iter_patches(self,kind='image'):
+        """
+        iterate patches in on-disk order
+        :yield image: ndarray
+        :yield row: index row
+        """
+        entries=self.entries(kind).sort_values(['slide','shard','offset'])
+        for _, row in entries.iterrows():
+            yield self.read(row['name'],kind), row
+
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files={}
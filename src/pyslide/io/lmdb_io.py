@@ -1,29 +1,124 @@
+"""
+lmdb_io.py: read and write patches to lmdb
+
+Each record is a small fixed header followed by the pixel data. The
+header stores codec, dtype, shape, label and the patch coordinates so
+records can be decoded without knowing the patch size in advance.
+Raw records are decoded with np.frombuffer directly on the transaction
+buffer (no copy). Images and masks live in separate named databases.
+"""
+
 import os
-import glob
-import pickle
-from PIL import Image
+import struct
 
+import cv2
 import lmdb
 import numpy as np
 from torch.utils.data import DataLoader, Dataset
 
+from pyslide.io.manifest import Manifest
+
+#magic,codec,dtype,ndim,shape(4),label,x,y
+HEADER=struct.Struct('<4sB4sB4Iiqq')
+MAGIC=b'PSL1'
+CODECS={'raw':0,'png':1}
+MAX_DIMS=4
+
+_READ_HANDLES={}
+
+
+def encode_record(image,label=-1,x=0,y=0,codec='raw'):
+    """
+    serialize array as header+pixel bytes
+    :param image: ndarray (at most 4 dimensions)
+    :param label: int label (-1 if missing)
+    :param x: int x coordinate
+    :param y: int y coordinate
+    :param codec: raw or png
+    :return bytes record
+    """
+    image=np.ascontiguousarray(image)
+    if image.ndim>MAX_DIMS:
+        raise ValueError(f'max {MAX_DIMS} dims, got {image.ndim}')
+    shape=list(image.shape)+[0]*(MAX_DIMS-image.ndim)
+    label=-1 if label is None or label!=label else int(label)
+    header=HEADER.pack(MAGIC,
+                       CODECS[codec],
+                       image.dtype.str.encode('ascii'),
+                       image.ndim,
+                       *shape,
+                       label,
+                       int(x),
+                       int(y))
+    if codec=='png':
+        status,data=cv2.imencode('.png',image)
+        if not status:
+            raise ValueError('png encoding failed')
+        return header+data.tobytes()
+    return header+image.tobytes()
+
+
+def decode_header(buf):
+    """
+    parse record header
+    :param buf: record buffer
+    :return meta: dict codec,dtype,shape,label,x,y
+    """
+    magic,codec,dtype,ndim,*rest=HEADER.unpack_from(buf)
+    if magic!=MAGIC:
+        raise ValueError('not a pyslide lmdb record')
+    shape,(label,x,y)=rest[:MAX_DIMS],rest[MAX_DIMS:]
+    return {'codec':codec,
+            'dtype':np.dtype(dtype.rstrip(b'\x00').decode('ascii')),
+            'shape':tuple(shape[:ndim]),
+            'label':label,
+            'x':x,
+            'y':y}
+
+
+def decode_record(buf):
+    """
+    deserialize record. raw records are returned as a
+    view on buf so buf must outlive the array
+    :param buf: record buffer
+    :return image: ndarray
+    :return meta: header dict
+    """
+    meta=decode_header(buf)
+    if meta['codec']==CODECS['png']:
+        data=np.frombuffer(buf,dtype=np.uint8,offset=HEADER.size)
+        image=cv2.imdecode(data,cv2.IMREAD_UNCHANGED)
+        image=image.reshape(meta['shape'])
+    else:
+        image=np.frombuffer(buf,dtype=meta['dtype'],offset=HEADER.size)
+        image=image.reshape(meta['shape'])
+    return image, meta
+
 
 class LMDBWrite():
-    def __init__(self,db_path,map_size,write_frequency=10):
+    def __init__(self,
+                 db_path,
+                 map_size,
+                 write_frequency=10,
+                 codec='raw',
+                 growth_factor=2):
         self.db_path=db_path
-        self.map_size=map_size
-        self.env=lmdb.open(self.db_path, 
-                           map_size=5e9,
-                           writemap=True)
+        self.map_size=int(max(map_size,2**20))
         self.write_frequency=write_frequency
+        self.codec=codec
+        self.growth_factor=growth_factor
+        self.env=lmdb.open(self.db_path,
+                           map_size=self.map_size,
+                           max_dbs=2)
+        self.images_db=self.env.open_db(b'images')
+        self.masks_db=self.env.open_db(b'masks')
+        self.manifest=None
+        self._pending=[]
+        self._done=[]
 
-    def __repr__(self):
-        return f'LMBDWrite(size: {self.map_size}, path: {self.db_path})'
-    
 
-    def _serialize(self,image):
-        image_bytes = image.tobytes()
-        return image_bytes
+    def __repr__(self):
+        return f'LMDBWrite(size: {self.map_size}, path: {self.db_path})'
 
 
     def _print_progress(self,i,total):
@@ -31,39 +126,173 @@ class LMDBWrite():
         print(f'\r- Progress: {complete:.1%}', end='\r')
 
 
-    def write(self,patch): 
-        txn=self.env.begin(write=True)
-        for i, (image, p) in enumerate(patch.extract_patches()):
-            value=self._serialize(image)
-            key = f"{p['name']}"
-            txn.put(key.encode("ascii"), pickle.dumps(value))
-            self._print_progress(i,len(patch._patches))
-            if i % self.write_frequency == 0:
-                txn.commit()
-                txn = self.env.begin(write=True)
-        txn.commit()
+    def _grow(self):
+        """
+        increase map size when database is full
+        """
+        self.map_size=int(self.map_size*self.growth_factor)
+        self.env.set_mapsize(self.map_size)
+        print(f'map size increased: {self.map_size}')
+
+
+    def _commit(self):
+        """
+        write pending records in a single transaction. On
+        MapFullError the transaction is aborted, the map grown
+        and the batch replayed
+        """
+        while True:
+            try:
+                with self.env.begin(write=True) as txn:
+                    for db,key,value in self._pending:
+                        txn.put(key,value,db=db)
+                break
+            except lmdb.MapFullError:
+                self._grow()
+        self._pending=[]
+        if self.manifest is not None:
+            for name in self._done:
+                self.manifest.add(name)
+        self._done=[]
+
+
+    def put(self,key,image,label=-1,x=0,y=0,mask=False):
+        """
+        queue single record, committed every write_frequency
+        :param key: str key
+        :param image: ndarray
+        :param label: int label
+        :param x: int x coordinate
+        :param y: int y coordinate
+        :param mask: boolean write to masks database
+        """
+        db=self.masks_db if mask else self.images_db
+        codec='png' if mask else self.codec
+        #png cannot hold stacked context patches
+        if np.ndim(image)>3:
+            codec='raw'
+        value=encode_record(image,label,x,y,codec)
+        self._pending.append((db,key.encode('ascii'),value))
+        if len(self._pending)>=self.write_frequency:
+            self._commit()
+
+
+    def flush(self):
+        if self._pending or self._done:
+            self._commit()
+
+
+    def write(self,patch,mask_flag=False,resume=True,context=None):
+        """
+        write all patches (and masks) of Patch object. Patch
+        names go to db_path/manifest.txt once their transaction
+        commits so an interrupted write resumes where it stopped
+        :param patch: pyslide.patching.Patch object
+        :param mask_flag: boolean write masks
+        :param resume: skip patches already in the manifest
+        :param context: optional scales, write (K,h,w,3) context
+            stacks instead of single patches
+        """
+        self.manifest=Manifest(os.path.join(self.db_path,'manifest.txt'))
+        if not resume:
+            self.manifest.reset()
+        total=len(patch._patches)
+        skip=set(self.manifest.completed)
+        if context is None:
+            patches=patch.extract_patches(skip=skip)
+        else:
+            patches=patch.extract_contexts(context,skip=skip)
+        for i, (image, p) in enumerate(patches):
+            label=p.get('label',-1)
+            self.put(p['name'],image,label,p['x'],p['y'])
+            if mask_flag:
+                mask=patch.extract_mask(p['x'],p['y'])
+                self.put(p['name'],mask,label,p['x'],p['y'],mask=True)
+            self._done.append(p['name'])
+            self._print_progress(i,total)
+        self.flush()
+        self.manifest.mark_complete()
         self.env.close()
 
 
     def close(self):
+        self.flush()
         self.env.close()
 
 
+def _read_handle(db_path):
+    """
+    one environment and long-lived read transaction per process
+    and database. a handle inherited through fork is dropped
+    without closing it (closing would release the parent's
+    environment) and a fresh environment is opened in the child
+    :param db_path: lmdb directory
+    :return handle: dict env,txn,images,masks
+    """
+    key=os.path.realpath(db_path)
+    handle=_READ_HANDLES.get(key)
+    if handle is not None and handle['pid']==os.getpid():
+        return handle
+    if handle is not None:
+        #dealloc in the child skips mdb_env_close
+        del _READ_HANDLES[key]
+        handle=None
+    env=lmdb.open(db_path,
+                  readonly=True,
+                  lock=False,
+                  readahead=False,
+                  max_dbs=2)
+    images_db=env.open_db(b'images',create=False)
+    try:
+        masks_db=env.open_db(b'masks',create=False)
+    except lmdb.NotFoundError:
+        masks_db=None
+    handle={'pid':os.getpid(),
+            'env':env,
+            'txn':env.begin(buffers=True),
+            'images':images_db,
+            'masks':masks_db}
+    _READ_HANDLES[key]=handle
+    return handle
+
+
 class LMDBRead():
-    def __init__(self, db_path, image_size):
+    """
+    lmdb patch reader. The environment and read transaction are
+    opened lazily and shared per process, so one reader can be
+    passed to forked workers (e.g DataLoader num_workers>0)
+    """
+    def __init__(self, db_path, image_size=None):
         self.db_path=db_path
-        self.env=lmdb.open(self.db_path,
-                           readonly=True,
-                           lock=False
-                           )
         self.image_size=image_size
 
 
+    @property
+    def env(self):
+        return _read_handle(self.db_path)['env']
+
+
+    @property
+    def txn(self):
+        return _read_handle(self.db_path)['txn']
+
+
     @property
     def num_keys(self):
-        with self.env.begin() as txn:
-            length = txn.stat()['entries']
-        return length
+        handle=_read_handle(self.db_path)
+        return handle['txn'].stat(handle['images'])['entries']
+
+
+    @property
+    def num_masks(self):
+        handle=_read_handle(self.db_path)
+        if handle['masks'] is None:
+            return 0
+        return handle['txn'].stat(handle['masks'])['entries']
+
+
+    def __len__(self):
+        return self.num_keys
 
 
     def __repr__(self):
@@ -71,17 +300,101 @@ class LMDBRead():
 
 
     def get_keys(self):
-        txn = self.env.begin()
-        keys = [k for k, _ in txn.cursor()]
-        #self.env.close()
+        handle=_read_handle(self.db_path)
+        cursor=handle['txn'].cursor(db=handle['images'])
+        keys=[bytes(k) for k in cursor.iternext(keys=True,values=False)]
         return keys
 
 
+    def _get(self,key,mask=False):
+        handle=_read_handle(self.db_path)
+        db=handle['masks'] if mask else handle['images']
+        if db is None:
+            raise KeyError('no masks database')
+        key=key.encode('ascii') if isinstance(key,str) else key
+        data=handle['txn'].get(key,db=db)
+        if data is None:
+            raise KeyError(key)
+        return decode_record(data)
+
+
+    def read_record(self,key):
+        """
+        read image and header metadata. Raw images are a
+        read-only view valid for the lifetime of the reader
+        :param key: str or bytes key
+        :return image: ndarray
+        :return meta: dict label,x,y,shape,dtype
+        """
+        return self._get(key)
+
+
     def read_image(self,key):
-        txn = self.env.begin()
-        data = txn.get(key)
-        image = pickle.loads(data)
-        image = np.frombuffer(image, dtype=np.uint8)
-        image = image.reshape(self.image_size)
+        image,_=self.read_record(key)
         return image
 
+
+    def read_mask(self,key):
+        mask,_=self._get(key,mask=True)
+        return mask
+
+
+    def close(self):
+        handle=_READ_HANDLES.pop(os.path.realpath(self.db_path),None)
+        if handle is not None and handle['pid']==os.getpid():
+            handle['env'].close()
+
+
+class LMDBDataset(Dataset):
+    """
+    torch dataset over an lmdb patch database. Arrays are copied
+    out of the read transaction so they can be collated into
+    tensors; each DataLoader worker opens its own transaction
+    :param db_path: lmdb directory
+    :param mask_flag: boolean return masks
+    :param transform: callable applied to (image,mask or label)
+    """
+    def __init__(self, db_path, mask_flag=True, transform=None):
+        self.reader=LMDBRead(db_path)
+        self.keys=self.reader.get_keys()
+        self.mask_flag=mask_flag
+        self.transform=transform
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def __getitem__(self,idx):
+        image,meta=self.reader.read_record(self.keys[idx])
+        image=np.array(image)
+        if self.mask_flag:
+            target=np.array(self.reader.read_mask(self.keys[idx]))
+        else:
+            target=meta['label']
+        if self.transform is not None:
+            image,target=self.transform(image,target)
+        return image, target
+
+
+def lmdb_dataloader(db_path,
+                    batch_size,
+                    num_workers=4,
+                    shuffle=True,
+                    mask_flag=True,
+                    transform=None):
+    """
+    multi-worker DataLoader with random access shuffling
+    :param db_path: lmdb directory
+    :param batch_size: batch size
+    :param num_workers: number of worker processes
+    :param shuffle: boolean shuffle every epoch
+    :return DataLoader
+    """
+    dataset=LMDBDataset(db_path,mask_flag,transform)
+    return DataLoader(dataset,
+                      batch_size=batch_size,
+                      shuffle=shuffle,
+                      num_workers=num_workers,
+                      persistent_workers=num_workers>0,
+                      pin_memory=True)
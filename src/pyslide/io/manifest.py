@@ -0,0 +1,132 @@
+"""
+manifest.py: append-only record of completed patches
+
+Sinks append a patch name once everything for that patch (image and
+mask) is durably written, and a final complete marker once the slide
+is done. Reruns skip names already in the manifest so interrupted
+jobs resume where they stopped rather than restarting the slide.
+"""
+
+import os
+
+COMPLETE='#complete'
+
+
+class Manifest():
+    def __init__(self, path):
+        self.path=path
+        self.completed=set()
+        self.complete=False
+        self._file=None
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    #a line without newline was cut off mid-write
+                    if not line.endswith('\n'):
+                        continue
+                    line=line[:-1]
+                    if line==COMPLETE:
+                        self.complete=True
+                    elif line:
+                        self.completed.add(line)
+
+
+    def __repr__(self):
+        return f'Manifest(path: {self.path}, completed: {len(self.completed)}, complete: {self.complete})'
+
+
+    def __len__(self):
+        return len(self.completed)
+
+
+    def __contains__(self,name):
+        return name in self.completed
+
+
+    @staticmethod
+    def is_complete(path):
+        """
+        check slide complete marker without loading names
+        :param path: manifest path
+        :return boolean
+        """
+        if not os.path.exists(path):
+            return False
+        with open(path,'rb') as f:
+            f.seek(max(0,os.path.getsize(path)-len(COMPLETE)-1))
+            return f.read().endswith((COMPLETE+'\n').encode())
+
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or '.',exist_ok=True)
+            self._file=open(self.path,'a')
+            #terminate a partial last line before appending
+            if self._file.tell()>0:
+                with open(self.path,'rb') as f:
+                    f.seek(-1,os.SEEK_END)
+                    if f.read(1)!=b'\n':
+                        self._file.write('\n')
+        return self._file
+
+
+    def add(self,name):
+        """
+        record completed patch
+        :param name: patch name
+        """
+        f=self._open()
+        f.write(name+'\n')
+        f.flush()
+        self.completed.add(name)
+
+
+    def mark_complete(self):
+        """
+        write slide complete marker and close
+        """
+        f=self._open()
+        f.write(COMPLETE+'\n')
+        f.flush()
+        os.fsync(f.fileno())
+        self.complete=True
+        self.close()
+
+
+    def retain(self,names):
+        """
+        rewrite the manifest keeping only names, e.g. after patches
+        recorded as done turn out to be missing from the output
+        :param names: names to keep
+        """
+        self.close()
+        names=self.completed&set(names)
+        if names!=self.completed:
+            self.complete=False
+        self.completed=names
+        tmp=self.path+'.tmp'
+        with open(tmp,'w') as f:
+            for name in sorted(names):
+                f.write(name+'\n')
+            if self.complete:
+                f.write(COMPLETE+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp,self.path)
+
+
+    def reset(self):
+        """
+        discard manifest to regenerate from scratch
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.completed=set()
+        self.complete=False
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file=None
@@ -0,0 +1,105 @@
+"""
+native_tiles.py: copy compressed tiles straight out of tiled TIFF/SVS
+slides
+
+When a patch covers exactly one tile of a JPEG compressed pyramid level
+the stored tile bytes can be written out without decoding. TIFF JPEG
+tiles are abbreviated streams sharing one JPEGTables tag, so the tables
+are spliced back in to make a standalone JPEG. Tiles stored as RGB
+rather than YCbCr get an Adobe APP14 marker (transform 0) so standard
+decoders do not apply a colour conversion.
+"""
+
+import os
+
+import tifffile
+
+JPEG=7
+#APP14 Adobe, version 100, flags 0, flags 0, transform 0 (no YCbCr)
+ADOBE_RGB=b'\xff\xee\x00\x0eAdobe\x00\x64\x00\x00\x00\x00\x00'
+
+
+class NativeTiles():
+    """
+    raw tile reader for one slide level
+    :param path: slide path
+    :param level: pyramid level
+    :param dims: expected (w,h) of level (openslide level_dimensions)
+    """
+    def __init__(self, path, level, dims):
+        self.path=path
+        self.level=level
+        self._tif=tifffile.TiffFile(path)
+        self._fd=os.open(path,os.O_RDONLY)
+        self.page=self._find_page(tuple(dims))
+        if self.page is not None:
+            self.tile_size=(self.page.tilewidth,self.page.tilelength)
+            self._across=-(-self.page.imagewidth//self.page.tilewidth)
+            self._prefix=b'\xff\xd8'
+            if self.page.photometric==tifffile.PHOTOMETRIC.RGB:
+                self._prefix+=ADOBE_RGB
+            if self.page.jpegtables:
+                self._prefix+=bytes(self.page.jpegtables)[2:-2]
+
+
+    def __repr__(self):
+        return f'NativeTiles(path: {self.path}, level: {self.level}, available: {self.available})'
+
+
+    def _find_page(self,dims):
+        """
+        tiled jpeg page matching level dimensions
+        :param dims: (w,h)
+        :return tifffile.TiffPage or None
+        """
+        pages=[l.keyframe for l in self._tif.series[0].levels]+list(self._tif.pages)
+        for page in pages:
+            if (page.imagewidth,page.imagelength)!=dims:
+                continue
+            if page.is_tiled and page.compression==JPEG and page.tiledepth==1:
+                return page
+        return None
+
+
+    @property
+    def available(self):
+        return self.page is not None
+
+
+    def aligned(self,size,step):
+        """
+        check patches map one to one onto native tiles
+        :param size: patch (w,h) at level
+        :param step: patch step at level
+        :return boolean
+        """
+        if not self.available:
+            return False
+        return tuple(size)==self.tile_size and step==size[0]
+
+
+    def read(self,x,y,downsample):
+        """
+        standalone jpeg for the tile at level 0 coordinates x,y
+        :param x: int x coordinate (level 0)
+        :param y: int y coordinate (level 0)
+        :param downsample: level downsample
+        :return bytes or None if not on the tile grid or an edge tile
+        """
+        tw,th=self.tile_size
+        lx,ly=x//downsample,y//downsample
+        if x%downsample or y%downsample or lx%tw or ly%th:
+            return None
+        if lx+tw>self.page.imagewidth or ly+th>self.page.imagelength:
+            return None
+        i=(ly//th)*self._across+lx//tw
+        offset,length=self.page.dataoffsets[i],self.page.databytecounts[i]
+        if length==0:
+            return None
+        data=os.pread(self._fd,length,offset)
+        return self._prefix+data[2:]
+
+
+    def close(self):
+        self._tif.close()
+        os.close(self._fd)
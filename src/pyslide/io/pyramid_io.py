@@ -0,0 +1,304 @@
+"""
+pyramid_io.py: write stitched slides and prediction canvases as
+multi-resolution tiled pyramids
+
+Two layouts are supported
+    dzi:  DeepZoom directory ({name}.dzi + {name}_files/{level}/{col}_{row}.{fmt})
+    tiff: tiled pyramidal BigTIFF with reduced levels stored as subifds
+Probability maps are written as tiff pyramids of uint8 (p*255) or
+float16 tiles with json metadata in the image description, and read
+back a region and level at a time with ProbabilityPyramid.
+Lower levels are built by streaming 2x area downsampling over strips of
+the level above into disk backed arrays, so only a strip of tiles is
+held in memory at any time. Inputs may themselves be np.memmap canvases.
+"""
+
+import os
+import json
+import math
+import tempfile
+
+import cv2
+import numpy as np
+import tifffile
+
+
+def temp_memmap(shape,dtype=np.uint8,path=None):
+    """
+    disk backed array. Without a path the backing file is a
+    temporary file unlinked once mapped
+    :param shape: array shape
+    :param dtype: array dtype
+    :param path: optional backing file path
+    :return np.memmap
+    """
+    if path is not None:
+        return np.memmap(path,dtype=dtype,mode='w+',shape=shape)
+    fd,tmp=tempfile.mkstemp(suffix='.mmap')
+    try:
+        array=np.memmap(tmp,dtype=dtype,mode='w+',shape=shape)
+    finally:
+        os.close(fd)
+        os.remove(tmp)
+    return array
+
+
+def _as_image(image):
+    """
+    drop batch and singleton channel axes, (1,H,W,1) -> (H,W)
+    """
+    if image.ndim==4:
+        image=image[0]
+    if image.ndim==3 and image.shape[2]==1:
+        image=image[:,:,0]
+    return image
+
+
+def downsample(image,strip=1024):
+    """
+    halve image with area interpolation one strip of rows at a time
+    :param image: ndarray or np.memmap (H,W) or (H,W,C)
+    :param strip: source rows per strip (even)
+    :return np.memmap (ceil(H/2),ceil(W/2)[,C])
+    """
+    h,w=image.shape[:2]
+    hn,wn=math.ceil(h/2),math.ceil(w/2)
+    out=temp_memmap((hn,wn)+image.shape[2:],image.dtype)
+    for r in range(0,h,strip):
+        src=np.ascontiguousarray(image[r:r+strip])
+        #cv2 has no float16 resize
+        if src.dtype==np.float16:
+            src=src.astype(np.float32)
+        rows=math.ceil(src.shape[0]/2)
+        out[r//2:r//2+rows]=cv2.resize(src,(wn,rows),interpolation=cv2.INTER_AREA).reshape((rows,wn)+image.shape[2:])
+    out.flush()
+    return out
+
+
+class DeepZoomWrite():
+    """
+    write image as DeepZoom tile pyramid
+    :param path: output directory
+    :param name: slide name
+    :param tile_size: tile edge in pixels
+    :param overlap: pixels shared with neighbouring tiles
+    :param fmt: tile format png or jpeg
+    :param quality: jpeg quality
+    :param bgr: input channels are BGR (cv2) rather than RGB
+    """
+    def __init__(self, path, name, tile_size=254, overlap=1, fmt='png', quality=90, bgr=False):
+        self.path=path
+        self.name=name
+        self.tile_size=tile_size
+        self.overlap=overlap
+        self.fmt=fmt
+        self.quality=quality
+        self.bgr=bgr
+        self.tile_path=os.path.join(path,name+'_files')
+
+
+    def __repr__(self):
+        return f'DeepZoomWrite(path: {self.path}, name: {self.name})'
+
+
+    def _write_level(self,image,level):
+        """
+        write all tiles of one level, reading one row of tiles at a time
+        """
+        level_path=os.path.join(self.tile_path,str(level))
+        os.makedirs(level_path,exist_ok=True)
+        h,w=image.shape[:2]
+        t,o=self.tile_size,self.overlap
+        params=[cv2.IMWRITE_JPEG_QUALITY,self.quality] if self.fmt=='jpeg' else []
+        for row in range(math.ceil(h/t)):
+            y0,y1=max(0,row*t-o),min(h,(row+1)*t+o)
+            strip=np.asarray(image[y0:y1])
+            if strip.ndim==3 and not self.bgr:
+                strip=cv2.cvtColor(strip,cv2.COLOR_RGB2BGR)
+            for col in range(math.ceil(w/t)):
+                x0,x1=max(0,col*t-o),min(w,(col+1)*t+o)
+                tile_name=f'{col}_{row}.{self.fmt}'
+                cv2.imwrite(os.path.join(level_path,tile_name),strip[:,x0:x1],params)
+
+
+    def _write_dzi(self,w,h):
+        xml=('<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+             f'Format="{self.fmt}" Overlap="{self.overlap}" TileSize="{self.tile_size}">\n'
+             f'  <Size Width="{w}" Height="{h}"/>\n'
+             '</Image>\n')
+        with open(os.path.join(self.path,self.name+'.dzi'),'w') as f:
+            f.write(xml)
+
+
+    def write(self,image):
+        """
+        write full resolution level then each halved level down to 1x1
+        :param image: ndarray or np.memmap (H,W), (H,W,C) or (1,H,W,C)
+        :return number of levels
+        """
+        image=_as_image(image)
+        h,w=image.shape[:2]
+        os.makedirs(self.path,exist_ok=True)
+        num_levels=math.ceil(math.log2(max(h,w)))+1
+        level=image
+        for l in reversed(range(num_levels)):
+            print(f'\r- level {l} {level.shape[1]}x{level.shape[0]}', end='\r')
+            self._write_level(level,l)
+            if l>0:
+                level=downsample(level,2*self.tile_size)
+        self._write_dzi(w,h)
+        return num_levels
+
+
+def write_tiff(image,path,tile_size=256,compression='zlib',min_size=None,bgr=False,description=None):
+    """
+    write image as tiled pyramidal BigTIFF. Reduced levels are
+    stored as subifds of the full resolution page
+    :param image: ndarray or np.memmap (H,W), (H,W,C) or (1,H,W,C)
+    :param path: output tiff path
+    :param tile_size: tile edge in pixels (multiple of 16)
+    :param compression: tifffile compression (zlib, jpeg, None)
+    :param min_size: stop once the largest edge is at most this
+    :param bgr: input channels are BGR (cv2) rather than RGB
+    :param description: optional image description of the first page
+    :return number of levels
+    """
+    image=_as_image(image)
+    min_size=tile_size if min_size is None else min_size
+    h,w=image.shape[:2]
+    num_levels=1
+    while max(math.ceil(h/2**(num_levels-1)),math.ceil(w/2**(num_levels-1)))>min_size:
+        num_levels+=1
+    photometric='rgb' if image.ndim==3 else 'minisblack'
+
+    def tiles(level):
+        lh,lw=level.shape[:2]
+        for r in range(0,lh,tile_size):
+            strip=np.asarray(level[r:r+tile_size])
+            if strip.ndim==3 and bgr:
+                strip=strip[:,:,::-1]
+            for c in range(0,lw,tile_size):
+                tile=np.zeros((tile_size,tile_size)+level.shape[2:],level.dtype)
+                t=strip[:,c:c+tile_size]
+                tile[:t.shape[0],:t.shape[1]]=t
+                yield tile
+
+    with tifffile.TiffWriter(path,bigtiff=True) as tif:
+        level=image
+        for l in range(num_levels):
+            options={'subifds':num_levels-1} if l==0 else {'subfiletype':1}
+            if l==0 and description is not None:
+                options.update({'description':description,'metadata':None})
+            tif.write(tiles(level),
+                      shape=level.shape,
+                      dtype=level.dtype,
+                      tile=(tile_size,tile_size),
+                      photometric=photometric,
+                      compression=compression,
+                      **options)
+            if l<num_levels-1:
+                level=downsample(level,2*tile_size)
+    return num_levels
+
+
+def write_probability_pyramid(prob,path,dtype='uint8',tile_size=256,metadata=None,strip=1024):
+    """
+    write a probability map as a quantized tiled tiff pyramid
+    :param prob: float probabilities in [0,1], ndarray or np.memmap
+        (H,W) or (1,H,W,1)
+    :param path: output tiff path
+    :param dtype: uint8 (stored as p*255) or float16
+    :param tile_size: tile edge in pixels
+    :param metadata: optional dict stored with the pyramid
+    :return number of levels
+    """
+    prob=_as_image(prob)
+    if dtype=='uint8':
+        scale=255
+    elif dtype=='float16':
+        scale=1
+    else:
+        raise ValueError(f'unknown probability dtype {dtype}')
+    h,w=prob.shape
+    quantized=temp_memmap((h,w),dtype)
+    for r in range(0,h,strip):
+        p=np.clip(np.asarray(prob[r:r+strip],np.float32),0,1)
+        quantized[r:r+strip]=np.rint(p*scale) if scale==255 else p
+    meta=dict(metadata or {})
+    meta.update({'kind':'probability','dtype':dtype,'scale':scale})
+    return write_tiff(quantized,path,tile_size,description=json.dumps(meta))
+
+
+class ProbabilityPyramid():
+    """
+    read regions of a probability pyramid written by
+    write_probability_pyramid. Only the tiles overlapping a
+    region are decoded
+    :param path: tiff path
+    """
+    def __init__(self, path):
+        self.path=path
+        self._tif=tifffile.TiffFile(path)
+        self.metadata=json.loads(self._tif.pages[0].description)
+        self.scale=self.metadata['scale']
+        self.level_dimensions=[(l.shape[1],l.shape[0]) for l in self._tif.series[0].levels]
+
+
+    def __repr__(self):
+        return f'ProbabilityPyramid(path: {self.path}, levels: {len(self.level_dimensions)})'
+
+
+    @property
+    def dims(self):
+        return self.level_dimensions[0]
+
+
+    def raw(self,x=0,y=0,w=None,h=None,level=0):
+        """
+        quantized values of a region at level, decoding only the
+        tiles it overlaps
+        :param x,y: top left at level
+        :param w,h: region size (default and clipped to the level edge)
+        :return (h,w) uint8 or float16
+        """
+        lw,lh=self.level_dimensions[level]
+        w=lw-x if w is None else min(w,lw-x)
+        h=lh-y if h is None else min(h,lh-y)
+        page=self._tif.series[0].levels[level].pages[0]
+        tw,th=page.tilewidth,page.tilelength
+        cols=math.ceil(lw/tw)
+        out=np.zeros((h,w),page.dtype)
+        fh=self._tif.filehandle
+        for row in range(y//th,(y+h-1)//th+1):
+            for col in range(x//tw,(x+w-1)//tw+1):
+                i=row*cols+col
+                fh.seek(page.dataoffsets[i])
+                tile=page.decode(fh.read(page.databytecounts[i]),i)[0].reshape(th,tw)
+                ty,tx=row*th,col*tw
+                y0,x0=max(y,ty),max(x,tx)
+                y1,x1=min(y+h,ty+th),min(x+w,tx+tw)
+                out[y0-y:y1-y,x0-x:x1-x]=tile[y0-ty:y1-ty,x0-tx:x1-tx]
+        return out
+
+
+    def read(self,x=0,y=0,w=None,h=None,level=0):
+        """
+        probabilities of a region at level
+        :param x,y: top left at level
+        :param w,h: region size (default to the level edge)
+        :return float32 (h,w)
+        """
+        return self.raw(x,y,w,h,level).astype(np.float32)/self.scale
+
+
+    def threshold(self,threshold,x=0,y=0,w=None,h=None,level=0):
+        """
+        binary mask of a region at level
+        :return uint8 (h,w)
+        """
+        return (self.read(x,y,w,h,level)>threshold).astype(np.uint8)
+
+
+    def close(self):
+        self._tif.close()
@@ -0,0 +1,104 @@
+"""
+slot_pool.py: fixed pool of shared memory patch slots for handing
+decoded patches between processes without pickling
+
+Producers acquire a free slot, write the patch into its array view and
+publish (slot, meta). Consumers get the slot, read the array in place
+and release it when done; only then can a producer reuse the slot, so
+a slot is never overwritten while it is being read. Only slot indices
+and small metadata go through the queues.
+
+The buffer is a multiprocessing.shared_memory block where available
+(python>=3.8) and otherwise an anonymous shared mmap; both are
+inherited by processes forked after the pool is created.
+"""
+
+import mmap
+import multiprocessing as mp
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory=None
+
+
+class SlotPool():
+    """
+    :param num_slots: number of slots
+    :param shape: shape of one slot e.g (h,w,3)
+    :param dtype: slot dtype
+    :param ctx: multiprocessing context used to create queues
+    """
+    def __init__(self, num_slots, shape, dtype=np.uint8, ctx=None):
+        ctx=mp.get_context('fork') if ctx is None else ctx
+        self.num_slots=num_slots
+        self.shape=tuple(shape)
+        self.dtype=np.dtype(dtype)
+        self.slot_bytes=int(np.prod(self.shape))*self.dtype.itemsize
+        size=self.slot_bytes*num_slots
+        if shared_memory is not None:
+            self._shm=shared_memory.SharedMemory(create=True,size=size)
+            self._buffer=self._shm.buf
+        else:
+            self._shm=None
+            self._buffer=mmap.mmap(-1,size)
+        self._arrays=np.ndarray((num_slots,)+self.shape,self.dtype,buffer=self._buffer)
+        self._free=ctx.Queue()
+        self._ready=ctx.Queue()
+        for slot in range(num_slots):
+            self._free.put(slot)
+
+
+    def __repr__(self):
+        return f'SlotPool(slots: {self.num_slots}, shape: {self.shape})'
+
+
+    def array(self,slot):
+        """
+        array view of slot (no copy)
+        """
+        return self._arrays[slot]
+
+
+    def acquire(self,timeout=None):
+        """
+        block until a slot is free
+        :return slot index
+        """
+        return self._free.get(timeout=timeout)
+
+
+    def publish(self,slot,meta=None):
+        """
+        hand a filled slot to consumers
+        :param slot: slot index
+        :param meta: small picklable metadata
+        """
+        self._ready.put((slot,meta))
+
+
+    def get(self,timeout=None):
+        """
+        next published slot
+        :return slot, meta
+        """
+        return self._ready.get(timeout=timeout)
+
+
+    def release(self,slot):
+        """
+        acknowledge slot has been consumed so it can be reused
+        """
+        self._free.put(slot)
+
+
+    def close(self):
+        del self._arrays
+        if self._shm is not None:
+            self._buffer=None
+            self._shm.close()
+            self._shm.unlink()
+        else:
+            self._buffer.close()
@@ -0,0 +1,170 @@
+"""
+zarr_io.py: read and write patches to a chunked zarr array store
+
+One group per slide holding
+    images: (N,H,W,C) uint8, one chunk per patch, blosc/zstd compressed
+    masks:  (N,H,W) uint8, optional, same chunking
+    coords: (N,2) int64 x,y level 0 coordinates
+    labels: (N,) int32 patch labels (-1 if missing)
+The coords and labels tables are small and held in memory by the
+reader so label/region sampling never touches the image chunks.
+"""
+
+import os
+
+import numpy as np
+import zarr
+from numcodecs import Blosc
+
+from pyslide.io.manifest import Manifest
+
+
+class ZarrWrite():
+    def __init__(self,
+                 db_path,
+                 clevel=5,
+                 shuffle=Blosc.BITSHUFFLE):
+        self.db_path=db_path
+        self.compressor=Blosc(cname='zstd',clevel=clevel,shuffle=shuffle)
+        self.root=zarr.open_group(self.db_path,mode='a')
+
+
+    def __repr__(self):
+        return f'ZarrWrite(path: {self.db_path})'
+
+
+    def _print_progress(self,i,total):
+        complete = float(i)/total
+        print(f'\r- Progress: {complete:.1%}', end='\r')
+
+
+    def _create(self,group,name,shape,dtype,resume=False):
+        if resume and name in group and group[name].shape==shape:
+            return group[name]
+        return group.create_dataset(name,
+                                    shape=shape,
+                                    chunks=(1,)+shape[1:],
+                                    dtype=dtype,
+                                    compressor=self.compressor,
+                                    overwrite=True)
+
+
+    def write(self,patch,mask_flag=False,resume=True):
+        """
+        write all patches (and masks) of Patch object to
+        group named after the slide. Completed patches are tracked
+        in {name}_manifest.txt so interrupted writes resume
+        :param patch: pyslide.patching.Patch object
+        :param mask_flag: boolean write masks
+        :param resume: skip patches already in the manifest
+        """
+        name=patch.slide.name
+        manifest=Manifest(os.path.join(self.db_path,name+'_manifest.txt'))
+        if not resume:
+            manifest.reset()
+        num=len(patch._patches)
+        w,h=patch.size
+        group=self.root.require_group(name)
+        images=self._create(group,'images',(num,h,w,3),np.uint8,resume)
+        if mask_flag:
+            masks=self._create(group,'masks',(num,h,w),np.uint8,resume)
+        coords=np.array([[p['x'],p['y']] for p in patch._patches],dtype=np.int64)
+        labels=[p.get('label',-1) for p in patch._patches]
+        labels=np.array([-1 if l!=l else l for l in labels],dtype=np.int32)
+        group.array('coords',coords,overwrite=True)
+        group.array('labels',labels,overwrite=True)
+        group.attrs.update({'size':list(patch.size),
+                            'mag_level':patch.mag_level,
+                            'step':patch.step,
+                            'names':[p['name'] for p in patch._patches]})
+
+        position={p['name']:i for i,p in enumerate(patch._patches)}
+        skip=set(manifest.completed)
+        for image, p in patch.extract_patches(skip=skip):
+            i=position[p['name']]
+            images[i]=image
+            if mask_flag:
+                masks[i]=patch.extract_mask(p['x'],p['y'])
+            manifest.add(p['name'])
+            self._print_progress(i,num)
+        manifest.mark_complete()
+        return num
+
+
+class ZarrRead():
+    """
+    random access reader for a single slide group
+    :param db_path: zarr store path
+    :param name: slide name (group)
+    """
+    def __init__(self, db_path, name):
+        self.db_path=db_path
+        self.name=name
+        self.group=zarr.open_group(db_path,mode='r')[name]
+        self.images=self.group['images']
+        self.masks=self.group['masks'] if 'masks' in self.group else None
+        self.coords=self.group['coords'][:]
+        self.labels=self.group['labels'][:]
+
+
+    def __len__(self):
+        return self.images.shape[0]
+
+
+    def __repr__(self):
+        return f'ZarrRead(path: {self.db_path}, name: {self.name}, n: {len(self)})'
+
+
+    @property
+    def names(self):
+        return self.group.attrs['names']
+
+
+    def read_batch(self,idx,mask_flag=False):
+        """
+        read arbitrary patch indices in one vectorized selection
+        :param idx: int array of patch indices
+        :param mask_flag: boolean also return masks
+        :return images: ndarray (len(idx),H,W,C)
+        :return masks: ndarray (len(idx),H,W) if mask_flag
+        """
+        idx=np.asarray(idx,dtype=np.int64)
+        order=np.argsort(idx)
+        inverse=np.empty_like(order)
+        inverse[order]=np.arange(len(idx))
+        images=self.images.get_orthogonal_selection(idx[order])[inverse]
+        if not mask_flag:
+            return images
+        masks=self.masks.get_orthogonal_selection(idx[order])[inverse]
+        return images, masks
+
+
+    def select(self,label=None,region=None):
+        """
+        indices of patches by label and/or region using only
+        the in-memory tables
+        :param label: int label or list of labels
+        :param region: [[xmin,xmax],[ymin,ymax]]
+        :return idx: int array of patch indices
+        """
+        keep=np.ones(len(self),dtype=bool)
+        if label is not None:
+            keep&=np.isin(self.labels,np.atleast_1d(label))
+        if region is not None:
+            (xmin,xmax),(ymin,ymax)=region
+            x,y=self.coords[:,0],self.coords[:,1]
+            keep&=(x>=xmin)&(x<xmax)&(y>=ymin)&(y<ymax)
+        return np.flatnonzero(keep)
+
+
+    def sample(self,n,label=None,region=None,replacement=False,mask_flag=False):
+        """
+        randomly sample n patches by label and/or region
+        :param n: number of patches
+        :return images (and masks), idx
+        """
+        idx=self.select(label,region)
+        if not replacement:
+            n=min(n,len(idx))
+        idx=np.random.choice(idx,n,replace=replacement)
+        return self.read_batch(idx,mask_flag), idx
@@ -11,9 +11,11 @@ and will stitch tiles to form entire slide or mask representation.
 """
 
 import os
-import glob
 import json
 import random
+import queue
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import cv2
@@ -26,26 +28,70 @@ import seaborn as sns
 from itertools import chain
 import operator as op
 
-from pyslide.util.utilities import mask2rgb
+from pyslide.util.utilities import mask2rgb, curve_order
 from pyslide.exceptions import StitchingMissingPatches
 from pyslide.analysis.filters import image_entropy
 from pyslide.io.lmdb_io import LMDBWrite
 from pyslide.io.tfrecords_io import TFRecordWrite
+from pyslide.io.zarr_io import ZarrWrite
+from pyslide.io.archive_io import ArchiveWrite
+from pyslide.io.manifest import Manifest
+from pyslide.io.slot_pool import SlotPool
+from pyslide.slide import Slide
+from pyslide.io.pyramid_io import DeepZoomWrite, write_tiff, temp_memmap
 
 __author__='Gregory Verghese'
 __email__='gregory.verghese@gmail.com'
 
 
+PNG_END=b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+
+def _png_complete(path):
+    """
+    check a png file ends with the IEND chunk
+    """
+    try:
+        with open(path,'rb') as f:
+            f.seek(-len(PNG_END),os.SEEK_END)
+            return f.read()==PNG_END
+    except OSError:
+        return False
+
+
+def _extract_worker(pool,tasks,path,mag,filter_mask,mag_level,size):
+    """
+    patch extraction process: opens its own slide handle and
+    decodes each patch into a free slot of the pool
+    """
+    try:
+        slide=Slide(path,mag=mag,filter_mask=filter_mask)
+        while True:
+            task=tasks.get()
+            if task is None:
+                break
+            i,x,y=task
+            region,_=slide.get_filtered_region((x,y),mag_level,size)
+            slot=pool.acquire()
+            pool.array(slot)[:]=region
+            pool.publish(slot,i)
+        pool.publish(None,None)
+    except Exception as e:
+        pool.publish(None,repr(e))
+
+
 class Patch():
     def __init__(self, 
                  slide, 
                  size, 
                  mag_level=0,
                  border=None,  
-                 step=None):
+                 step=None,
+                 workers=0):
 
         super().__init__()
         self.slide = slide
+        self.workers = workers
         self.mag_level = mag_level
         self.size = size
         self.border = slide._border if border is None else border
@@ -100,7 +146,7 @@ class Patch():
 
     @patches.setter
     def patches(self,value):
-        self._patches=patches
+        self._patches=value
 
 
     @property
@@ -157,12 +203,16 @@ class Patch():
 
     def generate_patches(self, 
                          step, 
-                         edge_cases=False):
+                         edge_cases=False,
+                         order='row'):
         """
         generate patch coordinates based on mag,step and size
         :param step: integer: step size
         :param mode: sparse or focus
         :param mask_flag: include masks
+        :param order: traversal order row (x then y), morton or
+            hilbert. Curve orders keep consecutive patches close
+            together on the slide so tile caches are reused
         :return len(self._patches): Number of patches
         """
         self.step=step
@@ -178,7 +228,108 @@ class Patch():
                     continue
             self._patches.append({'name':name,'x':x,'y':y})
 
+        self.order(order)
+        self._number=len(self._patches)
+        return self._number
+
+
+    def order(self, order='row'):
+        """
+        reorder patches along a space filling curve over the grid
+        :param order: row, morton or hilbert
+        """
+        step=self.step*self._downsample
+        cells=[((p['x']-self._x_min)//step,(p['y']-self._y_min)//step)
+               for p in self._patches]
+        self._patches=[self._patches[i] for i in curve_order(cells,order)]
+
+
+    def _thumbnail_maps(self, downsample=32):
+        """
+        low resolution tissue and label maps used to describe
+        grid cells without reading patches
+        :param downsample: target downsample of the maps
+        :return tissue: bool ndarray
+        :return labels: uint8 ndarray or None without annotations
+        :return ds: actual downsample of the maps
+        """
+        level=self.slide.get_best_level_for_downsample(downsample)
+        ds=self.slide.level_downsamples[level]
+        dims=self.slide.level_dimensions[level]
+        thumb=np.array(self.slide.read_region((0,0),level,dims).convert('RGB'))
+        sat=cv2.cvtColor(thumb,cv2.COLOR_RGB2HSV)[:,:,1]
+        _,tissue=cv2.threshold(sat,0,255,cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+        labels=None
+        if self.slide.annotations is not None:
+            labels=self.slide.generate_mask(downsample=int(ds))
+        return tissue>0, labels, ds
+
+
+    def sample(self,
+               n,
+               step=None,
+               tissue_bins=(0.25,0.5,0.75),
+               min_tissue=0.0,
+               seed=None):
+        """
+        draw a fixed budget of patches stratified by label and
+        tissue fraction. Grid cells are generated lazily and each
+        stratum keeps a reservoir of at most n cells, so the full
+        grid is never materialized. The budget is split evenly
+        across strata and any share a small stratum cannot fill
+        goes to the others
+        :param n: number of patches
+        :param step: step size (defaults to self.step)
+        :param tissue_bins: tissue fraction bin edges
+        :param min_tissue: skip cells below this tissue fraction
+        :param seed: random seed
+        :return len(self._patches): number sampled
+        """
+        rng=random.Random(seed)
+        self.step=self.step if step is None else step
+        tissue,labels,ds=self._thumbnail_maps()
+        w=max(1,int(self.size[0]*self._downsample/ds))
+        h=max(1,int(self.size[1]*self._downsample/ds))
+
+        reservoirs={}
+        seen={}
+        for x, y in self._patching(self.step*self._downsample):
+            tx,ty=int(x/ds),int(y/ds)
+            cell=tissue[ty:ty+h,tx:tx+w]
+            fraction=float(cell.mean()) if cell.size else 0.0
+            if fraction<min_tissue:
+                continue
+            p={'name':self.slide.name+'_'+str(x)+'_'+str(y),'x':x,'y':y,
+               'tissue':fraction}
+            key=(int(np.digitize(fraction,tissue_bins)),)
+            if labels is not None:
+                cls,cnts=np.unique(labels[ty:ty+h,tx:tx+w],return_counts=True)
+                if len(cls)>1 and cls[0]==0:
+                    cls,cnts=cls[1:],cnts[1:]
+                p['label']=int(cls[np.argmax(cnts)]) if len(cls) else 0
+                key=(p['label'],)+key
+            seen[key]=seen.get(key,0)+1
+            reservoir=reservoirs.setdefault(key,[])
+            if len(reservoir)<n:
+                reservoir.append(p)
+            else:
+                j=rng.randrange(seen[key])
+                if j<n:
+                    reservoir[j]=p
+
+        #even split with leftovers passed to larger strata
+        quota={}
+        remaining=n
+        keys=sorted(reservoirs,key=lambda k: len(reservoirs[k]))
+        for i, k in enumerate(keys):
+            quota[k]=min(len(reservoirs[k]),remaining//(len(keys)-i))
+            remaining-=quota[k]
+        self._patches=list(chain(*[rng.sample(reservoirs[k],quota[k]) for k in keys]))
+        self._labels=[p.get('label',np.nan) for p in self._patches]
         self._number=len(self._patches)
+        print(pd.DataFrame({'stratum':keys,
+                            'available':[seen[k] for k in keys],
+                            'sampled':[quota[k] for k in keys]}))
         return self._number
 
 
@@ -334,18 +485,140 @@ class Patch():
         return patch
 
 
-    def extract_patches(self):
+    def extract_patches(self,skip=None):
         """
-        generator to extract all patches
+        generator to extract all patches. With self.workers>0
+        patches are read by worker processes (see
+        extract_patches_shared) and arrive out of order
+        :param skip: optional set of patch names not to extract
         :yield patch: ndarray patch
         :yield p: patch dict metadata
         """
+        if self.workers>0:
+            yield from self.extract_patches_shared(skip,self.workers)
+            return
         #print(self._patches)
         for p in self._patches:
+            if skip is not None and p['name'] in skip:
+                continue
             patch=self.extract_patch(p['x'],p['y'])
             yield patch, p
 
 
+    def extract_patches_shared(self,skip=None,workers=4,num_slots=None):
+        """
+        extract patches in worker processes that decode straight
+        into a shared memory slot pool. Only slot indices are sent
+        between processes. The yielded array is a view of the slot
+        and the slot is released (acknowledged) when the next patch
+        is requested, so copy it if it must outlive the iteration
+        :param skip: optional set of patch names not to extract
+        :param workers: number of worker processes
+        :param num_slots: slots in the pool (default 2*workers)
+        :yield patch: ndarray view (h,w,3)
+        :yield p: patch dict metadata
+        """
+        ctx=mp.get_context('fork')
+        num_slots=2*workers if num_slots is None else num_slots
+        pool=SlotPool(num_slots,(self.size[1],self.size[0],3),np.uint8,ctx)
+        tasks=ctx.Queue()
+        for i, p in enumerate(self._patches):
+            if skip is None or p['name'] not in skip:
+                tasks.put((i,p['x'],p['y']))
+        for _ in range(workers):
+            tasks.put(None)
+        args=(pool,tasks,self.slide.path,self.slide.mag,self.slide.filter_mask,
+              self.mag_level,tuple(self.size))
+        procs=[ctx.Process(target=_extract_worker,args=args,daemon=True)
+               for _ in range(workers)]
+        for proc in procs:
+            proc.start()
+        finished=0
+        try:
+            while finished<workers:
+                #a worker killed hard (segfault, oom killer) never
+                #publishes its sentinel, so poll and check exit codes
+                try:
+                    slot,i=pool.get(timeout=1)
+                except queue.Empty:
+                    codes=[proc.exitcode for proc in procs]
+                    failed=[c for c in codes if c not in (None,0)]
+                    if failed:
+                        raise RuntimeError(f'patch extraction worker exited with code {failed[0]}')
+                    if None not in codes:
+                        raise RuntimeError('patch extraction workers exited without finishing')
+                    continue
+                if slot is None:
+                    if i is not None:
+                        raise RuntimeError(f'patch extraction worker failed: {i}')
+                    finished+=1
+                    continue
+                yield pool.array(slot), self._patches[i]
+                pool.release(slot)
+        finally:
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+                proc.join()
+            pool.close()
+
+
+    def extract_context(self, x, y, scales=(1,4)):
+        """
+        extract concentric patches centred on the grid cell at
+        several magnifications. Each scale s covers s times the
+        field of view of the patch and is resized to patch size.
+        Scales sharing a pyramid level are cropped from one read
+        of that level (the nearest level at or above the resolution
+        needed). The slide filter mask is not applied
+        :param x: int x coordinate
+        :param y: int y coordinate
+        :param scales: field of view multiples e.g (1,4) for
+            10x patches with a 2.5x surround
+        :return patches: ndarray (len(scales),h,w,3)
+        """
+        w,h=self.size
+        cx=x+w*self._downsample/2
+        cy=y+h*self._downsample/2
+        levels={}
+        for s in scales:
+            level=self.slide.get_best_level_for_downsample(self._downsample*s+1e-6)
+            levels.setdefault(level,[]).append(s)
+
+        views={}
+        for level, group in levels.items():
+            level_ds=self.slide.level_downsamples[level]
+            s_max=max(group)
+            rw=int(np.ceil(w*self._downsample*s_max/level_ds))
+            rh=int(np.ceil(h*self._downsample*s_max/level_ds))
+            x0=int(round(cx-rw*level_ds/2))
+            y0=int(round(cy-rh*level_ds/2))
+            region=np.array(self.slide.read_region((x0,y0),level,(rw,rh)).convert('RGB'))
+            for s in group:
+                cw=int(round(w*self._downsample*s/level_ds))
+                ch=int(round(h*self._downsample*s/level_ds))
+                ox,oy=(rw-cw)//2,(rh-ch)//2
+                view=region[oy:oy+ch,ox:ox+cw]
+                if (cw,ch)!=(w,h):
+                    view=cv2.resize(view,(w,h),interpolation=cv2.INTER_AREA)
+                views[s]=view
+        return np.stack([views[s] for s in scales])
+
+
+    def extract_contexts(self, scales=(1,4), skip=None):
+        """
+        generator to extract context stacks for all patches
+        :param scales: field of view multiples
+        :param skip: optional set of patch names not to extract
+        :yield patches: ndarray (len(scales),h,w,3)
+        :yield p: patch dict metadata
+        """
+        for p in self._patches:
+            if skip is not None and p['name'] in skip:
+                continue
+            yield self.extract_context(p['x'],p['y'],scales), p
+
+
     def extract_mask(self, x=None, y=None):
         """
         extract binary mask corresponding to patch
@@ -400,6 +673,27 @@ class Patch():
         return status
    
     
+    def _saved_names(self,path,mask_flag=False):
+        """
+        names of patches already saved under path. Only complete
+        pngs count: a file cut off mid-write has no IEND chunk
+        :param path: save path
+        :param mask_flag: mask and viewable pngs are required too
+        :return list of names
+        """
+        dirs=['images']+(['masks','viewable'] if mask_flag else [])
+        listed=[]
+        for d in dirs:
+            d=os.path.join(path,d)
+            listed.append(set(os.listdir(d)) if os.path.isdir(d) else set())
+        names=[]
+        for p in self._patches:
+            files=[os.path.join(path,d,p['name']+'.png') for d in dirs]
+            if all(p['name']+'.png' in l for l in listed) and all(map(_png_complete,files)):
+                names.append(p['name'])
+        return names
+
+
     def save_mask(self,path,dir_name):
 
         mask_generator=self.extract_masks()
@@ -414,48 +708,115 @@ class Patch():
              path, 
              mask_flag=False, 
              label_dir=False, 
-             label_csv=False):
+             label_csv=False,
+             resume=True):
         """
-        object save method. saves down all patches
+        object save method. saves down all patches. Completed
+        patches are appended to path/manifest.txt so an interrupted
+        save resumes from the first missing patch
         :param path: save path
         :param masK_flag: boolean to save masks
         :param label_dir: label directory
         :param label_csv: boolean to save labels in csv
+        :param resume: skip patches already in the manifest
         """
         #print("saving patch")
         patch_path=os.path.join(path,'images')
         os.makedirs(patch_path,exist_ok=True)
         filename=self.slide.name
+        manifest_path=os.path.join(path,'manifest.txt')
+        seed=resume and not os.path.exists(manifest_path)
+        manifest=Manifest(manifest_path)
+        if not resume:
+            manifest.reset()
+        elif seed:
+            #patches saved before manifests were written (or before
+            #the first manifest entry) are recorded from the disk
+            for name in self._saved_names(path,mask_flag):
+                manifest.add(name)
 
-        for patch,p in self.extract_patches():
-            if label_dir:
-                 patch_path=os.path.join(patch_path,patch['labels'])
-            self._save_disk(patch,patch_path,filename,p['x'],p['y'])
         if mask_flag:
-            mask_generator=self.extract_masks()
             mask_path=os.path.join(path,'masks')
             view_path=os.path.join(path,'viewable')
             os.makedirs(mask_path,exist_ok=True)
             os.makedirs(view_path,exist_ok=True)
-            
-            if label_dir:
-                patch_path=os.path.join(path_path,patch['labels'])
-            for mask,m in self.extract_masks():
-                self._save_disk(mask,mask_path,filename,m['x'],m['y'])
-                self._save_disk((mask*255),view_path,filename,m['x'],m['y'])
 
+        for patch,p in self.extract_patches(skip=manifest.completed):
+            if label_dir:
+                 patch_path=os.path.join(patch_path,patch['labels'])
+            self._save_disk(patch,patch_path,filename,p['x'],p['y'])
+            if mask_flag:
+                mask=self.extract_mask(p['x'],p['y'])
+                self._save_disk(mask,mask_path,filename,p['x'],p['y'])
+                self._save_disk((mask*255),view_path,filename,p['x'],p['y'])
+            manifest.add(p['name'])
 
         if label_csv:
             df=pd.DataFrame(self._patches,columns=['names','x','y','labels'])
             df.to_csv(os.path.join(path,'labels.csv'))
+        manifest.mark_complete()
 
 
-    def to_lmdb(self, db_path, write_frequency=100):
-        size_estimate=len(self._patches)*self.size[0]*self.size[1]*3
-        db_write=LMDBWrite(db_path,size_estimate,write_frequency)
-        db_write.write(self)
+    def to_lmdb(self,
+                db_path,
+                write_frequency=100,
+                mask_flag=False,
+                codec='raw',
+                resume=True,
+                context=None):
+        """
+        write patches to lmdb. map size starts at the raw
+        patch size estimate and grows if the database fills
+        :param db_path: lmdb directory
+        :param write_frequency: records per transaction
+        :param mask_flag: boolean write masks
+        :param codec: raw or png image encoding
+        :param resume: skip patches already in the manifest
+        :param context: optional scales, store (K,h,w,3) context
+            stacks from extract_context as one record per patch
+        """
+        num_views=1 if context is None else len(context)
+        size_estimate=len(self._patches)*self.size[0]*self.size[1]*3*num_views
+        db_write=LMDBWrite(db_path,size_estimate,write_frequency,codec)
+        db_write.write(self,mask_flag,resume,context)
             
 
+    def to_zarr(self,
+                db_path,
+                mask_flag=False,
+                clevel=5,
+                resume=True):
+        """
+        write patches to a chunked zarr group named after the
+        slide with aligned coords and labels arrays
+        :param db_path: zarr store path
+        :param mask_flag: boolean write masks
+        :param clevel: zstd compression level
+        :param resume: skip patches already in the manifest
+        """
+        ZarrWrite(db_path,clevel).write(self,mask_flag,resume)
+
+
+    def to_archive(self,
+                   path,
+                   mask_flag=False,
+                   shard_size=2e9,
+                   resume=True,
+                   passthrough=False):
+        """
+        write patches to packed tar shards with an offset
+        index instead of one png per patch
+        :param path: archive directory
+        :param mask_flag: boolean write masks
+        :param shard_size: max shard size in bytes
+        :param resume: skip patches already in the manifest
+        :param passthrough: copy native jpeg tiles when patches
+            are aligned to the slide tile grid
+        """
+        writer=ArchiveWrite(path,self.slide.name,shard_size,resume)
+        writer.write(self,mask_flag,passthrough)
+
+
     def to_tfrecords(self, 
                      db_path,
                      shard_size=0.01,
@@ -467,8 +828,18 @@ class Patch():
 
 
 class Stitching():
+    """
+    stitch patches named {name}_{x}_{y}.{ext} from a directory or
+    archive. The listing is parsed once into a coordinate index and
+    patches are decoded in parallel straight into a uint8 memory mapped
+    canvas at the output scale, so memory is bounded by the number of
+    patches in flight rather than the size of the slide
+    :param patch_path: patch directory
+    :param archive: optional pyslide.io.archive_io.ArchiveRead
+    :param kind: image or mask when reading from archive
+    """
 
-    MAG_FACTORS={0:1,1:2,2:4,3:8,4:16,5:32,5:64}
+    MAG_FACTORS={0:1,1:2,2:4,3:8,4:16,5:32,6:64}
 
     def __init__(self,patch_path,
                  slide=None,
@@ -476,35 +847,42 @@ class Stitching():
                  name=None,
                  step=None,
                  border=None,
-                 mag_level=0):
+                 mag_level=0,
+                 archive=None,
+                 kind='image'):
 
         self.patch_path=patch_path
-        patch_files=glob.glob(os.path.join(self.patch_path,'*'))
-        self.patch_files=[os.path.basename(p) for p in patch_files]
-        print(patch_files[0])
-        self.fext=self.patch_files[0].split('.')[-1]
+        self.archive=archive
+        self.kind=kind
         self.slide=slide
-        self.coords=self._get_coords()
         self.mag_level=mag_level
-        print(self.patch_files)
 
         if name is not None:
             self.name=name
         elif patching is not None:
-            self.name=self.patching.slide.name
+            self.name=patching.slide.name
         else:
             raise TypeError("missing name")
 
+        if archive is not None:
+            self.patch_files=[n+'.png' for n in archive.names(kind)]
+        else:
+            self.patch_files=os.listdir(self.patch_path)
+        self.index=self._get_index()
+        self.coords=self._get_coords()
+        if len(self.coords)==0:
+            raise ValueError(f'no patches found for {self.name}')
+        self.fext=self.index[self.coords[0]].split('.')[-1]
+
         if patching is not None:
             self.border=patching.slide.border
+            self.mag_level=patching.mag_level
+        elif border is not None:
+            self.border=border
         else:
             self.border=self._get_border()
- 
-        if patching is not None:
-            self.mag_level=patching.mag_level
-        elif mag_level is not None:
-            self.mag_level=mag_level
 
+        self._step=self._get_step() if step is None else step
         self._completeness()
         print(self.config)
         
@@ -515,7 +893,7 @@ class Stitching():
                 'mag':self.mag_level,
                 'step':self.step,
                 'border':self.border,
-                'patches':len(self.patch_files)}
+                'patches':len(self.index)}
         return config
 
 
@@ -525,25 +903,38 @@ class Stitching():
 
     @property
     def step(self):
-        self._step=self._get_step()
         return self._step
 
 
     @property
     def mag_factor(self):
          return Stitching.MAG_FACTORS[self.mag_level]
-    
-    #TODO: check required coordinates according to parameters
+
+
+    def _get_index(self):
+        """
+        parse patch filenames once into coordinate index
+        :return dict {(x,y): filename}
+        """
+        index={}
+        for f in self.patch_files:
+            stem=os.path.splitext(f)[0]
+            parts=stem.rsplit('_',2)
+            if len(parts)!=3 or parts[0]!=self.name:
+                continue
+            try:
+                index[(int(parts[1]),int(parts[2]))]=f
+            except ValueError:
+                continue
+        return index
+
+
     def _get_coords(self):
         """
         return coordinates of patches based on patch filesnames
         :return self._coords: list [(x1,y1),(x2,y2), ..., (xn,yn)]
         """
-        patch_files=glob.glob(os.path.join(self.patch_path,'*'))
-        coords=[(int(f.split('_')[-2:][0]),int(f.split('_')[-2:][1][:-4]))
-                for f in patch_files]
-
-        self._coords=coords
+        self._coords=sorted(self.index)
         return self._coords
 
 
@@ -552,24 +943,23 @@ class Stitching():
         calculate border based on coordinate maxima and minima
         :return [[xmin,xmax],[ymin,ymax]]
         """
-        coords=self._get_coords()
-        xmax=max([c[0] for c in coords])
-        xmin=min([c[0] for c in coords])
-        ymax=max([c[1] for c in coords])
-        ymin=min([c[1] for c in coords])
-
-        return [[xmin,xmax],[ymin,ymax]]
+        xs=[c[0] for c in self.coords]
+        ys=[c[1] for c in self.coords]
+        return [[min(xs),max(xs)],[min(ys),max(ys)]]
 
 
     def _get_step(self):
         """
-        calculate step based on patch filenames
+        calculate step from the smallest gap between
+        distinct patch coordinates
         :return int(step/self.mag_factor)
         """
-        coords=self._get_coords()
-        xs=[c[0] for c in coords]
-        step=min([abs(x1-x2) for x1, x2 in zip(xs, xs[1:]) if abs(x1-x2)!=0])
-        return int(step/self.mag_factor)
+        xs=np.unique([c[0] for c in self.coords])
+        ys=np.unique([c[1] for c in self.coords])
+        gaps=np.concatenate([np.diff(xs),np.diff(ys)])
+        if len(gaps)==0:
+            raise ValueError('cannot infer step from a single patch, pass step')
+        return int(gaps.min()/self.mag_factor)
 
 
     def _completeness(self):
@@ -578,13 +968,11 @@ class Stitching():
         based on the coordinates. Raises MissingPatches error
         if missing
         """
-        missing_patches=[]
-        for (p_name,_,_) in self._patches():
-            print(p_name)
-            if p_name not in self.patch_files:
-                missing_patches.append(p_name)
-        if len(missing_patches)>0:        
-            raise StitchingMissingPatches(missing_patches)
+        expected={(x,y) for _,x,y in self._patches()}
+        missing=sorted(expected-set(self.index))
+        if len(missing)>0:
+            names=[f'{self.name}_{x}_{y}.{self.fext}' for x,y in missing]
+            raise StitchingMissingPatches(names)
 
 
     def _patches(self):
@@ -594,42 +982,88 @@ class Stitching():
         step=self.step*self.mag_factor
         xmin,xmax=self.border[0][0],self.border[0][1]
         ymin,ymax=self.border[1][0],self.border[1][1]
-        for i,x in enumerate(range(xmin,xmax+step,step)):
-            for j,y in enumerate(range(ymin,ymax+step,step)):
-                filename=self.name+'_'+str(x)+'_'+str(y)+'.'+self.fext
+        for x in range(xmin,xmax+step,step):
+            for y in range(ymin,ymax+step,step):
+                filename=self.index.get((x,y),f'{self.name}_{x}_{y}.{self.fext}')
                 yield filename,x,y
 
 
+    def _read_patch(self,filename):
+        """
+        read patch from directory or archive (BGR as cv2.imread)
+        :param filename: patch filename
+        :return ndarray
+        """
+        if self.archive is None:
+            return cv2.imread(os.path.join(self.patch_path,filename))
+        p=self.archive.read(filename[:-len(self.fext)-1],self.kind)
+        if p.ndim==2:
+            return cv2.cvtColor(p,cv2.COLOR_GRAY2BGR)
+        return cv2.cvtColor(p,cv2.COLOR_RGB2BGR)
+
 
-    def stitch(self,size=None):
+    def stitch(self,size=None,canvas_path=None,workers=8):
         """
         stitches patches together to create entire
         slide representation. Size argument 
-        determnines image size
-        :param size: (x_size,y_size)
+        determnines image size. Patches are downsampled to
+        the output scale as they are decoded
+        :param size: (x_size,y_size) approximate output size
+        :param canvas_path: optional file backing the canvas
+        :param workers: number of decoding threads
+        :return canvas: np.memmap uint8 (h,w,3)
         """
         xmin,xmax=self.border[0][0],self.border[0][1]
         ymin,ymax=self.border[1][0],self.border[1][1]
         z=self.step*self.mag_factor
-        xnew=(xmax+z-xmin)/self.mag_factor
-        ynew=(ymax+z-ymin)/self.mag_factor
-        canvas=np.zeros((int(ynew),int(xnew),3))
-        
-        #what do we do if it is none
+        x_num=(xmax-xmin)//z+1
+        y_num=(ymax-ymin)//z+1
         if size is not None:
-            x_num=(xmax-xmin)/(self.step*self.mag_factor)+1
-            y_num=(ymax-ymin)/(self.step*self.mag_factor)+1
-            xdim_new=(int((size[0]/x_num))+1)*x_num
-            ydim_new=(int((size[1]/y_num))+1)*y_num
-            p_xsize=int(xdim_new/x_num)
-            p_ysize=int(ydim_new/y_num)
-            
-        canvas=np.zeros((int(ydim_new),int(xdim_new),3))
-        for filename,x,y in self._patches():
-            p=cv2.imread(os.path.join(self.patch_path,filename))
-            if size is not None:
-                p=cv2.resize(p,(p_xsize,p_ysize))
-                x=int(((x-xmin)/(self.step*self.mag_factor))*p_xsize)
-                y=int(((y-ymin)/(self.step*self.mag_factor))*p_ysize)
-            canvas[y:y+p_ysize,x:x+p_xsize,:]=p
-        return canvas.astype(np.uint8)
+            p_xsize=int(size[0]/x_num)+1
+            p_ysize=int(size[1]/y_num)+1
+        else:
+            p_xsize=p_ysize=self.step
+        h,w=int(y_num*p_ysize),int(x_num*p_xsize)
+        canvas=temp_memmap((h,w,3),np.uint8,canvas_path)
+        fx,fy=p_xsize/self.step,p_ysize/self.step
+
+        def paste(patch):
+            filename,x,y=patch
+            p=self._read_patch(filename)
+            ph,pw=p.shape[:2]
+            dims=(max(1,int(round(pw*fx))),max(1,int(round(ph*fy))))
+            if dims!=(pw,ph):
+                interp=cv2.INTER_AREA if fx<1 else cv2.INTER_LINEAR
+                p=cv2.resize(p,dims,interpolation=interp)
+            x=int((x-xmin)//z*p_xsize)
+            y=int((y-ymin)//z*p_ysize)
+            #overlapping patches (step < size) are cropped to their step
+            #cell so no pixel is written by two threads; the result is
+            #the same as pasting in order with later patches on top
+            p=p[:min(p_ysize,h-y),:min(p_xsize,w-x)]
+            canvas[y:y+p.shape[0],x:x+p.shape[1],:]=p
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(paste,self._patches()):
+                pass
+        canvas.flush()
+        return canvas
+
+
+    def to_pyramid(self,path,size=None,fmt='dzi',tile_size=256,**kwargs):
+        """
+        stitch and write as a tiled multi-resolution pyramid
+        :param path: output directory
+        :param size: (x_size,y_size) approximate full resolution size
+        :param fmt: dzi (DeepZoom directory) or tiff (pyramidal BigTIFF)
+        :param tile_size: tile edge in pixels
+        :return number of levels
+        """
+        canvas=self.stitch(size)
+        if fmt=='dzi':
+            return DeepZoomWrite(path,self.name,tile_size,bgr=True,**kwargs).write(canvas)
+        elif fmt=='tiff':
+            os.makedirs(path,exist_ok=True)
+            tiff_path=os.path.join(path,self.name+'.tiff')
+            return write_tiff(canvas,tiff_path,tile_size,bgr=True,**kwargs)
+        raise ValueError(f'unknown pyramid format {fmt}')
@@ -60,6 +60,7 @@ class Slide(OpenSlide):
                  filter_mask_path=None):
         super().__init__(filename)
 
+        self.path=filename
         self.mag=mag
         self.dims=self.dimensions
         self.name=os.path.basename(filename)[:-5]
@@ -99,22 +100,23 @@ class Slide(OpenSlide):
             print("no valid mask detected")
     
 
-    def generate_mask(self, size=None):
+    def generate_mask(self, size=None, downsample=1):
         """
         Generates mask representation of annotations.
 
         :param size: tuple of mask dimensions
+        :param downsample: draw mask directly at reduced resolution
         :return: self._slide_mask ndarray. single channel
             mask with integer for each class
         """
-        x, y = self.dims[0], self.dims[1]
+        x, y = self.dims[0]//downsample, self.dims[1]//downsample
         slide_mask=np.zeros((y, x), dtype=np.uint8)
         self.annotations.encode=True
         coordinates=self.annotations.annotations
         keys=sorted(list(coordinates.keys()))
         for k in keys:
             v = coordinates[k]
-            v = [np.array(a) for a in v]
+            v = [(np.array(a)/downsample).astype(np.int32) for a in v]
             cv2.fillPoly(slide_mask, v, color=k)
         if size is not None:
             slide_mask=cv2.resize(slide_mask, size)
@@ -294,7 +296,7 @@ class Slide(OpenSlide):
         start_x = start[0]
         start_y = start[1] 
         if self.filter_mask is None:
-            return region
+            return np.array(region.convert('RGB')), None
         #print(self.filter_mask.shape)
         #need to scale mask to correct size - requested mag / existing mag
         #filter mask will already be stored at the self.mag level
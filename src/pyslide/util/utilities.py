@@ -1,6 +1,9 @@
 '''
 utilities.py: useful functions
 '''
+import copy
+import random
+
 import cv2
 import numpy as np
 import xml.etree.ElementTree as ET
@@ -39,23 +42,25 @@ def oneHotToMask(onehot):
     return multimask
 
 
-#can we sample and return a new patching object
 def sample_patches(patch,n,replacement=False):
-    
+    """
+    random sample of an existing patch list as a new Patch
+    object. See Patch.sample for stratified sampling over
+    the grid without building the list
+    :param patch: pyslide.patching.Patch object
+    :param n: number of patches
+    :param replacement: sample with replacement
+    :return new_patch: Patch object
+    """
     if replacement:
-        patches=random.choice(patch._patches,n)
+        patches=random.choices(patch._patches,k=n)
     else:
-        patches=random.sample(patch._patches,n)
-
-    new_patch =  Patch(patch.slide,
-                       patch.size,
-                       patch.mag_level,
-                       patch.border,  
-                       patch.step)
+        patches=random.sample(patch._patches,min(n,len(patch._patches)))
 
+    new_patch=copy.copy(patch)
     new_patch.patches=patches
-    return new_patches
-
+    new_patch._number=len(patches)
+    return new_patch
 
 
 def detect_tissue_section(slide):
@@ -108,3 +113,60 @@ def match_annotations_to_tissue_contour(
             break
     return c
 
+
+
+def morton_index(i,j):
+    """
+    z-order (morton) index interleaving the bits of i and j
+    :param i: int column
+    :param j: int row
+    :return int index
+    """
+    d=0
+    for b in range(max(int(i).bit_length(),int(j).bit_length())):
+        d|=((i>>b)&1)<<(2*b)
+        d|=((j>>b)&1)<<(2*b+1)
+    return d
+
+
+def hilbert_index(i,j,n):
+    """
+    position of cell (i,j) along a hilbert curve filling n x n
+    :param i: int column
+    :param j: int row
+    :param n: grid side (power of 2)
+    :return int index
+    """
+    d=0
+    s=n//2
+    while s>0:
+        ri=1 if i&s else 0
+        rj=1 if j&s else 0
+        d+=s*s*((3*ri)^rj)
+        if rj==0:
+            if ri==1:
+                i=s-1-i
+                j=s-1-j
+            i,j=j,i
+        s//=2
+    return d
+
+
+def curve_order(cells,order='row'):
+    """
+    reorder grid cells so neighbouring cells are visited
+    consecutively. row keeps the given order
+    :param cells: list of (i,j) grid indices
+    :param order: row, morton or hilbert
+    :return list of positions into cells
+    """
+    if order=='row':
+        return list(range(len(cells)))
+    elif order=='morton':
+        key=lambda k: morton_index(*cells[k])
+    elif order=='hilbert':
+        n=1<<max(1,max(max(c) for c in cells)).bit_length() if cells else 1
+        key=lambda k: hilbert_index(cells[k][0],cells[k][1],n)
+    else:
+        raise ValueError(f'unknown order {order}')
+    return sorted(range(len(cells)),key=key)
@@ -0,0 +1,312 @@
+"""
+run_queue.py: run per-slide jobs on one node with a local work queue
+
+Replaces fanning out one qsub job per slide. Each slide becomes a job
+run in its own process (so openslide/tensorflow memory is returned when
+the job ends). Jobs are started longest first, using the cost estimates
+from plan_jobs.py when a plan csv is given and the slide file size
+otherwise. The number of running jobs is limited by cores and by a
+memory budget shared across the estimated peak memory of running jobs.
+Failed jobs are retried. Every start/finish is appended to a json lines
+ledger so a rerun skips jobs that already completed. Job output goes to
+{log_path}/{job}.log.
+
+    python run_queue.py patch -wp wsi -ap annotations -tp tissue_masks -sp patches
+    python run_queue.py predict -md model.h5 -tp test -sp results -f germinal
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import importlib
+import traceback
+import multiprocessing as mp
+
+import pandas as pd
+
+SRC_PATH=os.path.dirname(os.path.abspath(__file__))
+
+
+class Ledger():
+    """
+    append-only json lines record of job attempts. The last
+    entry for a job is its current status
+    :param path: ledger path
+    """
+    def __init__(self, path):
+        self.path=path
+        self.status={}
+        self.attempts={}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry=json.loads(line)
+                    except ValueError:
+                        continue
+                    self.status[entry['job']]=entry['status']
+                    if entry['status']=='running':
+                        self.attempts[entry['job']]=self.attempts.get(entry['job'],0)+1
+        self._file=open(path,'a')
+
+
+    def __repr__(self):
+        return f'Ledger(path: {self.path}, jobs: {len(self.status)})'
+
+
+    def done(self,job):
+        return self.status.get(job)=='done'
+
+
+    def record(self,job,status,**info):
+        entry={'job':job,'status':status,'time':time.strftime('%Y-%m-%d %H:%M:%S')}
+        entry.update(info)
+        self._file.write(json.dumps(entry)+'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.status[job]=status
+        if status=='running':
+            self.attempts[job]=self.attempts.get(job,0)+1
+
+
+    def close(self):
+        self._file.close()
+
+
+def _run_job(target,kwargs,log_path,path=None):
+    """
+    job process: send stdout/stderr to the job log, import
+    module:function and call it
+    """
+    log=open(log_path,'a')
+    os.dup2(log.fileno(),1)
+    os.dup2(log.fileno(),2)
+    sys.stdout=sys.stderr=log
+    if path is not None:
+        sys.path.insert(0,path)
+    try:
+        module,function=target.split(':')
+        getattr(importlib.import_module(module),function)(**kwargs)
+    except Exception:
+        traceback.print_exc()
+        log.flush()
+        os._exit(1)
+    log.flush()
+    os._exit(0)
+
+
+def total_memory_mb():
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/2**20
+
+
+class WorkQueue():
+    """
+    :param ledger_path: json lines ledger
+    :param log_path: directory for job logs
+    :param workers: max concurrent jobs (default available cores)
+    :param mem_budget_mb: memory shared by running jobs
+        (default 80% of physical memory)
+    :param retries: retries after a failure
+    """
+    def __init__(self,
+                 ledger_path,
+                 log_path,
+                 workers=None,
+                 mem_budget_mb=None,
+                 retries=2):
+        self.ledger=Ledger(ledger_path)
+        self.log_path=log_path
+        self.workers=len(os.sched_getaffinity(0)) if workers is None else workers
+        self.mem_budget_mb=0.8*total_memory_mb() if mem_budget_mb is None else mem_budget_mb
+        self.retries=retries
+        self.jobs=[]
+        os.makedirs(log_path,exist_ok=True)
+
+
+    def __repr__(self):
+        return f'WorkQueue(workers: {self.workers}, memory: {self.mem_budget_mb:.0f}MB, jobs: {len(self.jobs)})'
+
+
+    def add(self,job,target,kwargs,cost=1.0,mem_mb=0.0,path=None):
+        """
+        queue one job
+        :param job: unique job id (slide name)
+        :param target: module:function
+        :param kwargs: keyword arguments for function
+        :param cost: estimated runtime, larger starts first
+        :param mem_mb: estimated peak memory
+        :param path: optional directory added to sys.path in the job
+        """
+        self.jobs.append({'job':job,'target':target,'kwargs':kwargs,
+                          'cost':cost,'mem_mb':mem_mb,'path':path})
+
+
+    def run(self,poll=1.0):
+        """
+        run all queued jobs not already done in the ledger
+        :return dict job: status
+        """
+        ctx=mp.get_context('fork')
+        pending=[j for j in self.jobs if not self.ledger.done(j['job'])]
+        pending.sort(key=lambda j: j['cost'],reverse=True)
+        print(f'{len(self.jobs)-len(pending)} done, {len(pending)} to run')
+        running={}
+        failed={}
+        while pending or running:
+            used=sum(j['mem_mb'] for _, j in running.values())
+            for j in list(pending):
+                if len(running)>=self.workers:
+                    break
+                #a job larger than the budget runs alone
+                if running and used+j['mem_mb']>self.mem_budget_mb:
+                    continue
+                log_path=os.path.join(self.log_path,j['job']+'.log')
+                proc=ctx.Process(target=_run_job,
+                                 args=(j['target'],j['kwargs'],log_path,j['path']))
+                proc.start()
+                self.ledger.record(j['job'],'running',pid=proc.pid)
+                running[j['job']]=(proc,j)
+                pending.remove(j)
+                used+=j['mem_mb']
+                print(f"started {j['job']} ({len(running)} running)")
+
+            time.sleep(poll)
+            for name, (proc,j) in list(running.items()):
+                if proc.is_alive():
+                    continue
+                proc.join()
+                del running[name]
+                if proc.exitcode==0:
+                    self.ledger.record(name,'done')
+                    print(f'done {name}')
+                    continue
+                self.ledger.record(name,'failed',exitcode=proc.exitcode)
+                if self.ledger.attempts.get(name,0)<=self.retries:
+                    print(f'failed {name} (exit {proc.exitcode}), retrying')
+                    pending.append(j)
+                else:
+                    print(f'failed {name} (exit {proc.exitcode}), see {self.log_path}')
+                    failed[name]=proc.exitcode
+        self.ledger.close()
+        print(f'{len(self.jobs)-len(failed)} done, {len(failed)} failed')
+        return {j['job']:('failed' if j['job'] in failed else 'done') for j in self.jobs}
+
+
+def predict_images(model_path,image_names,**kwargs):
+    """
+    load model in the job process and predict a subset of images
+    """
+    from tensorflow.keras.models import load_model
+    from predict import test_predictions
+    model=load_model(model_path,compile=False)
+    test_predictions(model,image_names=image_names,**kwargs)
+
+
+def load_plan(plan_path,task,runtime_col=None):
+    """
+    per slide cost and memory from a plan_jobs.py csv. Prediction
+    plans (plan_jobs.py predict) have runtime_s and are keyed by
+    image name as in test_predictions, patch plans by slide name
+    :param plan_path: plan csv
+    :param task: run_queue task
+    :param runtime_col: optional runtime column override
+    :return dict name: (cost,mem_mb)
+    """
+    if plan_path is None:
+        return {}
+    plan=pd.read_csv(plan_path)
+    if task=='predict':
+        runtime_col=runtime_col or 'runtime_s'
+        names=[os.path.basename(p)[:-9] for p in plan['path']]
+    else:
+        runtime_col=runtime_col or 'runtime_png_s'
+        names=plan['name']
+    return {n:(c,m) for n, c, m in zip(names,plan[runtime_col],plan['mem_peak_mb'])}
+
+
+def merge_csvs(paths,out_path):
+    frames=[pd.read_csv(p,index_col=0) for p in paths if os.path.exists(p)]
+    if frames:
+        pd.concat(frames,ignore_index=True).to_csv(out_path)
+        print(f'merged {len(frames)} results: {out_path}')
+
+
+if __name__=='__main__':
+    ap=argparse.ArgumentParser(description='local work queue for per slide jobs')
+    ap.add_argument('task',choices=['patch','pngs','quantify','predict'])
+    ap.add_argument('-wp','--wsi_path',help='path to slides')
+    ap.add_argument('-ap','--ann_path',help='path to annotations')
+    ap.add_argument('-tp','--tissue_mask_path',help='tissue masks (patch) or test path (predict)')
+    ap.add_argument('-mp','--mask_path',help='wsi masks (pngs) or prediction masks (quantify)')
+    ap.add_argument('-sp','--save_path',required=True,help='output path')
+    ap.add_argument('-ext','--extension',default='ndpi',help='slide extension')
+    ap.add_argument('-md','--model_path',help='trained model (predict)')
+    ap.add_argument('-f','--feature',help='morphological feature (predict)')
+    ap.add_argument('-th','--threshold',default=0.75,help='activation threshold (predict)')
+    ap.add_argument('-td','--tile_dim',default=1024,help='tile dims (predict)')
+    ap.add_argument('-s','--step',default=512,help='sliding window size (predict)')
+    ap.add_argument('-n','--normalize',nargs='+',default=["Scale","StandardizeDataset"],help='normalization methods (predict)')
+    ap.add_argument('-cm','--means',nargs='+',default=[0.675,0.460,0.690],help='channel mean (predict)')
+    ap.add_argument('-cs','--std',nargs='+', default=[0.180,0.269,0.218],help='channel std (predict)')
+    ap.add_argument('-bs','--batch_size',default=8,help='tiles per inference batch (predict)')
+    ap.add_argument('-pp','--plan_path',default=None,help='plan_jobs.py csv for costs')
+    ap.add_argument('-rc','--runtime_col',default=None,help='plan runtime column (default from task)')
+    ap.add_argument('-w','--workers',default=None,help='concurrent jobs (default cores)')
+    ap.add_argument('-mb','--mem_budget',default=None,help='memory budget in MB')
+    ap.add_argument('-jm','--job_mem',default=4096,help='memory per job in MB without a plan')
+    ap.add_argument('-r','--retries',default=2,help='retries per job')
+    args=ap.parse_args()
+
+    queue=WorkQueue(os.path.join(args.save_path,f'{args.task}_ledger.jsonl'),
+                    os.path.join(args.save_path,'logs',args.task),
+                    int(args.workers) if args.workers else None,
+                    float(args.mem_budget) if args.mem_budget else None,
+                    int(args.retries))
+    plan=load_plan(args.plan_path,args.task,args.runtime_col)
+    job_mem=float(args.job_mem)
+
+    if args.task=='predict':
+        paths=sorted(glob.glob(os.path.join(args.tissue_mask_path,'images',args.feature,'*')))
+        names=[os.path.basename(p)[:-9] for p in paths]
+    else:
+        paths=sorted(glob.glob(os.path.join(args.wsi_path,'*.'+args.extension)))
+        names=[os.path.basename(p)[:-len(args.extension)-1] for p in paths]
+
+    results=[]
+    for name, path in zip(names,paths):
+        cost,mem=plan.get(name,(os.path.getsize(path),job_mem))
+        if args.task=='patch':
+            kwargs={'wsi_path':args.wsi_path,'ann_path':args.ann_path,
+                    'tissue_mask_path':args.tissue_mask_path,'save_path':args.save_path,
+                    'classes':['GC','sinus'],'names':[name]}
+            queue.add(name,'generate_patches:patch_slides',kwargs,cost,mem,SRC_PATH)
+        elif args.task=='pngs':
+            kwargs={'wsi_path':args.wsi_path,'ann_path':args.ann_path,
+                    'save_path':args.save_path,'wsi_mask_path':args.mask_path,'names':[name]}
+            queue.add(name,'output_pngs:create_pngs',kwargs,cost,mem,SRC_PATH)
+        elif args.task=='quantify':
+            out_path=os.path.join(args.save_path,name+'_node_details.csv')
+            results.append(out_path)
+            kwargs={'wsiPath':args.wsi_path,'maskPath':args.mask_path,
+                    'savePath':args.save_path,'names':[name],'outPath':out_path}
+            queue.add(name,'quantify:analyseNodes',kwargs,cost,mem,os.path.join(SRC_PATH,'postanalysis'))
+        else:
+            out_path=os.path.join(args.save_path,f'results-{args.threshold}-{name}.csv')
+            results.append(out_path)
+            kwargs={'model_path':args.model_path,'test_path':args.tissue_mask_path,
+                    'save_path':args.save_path,'feature':args.feature,
+                    'threshold':float(args.threshold),'tile_dim':int(args.tile_dim),
+                    'step':int(args.step),'normalize':args.normalize,
+                    'channel_means':[float(m) for m in args.means],
+                    'channel_std':[float(s) for s in args.std],
+                    'batch_size':int(args.batch_size),'results_path':out_path}
+            queue.add(name,'run_queue:predict_images',dict(kwargs,image_names=[name]),cost,mem,SRC_PATH)
+
+    queue.run()
+    if args.task=='quantify':
+        merge_csvs(results,os.path.join(args.save_path,'node_details.csv'))
+    elif args.task=='predict':
+        merge_csvs(results,os.path.join(args.save_path,f'results-{args.threshold}.csv'))
@@ -2,12 +2,19 @@ import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 
+from pyslide.io.pyramid_io import temp_memmap
+
 
 class Canvas():
-    def __init__(self,x_dim,y_dim):
+    def __init__(self,x_dim,y_dim,path=None,dtype=np.uint8):
         #only needs 1 channel as it is a binary mask
+        #with a path the canvas is a .npy memmap so whole slides fit
+        if path is not None:
+            self.canvas=np.lib.format.open_memmap(path,mode='w+',dtype=dtype,
+                                                  shape=(1,int(x_dim),int(y_dim),1))
+            return
         canvas=np.zeros((1,int(x_dim),int(y_dim),1))
-        self.canvas=canvas.astype(np.uint8)
+        self.canvas=canvas.astype(dtype)
     
     #@property
     #def canvas(self):
@@ -19,6 +26,85 @@ class Canvas():
         #existing=self.canvas[:,x:x+m.shape[1],y:y+m.shape[2],:]
         #self.canvas[:,x:x+m.shape[1],y:y+m.shape[2],:]=np.maximum(m,existing)
 
+def blend_window(t_dim, kind='gaussian', sigma=0.125):
+    """
+    2d tile weighting that falls off towards the tile edges
+    :param t_dim: tile dims
+    :param kind: gaussian or cosine
+    :param sigma: gaussian sigma as a fraction of t_dim
+    :return float32 (t_dim,t_dim) window, strictly positive
+    """
+    i=np.arange(t_dim)+0.5
+    if kind=='gaussian':
+        w=np.exp(-((i-t_dim/2)**2)/(2*(sigma*t_dim)**2))
+    elif kind=='cosine':
+        w=np.sin(np.pi*i/t_dim)**2
+    else:
+        raise ValueError(f'unknown blend window {kind}')
+    w=np.outer(w,w)
+    return np.maximum(w/w.max(),1e-6).astype(np.float32)
+
+
+class BlendCanvas():
+    """
+    weighted overlap blending of tile probabilities. Each tile is
+    added as window*p to a sum buffer and window to a weight buffer,
+    both disk backed, and the blended map sum/weight is thresholded
+    once at the end a strip at a time
+    :param x_dim: rows
+    :param y_dim: cols
+    :param t_dim: tile dims
+    :param window: gaussian or cosine
+    :param dtype: accumulator dtype float32 or float16
+    :param path: optional .npy path for the thresholded canvas
+    """
+    def __init__(self,x_dim,y_dim,t_dim,window='gaussian',dtype=np.float32,path=None):
+        self.shape=(int(x_dim),int(y_dim))
+        self.path=path
+        self.window=blend_window(t_dim,window).astype(dtype)
+        self.sum=temp_memmap(self.shape,dtype)
+        self.weight=temp_memmap(self.shape,dtype)
+
+    def add(self,p,x,y):
+        """
+        :param p: tile probabilities (t,t) or (t,t,1)
+        :param x: row offset
+        :param y: col offset
+        """
+        p=np.asarray(p).reshape(self.window.shape)
+        self.sum[x:x+p.shape[0],y:y+p.shape[1]]+=self.window*p
+        self.weight[x:x+p.shape[0],y:y+p.shape[1]]+=self.window
+
+    def probability(self,x,rows):
+        s=self.sum[x:x+rows].astype(np.float32)
+        w=self.weight[x:x+rows].astype(np.float32)
+        return np.divide(s,w,out=np.zeros_like(s),where=w>0)
+
+    def _output(self,dtype):
+        if self.path is not None:
+            return np.lib.format.open_memmap(self.path,mode='w+',dtype=dtype,
+                                             shape=(1,)+self.shape+(1,))
+        return np.zeros((1,)+self.shape+(1,),dtype)
+
+    def threshold(self,threshold,strip=1024):
+        """
+        :return uint8 (1,x_dim,y_dim,1) binary mask (a .npy memmap with a path)
+        """
+        out=self._output(np.uint8)
+        for r in range(0,self.shape[0],strip):
+            out[0,r:r+strip,:,0]=self.probability(r,strip)>threshold
+        return out
+
+    def probabilities(self,strip=1024):
+        """
+        :return float32 (1,x_dim,y_dim,1) blended probabilities
+        """
+        out=self._output(np.float32)
+        for r in range(0,self.shape[0],strip):
+            out[0,r:r+strip,:,0]=self.probability(r,strip)
+        return out
+
+
 def stitch(canvas, mask, x, y, h, w, t_dim, step, margin):
     #Top left
     if (y==0) and (x==0):
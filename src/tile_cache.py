@@ -0,0 +1,187 @@
+"""
+tile_cache.py: content addressed on-disk cache of per-tile model outputs
+
+Keys are sha1 digests of the model weights hash, the tile/normalization
+config and either the tile pixels or a slide tile id (slide, level, x,
+y), so a cached output is only reused by the same model on the same
+input. Each entry is one .npy file under {path}/{key[:2]}/, written to a
+temporary file and renamed so concurrent jobs can share a cache. The
+total size of the directory is kept in {path}/size under a file lock
+shared by every process using the cache. When it passes the budget the
+directory is rescanned and the least recently used entries (file mtime
+is refreshed on every hit) are evicted down to 90% of the budget.
+"""
+
+import os
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+#eviction frees down to this fraction of the budget so the directory
+#is not rescanned on every put once the cache is full
+LOW_WATERMARK=0.9
+
+
+def model_hash(model):
+    """
+    sha1 of a model's weights (keras get_weights)
+    """
+    h=hashlib.sha1()
+    for w in model.get_weights():
+        h.update(np.ascontiguousarray(w).tobytes())
+    return h.hexdigest()
+
+
+class TileCache():
+    """
+    :param path: cache directory
+    :param budget_mb: max size of cached outputs, shared by all
+        processes using path
+    :param dtype: stored dtype of outputs (float16 halves the size
+        but can flip pixels within rounding of the threshold)
+    """
+    def __init__(self, path, budget_mb=2048, dtype=np.float32):
+        self.path=path
+        self.budget=budget_mb*2**20
+        self.dtype=dtype
+        self.hits=0
+        self.misses=0
+        os.makedirs(path,exist_ok=True)
+        self._size_path=os.path.join(path,'size')
+        self._lock_path=os.path.join(path,'.lock')
+        with self._locked():
+            self._write_size(self._evict(self._scan()))
+
+
+    def __repr__(self):
+        return f'TileCache(path: {self.path}, size: {self.size/2**20:.0f}MB, budget: {self.budget/2**20:.0f}MB)'
+
+
+    @staticmethod
+    def key(*parts):
+        """
+        sha1 of str/bytes/ndarray parts
+        """
+        h=hashlib.sha1()
+        for p in parts:
+            if isinstance(p,np.ndarray):
+                p=np.ascontiguousarray(p).tobytes()
+            elif isinstance(p,str):
+                p=p.encode()
+            h.update(p)
+        return h.hexdigest()
+
+
+    def _file(self,key):
+        return os.path.join(self.path,key[:2],key+'.npy')
+
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_path,'a') as f:
+            fcntl.flock(f,fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f,fcntl.LOCK_UN)
+
+
+    def _read_size(self):
+        try:
+            with open(self._size_path) as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError,ValueError):
+            return sum(s for _, _, s in self._scan())
+
+
+    def _write_size(self,size):
+        with open(self._size_path,'w') as f:
+            f.write(str(max(0,int(size))))
+
+
+    @property
+    def size(self):
+        with self._locked():
+            return self._read_size()
+
+
+    def _scan(self):
+        """
+        :return list of (mtime,path,size) of every entry on disk
+        """
+        entries=[]
+        for d in os.scandir(self.path):
+            if not d.is_dir():
+                continue
+            for f in os.scandir(d.path):
+                if f.name.endswith('.npy'):
+                    try:
+                        st=f.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime,f.path,st.st_size))
+        return entries
+
+
+    def get(self,key):
+        """
+        :return cached array or None
+        """
+        path=self._file(key)
+        try:
+            value=np.load(path)
+            os.utime(path)
+        except (FileNotFoundError,ValueError,OSError):
+            self.misses+=1
+            return None
+        self.hits+=1
+        return value
+
+
+    def put(self,key,value):
+        path=self._file(key)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        fd,tmp=tempfile.mkstemp(dir=os.path.dirname(path),suffix='.tmp')
+        with os.fdopen(fd,'wb') as f:
+            np.save(f,np.asarray(value).astype(self.dtype))
+        with self._locked():
+            try:
+                old=os.path.getsize(path)
+            except FileNotFoundError:
+                old=0
+            os.replace(tmp,path)
+            size=self._read_size()+os.path.getsize(path)-old
+            if size>self.budget:
+                #other processes' puts are only seen on disk
+                size=self._evict(self._scan())
+            self._write_size(size)
+
+
+    def _evict(self,entries):
+        """
+        remove least recently used entries down to the low
+        watermark if over budget (caller holds the lock)
+        :param entries: list of (mtime,path,size)
+        :return size left
+        """
+        size=sum(s for _, _, s in entries)
+        if size<=self.budget:
+            return size
+        for _, path, s in sorted(entries):
+            if size<=self.budget*LOW_WATERMARK:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size-=s
+        return size
+
+
+    @property
+    def hit_rate(self):
+        total=self.hits+self.misses
+        return self.hits/total if total else 0.0
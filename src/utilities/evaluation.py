@@ -38,3 +38,58 @@ def iouScore(yTrue, yPred, axIdx=[1,2,3], smooth=1):
     iou = K.mean((intersection + smooth)/(union + smooth), axis=0)
 
     return iou
+
+
+
+def probabilityHistograms(prob, mask, levels=256):
+    '''
+    counts of quantized probabilities over ground truth positive
+    and negative pixels. Level q stands for p=q/(levels-1), so
+    uint8 maps saved as p*255 are used as is
+    Args:
+        prob: probability map, uint8 (p*255) or float in [0,1]
+        mask: ground truth mask, positive where > 0
+        levels: quantization levels for float maps
+    Returns:
+        pos: counts per level over positive pixels
+        neg: counts per level over negative pixels
+    '''
+    prob = np.asarray(prob)
+    if prob.dtype == np.uint8:
+        levels = 256
+        q = prob.ravel()
+    else:
+        q = np.rint(np.clip(prob.astype(np.float32), 0, 1)*(levels-1)).astype(np.int64).ravel()
+    gt = np.asarray(mask).ravel() > 0
+    pos = np.bincount(q[gt], minlength=levels)
+    neg = np.bincount(q[~gt], minlength=levels)
+    return pos, neg
+
+
+
+def thresholdSweep(pos, neg, thresholds, smooth=1):
+    '''
+    dice and iou of prob > threshold for every threshold from
+    the histograms of probabilityHistograms
+    Args:
+        pos: counts per level over positive pixels
+        neg: counts per level over negative pixels
+        thresholds: list of thresholds
+        smooth: smoothing as in diceCoef/iouScore
+    Returns:
+        dices: list of dice per threshold
+        ious: list of iou per threshold
+    '''
+    levels = len(pos)
+    #counts at or above each level
+    tpAbove = np.cumsum(pos[::-1])[::-1]
+    fpAbove = np.cumsum(neg[::-1])[::-1]
+    total = pos.sum()
+    dices, ious = [], []
+    for t in thresholds:
+        k = int(np.floor(t*(levels-1)+1e-9))+1
+        tp = tpAbove[k] if k < levels else 0
+        fp = fpAbove[k] if k < levels else 0
+        dices.append((2.*tp+smooth)/(total+tp+fp+smooth))
+        ious.append((tp+smooth)/(total+fp+smooth))
+    return dices, ious